@@ -8,7 +8,7 @@ from dash_bootstrap_templates import load_figure_template
 
 from src.analysis.appdata import SplitResults
 from src.common import connect_mongo
-from app.helpers import load_app_data
+from app.helpers import load_app_data, resolve_release
 
 if os.getenv("OSRS_APPDATA_URI") is None:
     raise ValueError("missing config variable: OSRS_APPDATA_URI")
@@ -27,8 +27,9 @@ app = Dash(
         'content': 'width=device-width, initial-scale=1',
     }],
 )
-appdb = connect_mongo(os.environ['OSRS_MONGO_URI'], os.environ['OSRS_MONGO_COLL'])
-appdata: Dict[str, SplitResults] = load_app_data(os.environ['OSRS_APPDATA_URI'])
+appdata_path, appdb_coll = resolve_release(os.environ['OSRS_APPDATA_URI'], os.environ['OSRS_MONGO_COLL'])
+appdb = connect_mongo(os.environ['OSRS_MONGO_URI'], appdb_coll)
+appdata: Dict[str, SplitResults] = load_app_data(appdata_path)
 
 if os.getenv('OSRS_USE_AUTH'):
     auth_coll = connect_mongo(os.environ['OSRS_MONGO_URI'], collection='auth')
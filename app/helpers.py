@@ -4,7 +4,6 @@ import base64
 import collections
 import json
 import os
-import pickle
 import string
 from functools import lru_cache
 from pathlib import Path
@@ -12,7 +11,8 @@ from typing import OrderedDict, Any, Tuple, Dict, List
 
 from src.common import download_s3_obj, osrs_skills
 from src.analysis.appdata import SplitResults
-from src.analysis.io import load_pkl
+from src.analysis.io import load_artifact
+from src.analysis.publish import MANIFEST_NAME, load_manifest, artifact_url
 
 
 VALID_UNAME_CHARS = (string.ascii_lowercase +
@@ -45,17 +45,25 @@ def load_icon_b64(path: str) -> str:
         return base64.b64encode(f.read()).decode('utf-8')
 
 
+def resolve_release(appdata_uri: str, collection: str) -> Tuple[str, str]:
+    """ Get the location of the app data and the database collection to
+    serve. If the app data URI is that of a release manifest, both are taken
+    from the current release, so they always match. Releases published
+    without a collection use the one given. """
+
+    if not (appdata_uri.startswith('s3://') and appdata_uri.endswith(MANIFEST_NAME)):
+        return appdata_uri, collection
+    manifest = load_manifest(appdata_uri)
+    return artifact_url(manifest, appdata_uri, 'app-data'), manifest.get('collection', collection)
+
+
 @lru_cache()
 def load_app_data(path: str) -> OrderedDict[str, SplitResults]:
     """ Load app data from S3 bucket or local path. """
 
     if path.startswith('s3://'):
-        blob = download_s3_obj(url=path)
-        app_data = pickle.loads(blob)
-    else:
-        app_data = load_pkl(path)
-
-    return app_data
+        path = download_s3_obj(url=path)  # cached on disk and memory-mapped rather than read into memory
+    return load_artifact(path)
 
 
 @lru_cache()
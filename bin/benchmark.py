@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+""" Benchmarks for performance-sensitive parts of the pipeline. """
+
+import argparse
+import csv
+import datetime
+import filecmp
+import gzip
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, OrderedDict, Tuple
+
+import faiss
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+from tqdm import tqdm
+
+from src.common import osrs_skills
+from src.analysis.io import load_artifact, dump_artifact, load_json, export_players_csv, export_centroids_csv
+from src.analysis.models import fit_kmeans, fit_minibatch_kmeans, kmeans_inertia, assign_clusters, centroid_index, \
+    assignment_mismatch, set_num_threads, assign_levels
+from src.analysis.synthetic import synthetic_players
+from scripts.cluster_players import split_features, collapse_duplicates, MINIBATCH_INIT_ITERS, \
+    MIN_POINTS_PER_CENTROID
+
+
+def export_players_csv_rowwise(players_df: pd.DataFrame, file: str):
+    """ Row-at-a-time player stats export, as used before vectorizing. """
+
+    with open(file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['username', 'rank'] + list(players_df.columns))
+        for rank, (uname, stats) in tqdm(enumerate(players_df.iterrows(), 1), total=len(players_df)):
+            line = [uname, rank]
+            for n in stats:
+                if n == 0:
+                    line.append('')
+                else:
+                    line.append(n)
+            writer.writerow(line)
+
+
+def export_centroids_csv_rowwise(centroids_dict: OrderedDict[str, pd.DataFrame], file):
+    """ Row-at-a-time centroids export, as used before vectorizing. """
+
+    header = ['split', 'clusterid'] + osrs_skills(include_total=False)
+    with open(file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for split, split_centroids in centroids_dict.items():
+            lines = []
+            for clusterid, centroid in split_centroids.iterrows():
+                skill_vals = []
+                for s in osrs_skills():
+                    skill_vals.append('' if s not in centroid.index else centroid[s])
+                lines.append([split, clusterid] + skill_vals)
+            writer.writerows(lines)
+
+
+def cluster_l2_whole(x: NDArray, centroids: NDArray) -> NDArray:
+    """ Cluster assignment searching every vector at once, as used before chunking. """
+
+    x = x.copy().astype('float32')
+    index = faiss.IndexFlatL2(x.shape[1])
+    index.add(centroids.astype('float32'))
+    _, result = index.search(x, k=1)
+    clusterids = [i[0] for i in result]
+    return np.array(clusterids).astype('int')
+
+
+def timed(fn, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def reset_peak_rss():
+    """ Start measuring peak memory use from now on (Linux only, elsewhere the peak is since the process started). """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """ Peak resident memory of this process in bytes, since it started or since reset_peak_rss(). """
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if platform.system() == 'Darwin' else maxrss * 1024  # bytes on macOS, kilobytes on Linux
+
+
+def git_commit() -> Tuple[str, bool]:
+    """ Commit checked out in the repository, and whether there are uncommitted changes to tracked files. """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def same_contents(file1: str, file2: str) -> bool:
+    if not file2.endswith('.gz'):
+        return filecmp.cmp(file1, file2, shallow=False)
+    with open(file1, 'rb') as f1, gzip.open(file2, 'rb') as f2:
+        return f1.read() == f2.read()
+
+
+def bench_export(args):
+    """ Time CSV export of the published dataset files, comparing the
+    row-at-a-time writers with the vectorized ones and checking that they
+    produce identical output. """
+
+    players = load_artifact(args.stats_file)
+    if args.nrows is not None:
+        players = players.iloc[:args.nrows]
+    print(f"loaded {len(players)} players from {args.stats_file}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = []
+        baseline = os.path.join(tmp, 'players-rowwise.csv')
+        results.append(('players rowwise', timed(export_players_csv_rowwise, players, baseline), baseline))
+        for nworkers in sorted({1, args.num_workers}):
+            out = os.path.join(tmp, f'players-{nworkers}.csv')
+            results.append((f'players vectorized x{nworkers}', timed(export_players_csv, players, out, nworkers), out))
+        out = os.path.join(tmp, f'players-{args.num_workers}.csv.gz')
+        results.append((f'players vectorized x{args.num_workers} gzip',
+                        timed(export_players_csv, players, out, args.num_workers), out))
+
+        centroids = OrderedDict(all=players[osrs_skills()].iloc[:2000].astype('float32') / 3)
+        centroids['all'].index = range(len(centroids['all']))
+        baseline_centroids = os.path.join(tmp, 'centroids-rowwise.csv')
+        results.append(('centroids rowwise', timed(export_centroids_csv_rowwise, centroids, baseline_centroids),
+                        baseline_centroids))
+        out = os.path.join(tmp, 'centroids.csv')
+        results.append(('centroids vectorized', timed(export_centroids_csv, centroids, out), out))
+
+        print(f"\n{'method':<36}{'seconds':>10}{'speedup':>10}  identical")
+        reference = {}
+        for name, seconds, file in results:
+            kind = name.split()[0]
+            base_seconds, base_file = reference.setdefault(kind, (seconds, file))
+            identical = same_contents(base_file, file)
+            print(f"{name:<36}{seconds:>10.2f}{base_seconds / seconds:>9.1f}x  {identical}")
+
+
+def bench_kmeans(args):
+    """ Compare full-batch k-means over every player with mini-batch k-means
+    streaming batches of players, by runtime and by the inertia of the fit
+    over the whole dataset. """
+
+    skills = load_json(args.splits_file)[args.split]
+    k = args.k or load_json(args.params_file)[args.split]['k']
+    players = load_artifact(args.stats_file, columns=skills, index=False)
+    if args.nrows is not None:
+        players = players.iloc[:args.nrows]
+    x, w = split_features(players.to_numpy())
+    x = x.astype('float32')
+    print(f"loaded {len(x)} players from {args.stats_file}, clustering split '{args.split}' with k = {k}")
+
+    results = []
+    start = time.perf_counter()
+    centroids = fit_kmeans(x, k, w, verbose=False)
+    results.append(('full batch', time.perf_counter() - start, kmeans_inertia(x, w, centroids)))
+
+    for batch_rows in args.batch_rows:
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        nsample = min(len(x), max(batch_rows, k * MIN_POINTS_PER_CENTROID))
+        sample = rng.choice(len(x), nsample, replace=False)
+        init = fit_kmeans(x[sample], k, w[sample], verbose=False, niter=MINIBATCH_INIT_ITERS, nredo=1)
+
+        def batches():
+            for batch_start in rng.permutation(np.arange(0, len(x), batch_rows)):
+                yield x[batch_start:batch_start + batch_rows], w[batch_start:batch_start + batch_rows]
+
+        centroids, _ = fit_minibatch_kmeans(batches, init, verbose=False)
+        results.append((f'mini-batch {batch_rows}', time.perf_counter() - start, kmeans_inertia(x, w, centroids)))
+
+    print(f"\n{'method':<24}{'seconds':>10}{'speedup':>10}{'inertia':>14}{'vs full':>10}")
+    base_seconds, base_inertia = results[0][1], results[0][2]
+    for name, seconds, inertia in results:
+        print(f"{name:<24}{seconds:>10.2f}{base_seconds / seconds:>9.1f}x{inertia:>14.2f}{inertia / base_inertia:>9.3f}x")
+
+
+def bench_assign(args):
+    """ Compare cluster assignment of every player in one search with the
+    chunked assignment, by runtime and by peak memory allocated by numpy
+    (as traced by tracemalloc, which doesn't see memory allocated by faiss). """
+
+    skills = load_json(args.splits_file)[args.split]
+    players = load_artifact(args.stats_file, columns=skills, index=False)
+    if args.nrows is not None:
+        players = players.iloc[:args.nrows]
+    x = np.ascontiguousarray(players.to_numpy(), dtype='float32')
+    centroids = x[np.random.default_rng(0).choice(len(x), args.k, replace=False)]
+    print(f"loaded {len(x)} players from {args.stats_file}, assigning split '{args.split}' to {args.k} clusters")
+
+    methods = [('whole', lambda: cluster_l2_whole(x, centroids))]
+    for nthreads in sorted({1, args.num_threads}):
+        methods.append((f'chunked x{nthreads}', lambda n=nthreads: assign_clusters(x, centroids, num_threads=n)[0]))
+
+    print(f"\n{'method':<24}{'seconds':>10}{'speedup':>10}{'peak MB':>10}  identical")
+    baseline = None
+    for name, fn in methods:
+        tracemalloc.start()
+        start = time.perf_counter()
+        ids = fn()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if baseline is None:
+            baseline = (seconds, ids)
+        print(f"{name:<24}{seconds:>10.2f}{baseline[0] / seconds:>9.1f}x{peak / 1024 ** 2:>10.1f}  "
+              f"{np.array_equal(ids, baseline[1])}")
+
+
+def bench_approx(args):
+    """ Compare exact cluster assignment with the approximate indexes over
+    increasing numbers of clusters, by runtime (including building the
+    index) and by the fraction of players not assigned their nearest centroid. """
+
+    skills = load_json(args.splits_file)[args.split]
+    players = load_artifact(args.stats_file, columns=skills, index=False)
+    if args.nrows is not None:
+        players = players.iloc[:args.nrows]
+    x, w = split_features(players.to_numpy())
+    x = np.ascontiguousarray(x, dtype='float32')
+    print(f"loaded {len(x)} players from {args.stats_file}, assigning split '{args.split}'")
+
+    print(f"\n{'k':>7}  {'method':<14}{'build s':>10}{'assign s':>10}{'speedup':>10}{'mismatch':>10}")
+    for k in args.k:
+        # Centroids are fit to a sample, which is enough to place them like those of a real clustering.
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(x), min(len(x), k * 10), replace=False)
+        centroids = fit_kmeans(x[sample], k, w[sample], verbose=False, niter=10, nredo=1)
+        exact_seconds = None
+        for method in ['flat', 'hnsw', 'ivf']:
+            for effort in ([None] if method == 'flat' else args.effort or [None]):
+                start = time.perf_counter()
+                centroid_index(centroids, method, effort)
+                build_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                ids, _ = assign_clusters(x, centroids, method=method, effort=effort)
+                seconds = time.perf_counter() - start
+                exact_seconds = exact_seconds or seconds
+                nwrong, nchecked = assignment_mismatch(x, centroids, ids)
+                name = method if effort is None else f'{method} {effort}'
+                print(f"{k:>7}  {name:<14}{build_seconds:>10.2f}{seconds:>10.2f}{exact_seconds / seconds:>9.1f}x"
+                      f"{nwrong / nchecked:>10.2%}")
+
+
+def bench_lut(args):
+    """ Compare cluster assignment by faiss (from raw levels, so including
+    the conversion to features) with the lookup-table engines over
+    increasing numbers of clusters, by runtime and by the fraction of
+    players assigned a different cluster (ties broken by rounding). """
+
+    skills = load_json(args.splits_file)[args.split]
+    players = load_artifact(args.stats_file, columns=skills, index=False)
+    if args.nrows is not None:
+        players = players.iloc[:args.nrows]
+    levels = np.ascontiguousarray(players.to_numpy(), dtype='uint8')
+    x, _ = split_features(levels)
+    print(f"loaded {len(levels)} players from {args.stats_file}, assigning split '{args.split}'")
+    assign_levels(levels[:1], x[:1])  # compile the kernel before timing it
+
+    print(f"\n{'k':>7}  {'method':<14}{'seconds':>10}{'speedup':>10}{'differ':>10}")
+    for k in args.k:
+        centroids = x[np.random.default_rng(0).choice(len(x), k, replace=False)]
+        methods = [('faiss', lambda: assign_clusters(split_features(levels)[0], centroids)[0]),
+                   ('lut numba', lambda: assign_levels(levels, centroids, engine='numba')[0])]
+        if len(levels) * k <= args.numpy_max_cells:
+            methods.append(('lut numpy', lambda: assign_levels(levels, centroids, chunk_rows=4096, engine='numpy')[0]))
+        baseline = None
+        for name, fn in methods:
+            start = time.perf_counter()
+            ids = fn()
+            seconds = time.perf_counter() - start
+            baseline = baseline or (seconds, ids)
+            print(f"{k:>7}  {name:<14}{seconds:>10.2f}{baseline[0] / seconds:>9.1f}x{np.mean(ids != baseline[1]):>10.4%}")
+
+
+def bench_synthetic(args):
+    """ Write a synthetic player stats dataset, for use by the other benchmarks. """
+
+    start = time.perf_counter()
+    players = synthetic_players(args.nrows, seed=args.seed, names=True)
+    print(f"generated {len(players)} players in {time.perf_counter() - start:.2f}s")
+    dump_artifact(players, args.out_file, index_label='username')
+    print(f"wrote synthetic player stats to {args.out_file}")
+
+
+def bench_cluster(args):
+    """ Time k-means fitting and cluster assignment for each split on
+    synthetic datasets of several sizes, the way the pipeline clusters
+    players (duplicates collapsed, then every player assigned). Each
+    result is appended to a JSON lines file with the commit, machine and
+    settings it was measured with, and compared with the latest result for
+    the same settings from another commit. """
+
+    splits = load_json(args.splits_file)
+    k_per_split = {split: args.k or params['k'] for split, params in load_json(args.params_file).items()}
+    if args.num_threads is not None:
+        set_num_threads(args.num_threads)
+    commit, dirty = git_commit()
+    run = {'commit': commit, 'dirty': dirty, 'time': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+           'host': platform.node(), 'cpu_count': os.cpu_count(), 'faiss_version': faiss.__version__,
+           'faiss_threads': faiss.omp_get_max_threads(), 'niter': args.niter, 'nredo': args.nredo,
+           'seed': args.seed}
+    print(f"commit {commit}{' (with uncommitted changes)' if dirty else ''}, "
+          f"faiss {faiss.__version__} with {run['faiss_threads']} threads")
+
+    previous = []
+    if os.path.isfile(args.results_file):
+        with open(args.results_file) as f:
+            previous = [json.loads(line) for line in f if line.strip()]
+    config_keys = ['nrows', 'split', 'k', 'niter', 'nredo', 'seed', 'faiss_threads', 'host']
+
+    def baseline(record: Dict[str, Any]) -> Dict[str, Any]:
+        matches = [r for r in previous if r['commit'] != record['commit'] and
+                   all(r.get(key) == record[key] for key in config_keys)]
+        return matches[-1] if matches else None
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results_file)), exist_ok=True)
+    print(f"\n{'players':>10}  {'split':<8}{'k':>6}{'unique':>10}{'fit s':>10}{'assign s':>10}{'peak MB':>10}"
+          f"{'inertia':>10}  vs previous")
+    for nrows in args.nrows:
+        players = synthetic_players(nrows, seed=args.seed)
+        for split, skills in splits.items():
+            k = min(k_per_split[split], nrows)
+            reset_peak_rss()
+            features, weights = split_features(players[skills].to_numpy())
+            start = time.perf_counter()
+            points, point_weights, _ = collapse_duplicates(features, weights, k)
+            centroids = fit_kmeans(points, k, point_weights, verbose=False, niter=args.niter, nredo=args.nredo)
+            fit_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            _, sqdists = assign_clusters(features, centroids)
+            assign_seconds = time.perf_counter() - start
+            record = dict(run, nrows=nrows, split=split, k=k, unique=len(points), fit_seconds=fit_seconds,
+                          assign_seconds=assign_seconds, peak_rss=peak_rss(),
+                          inertia=float(weights @ sqdists) / max(float(weights.sum()), 1e-12))
+            del features, weights, points, point_weights, sqdists
+
+            base = baseline(record)
+            vs = (f"fit {record['fit_seconds'] / base['fit_seconds']:.2f}x, "
+                  f"assign {record['assign_seconds'] / base['assign_seconds']:.2f}x, "
+                  f"memory {record['peak_rss'] / base['peak_rss']:.2f}x of {base['commit'][:10]}") if base else '-'
+            print(f"{nrows:>10}  {split:<8}{k:>6}{record['unique']:>10}{fit_seconds:>10.2f}{assign_seconds:>10.2f}"
+                  f"{record['peak_rss'] / 1024 ** 2:>10.0f}{record['inertia']:>10.2f}  {vs}")
+            with open(args.results_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        del players
+    print(f"\nappended results to {args.results_file}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark parts of the processing pipeline.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    export = subparsers.add_parser('export', help="CSV export of the published dataset")
+    export.add_argument('--stats-file', default=os.environ.get('PLAYER_STATS_FILE'), help="player stats artifact")
+    export.add_argument('--nrows', type=int, default=None, help="only export this many players")
+    export.add_argument('--num-workers', type=int, default=os.cpu_count(), help="processes for parallel export")
+    export.set_defaults(run=bench_export)
+
+    kmeans = subparsers.add_parser('kmeans', help="full-batch vs. mini-batch k-means")
+    kmeans.add_argument('--stats-file', default=os.environ.get('PLAYER_STATS_FILE'), help="player stats artifact")
+    kmeans.add_argument('--splits-file', default=os.environ.get('SPLITS_FILE'), help="skills in each split")
+    kmeans.add_argument('--params-file', default=os.environ.get('PARAMS_FILE'), help="clustering parameters")
+    kmeans.add_argument('--split', default='all', help="cluster the skills in this split")
+    kmeans.add_argument('--k', type=int, default=None, help="number of clusters (default is k from the params file)")
+    kmeans.add_argument('--nrows', type=int, default=None, help="only cluster this many players")
+    kmeans.add_argument('--batch-rows', type=int, nargs='+', default=[65536], help="mini-batch sizes to try")
+    kmeans.set_defaults(run=bench_kmeans)
+
+    assign = subparsers.add_parser('assign', help="whole vs. chunked cluster assignment")
+    assign.add_argument('--stats-file', default=os.environ.get('PLAYER_STATS_FILE'), help="player stats artifact")
+    assign.add_argument('--splits-file', default=os.environ.get('SPLITS_FILE'), help="skills in each split")
+    assign.add_argument('--split', default='all', help="assign players by the skills in this split")
+    assign.add_argument('--k', type=int, default=2000, help="number of clusters")
+    assign.add_argument('--nrows', type=int, default=None, help="only assign this many players")
+    assign.add_argument('--num-threads', type=int, default=os.cpu_count(), help="chunks searched at once")
+    assign.set_defaults(run=bench_assign)
+
+    approx = subparsers.add_parser('approx', help="exact vs. approximate cluster assignment across k")
+    approx.add_argument('--stats-file', default=os.environ.get('PLAYER_STATS_FILE'), help="player stats artifact")
+    approx.add_argument('--splits-file', default=os.environ.get('SPLITS_FILE'), help="skills in each split")
+    approx.add_argument('--split', default='all', help="assign players by the skills in this split")
+    approx.add_argument('--k', type=int, nargs='+', default=[500, 2000, 8000, 32000], help="numbers of clusters")
+    approx.add_argument('--effort', type=int, nargs='+', default=None,
+                        help="search efforts to try for the approximate indexes (default is their default)")
+    approx.add_argument('--nrows', type=int, default=None, help="only assign this many players")
+    approx.set_defaults(run=bench_approx)
+
+    lut = subparsers.add_parser('lut', help="faiss vs. lookup-table cluster assignment across k")
+    lut.add_argument('--stats-file', default=os.environ.get('PLAYER_STATS_FILE'), help="player stats artifact")
+    lut.add_argument('--splits-file', default=os.environ.get('SPLITS_FILE'), help="skills in each split")
+    lut.add_argument('--split', default='all', help="assign players by the skills in this split")
+    lut.add_argument('--k', type=int, nargs='+', default=[25, 100, 500, 2000], help="numbers of clusters")
+    lut.add_argument('--nrows', type=int, default=None, help="only assign this many players")
+    lut.add_argument('--numpy-max-cells', type=int, default=10 ** 9,
+                     help="skip the numpy engine when players times clusters exceeds this")
+    lut.set_defaults(run=bench_lut)
+
+    synthetic = subparsers.add_parser('synthetic', help="write a synthetic player stats dataset")
+    synthetic.add_argument('--nrows', type=int, required=True, help="number of players")
+    synthetic.add_argument('--out-file', required=True, help="write the player stats artifact to this file")
+    synthetic.add_argument('--seed', type=int, default=0, help="seed for generating players")
+    synthetic.set_defaults(run=bench_synthetic)
+
+    cluster = subparsers.add_parser('cluster', help="k-means fit and assignment on synthetic datasets")
+    cluster.add_argument('--splits-file', default=os.environ.get('SPLITS_FILE'), help="skills in each split")
+    cluster.add_argument('--params-file', default=os.environ.get('PARAMS_FILE'), help="clustering parameters")
+    cluster.add_argument('--nrows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                         help="sizes of synthetic datasets to cluster (e.g. up to 20000000)")
+    cluster.add_argument('--k', type=int, default=None, help="number of clusters (default is k from the params file)")
+    cluster.add_argument('--niter', type=int, default=20, help="k-means iterations (the pipeline runs 100)")
+    cluster.add_argument('--nredo', type=int, default=1, help="k-means restarts (the pipeline runs 10)")
+    cluster.add_argument('--num-threads', type=int, default=None, help="threads used by faiss (default is all)")
+    cluster.add_argument('--seed', type=int, default=0, help="seed for generating players")
+    cluster.add_argument('--results-file', default='data/benchmarks/clustering.jsonl',
+                         help="append results to this JSON lines file")
+    cluster.set_defaults(run=bench_cluster)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -4,14 +4,14 @@
 
 import argparse
 import numpy as np
-from src.analysis.io import load_pkl, export_players_csv
+from src.analysis.io import load_artifact, export_players_csv
 
 parser = argparse.ArgumentParser(description="Build a small dataset for unit tests.")
-parser.add_argument('--base-file', required=True, help="player stats .pkl file")
+parser.add_argument('--base-file', required=True, help="player stats file")
 parser.add_argument('--out-file', required=True, help="write small dataset to this CSV file")
 args = parser.parse_args()
 
-players = load_pkl(args.in_file)
+players = load_artifact(args.base_file)
 players = players.sample(10000, random_state=0)
 
 sortinds = np.argsort(players['total'])[::-1]
@@ -5,19 +5,32 @@
 import argparse
 import os
 import sys
-from src.common import download_s3_obj
+from botocore.exceptions import ClientError
+from src.common import download_s3_file, s3_object_missing, S3_DOWNLOAD_WORKERS
 
 parser = argparse.ArgumentParser(description="Download an S3 object to a local file.")
 parser.add_argument('s3_url', help="S3 URL for object to download")
 parser.add_argument('out_file', help="write object to this file as a binary blob")
+parser.add_argument('--fallback-url', default=None,
+                    help="download this object instead if there is no object at s3_url "
+                         "(e.g. the same data in an older format)")
+parser.add_argument('--num-workers', default=S3_DOWNLOAD_WORKERS, type=int,
+                    help="number of byte ranges to download at once")
 args = parser.parse_args()
 
-if os.path.isfile(args.out_file):
+# A file without a recorded ETag wasn't downloaded here (e.g. it was built
+# locally), so it is kept rather than checked against the object.
+if os.path.isfile(args.out_file) and not os.path.isfile(f'{args.out_file}.etag'):
     print(f"{args.out_file} already exists, skipping download")
     sys.exit(0)
 
-blob = download_s3_obj(url=args.s3_url)
-with open(args.out_file, 'wb') as f:
-    f.write(blob)
+# Skips the download if the file is already an up-to-date copy of the object.
+try:
+    download_s3_file(args.s3_url, args.out_file, num_workers=args.num_workers)
+except ClientError as e:
+    if args.fallback_url is None or not s3_object_missing(e):
+        raise
+    print(f"{args.s3_url} does not exist, downloading {args.fallback_url} instead")
+    download_s3_file(args.fallback_url, args.out_file, num_workers=args.num_workers)
 
 print(f"wrote to {args.out_file}")
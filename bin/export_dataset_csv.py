@@ -2,20 +2,26 @@
 
 """ Export player stats, cluster IDs, and cluster centroids to CSV. """
 
+import argparse
 import os
-from src.analysis.io import load_pkl, export_players_csv, export_clusterids_csv, export_centroids_csv
+from src.analysis.io import load_artifact, export_players_csv, export_clusterids_csv, export_centroids_csv
 
-centroids_pkl = os.environ['CLUSTER_CENTROIDS_FILE']
+parser = argparse.ArgumentParser(description="Export dataset files to CSV format.")
+parser.add_argument('--num-workers', default=os.cpu_count(), type=int, help="number of processes for formatting")
+parser.add_argument('--gzip', action='store_true', help="if set, gzip-compress player stats (written to .csv.gz)")
+args = parser.parse_args()
+
+centroids_file = os.environ['CLUSTER_CENTROIDS_FILE']
 centroids_csv = os.environ['CLUSTER_CENTROIDS_CSV']
-clusterids_pkl = os.environ['CLUSTER_IDS_FILE']
+clusterids_file = os.environ['CLUSTER_IDS_FILE']
 clusterids_csv = os.environ['CLUSTER_IDS_CSV']
-stats_pkl = os.environ['PLAYER_STATS_FILE']
-stats_csv = os.environ['PLAYER_STATS_CSV']
+stats_file = os.environ['PLAYER_STATS_FILE']
+stats_csv = os.environ['PLAYER_STATS_CSV'] + ('.gz' if args.gzip else '')
 
 print(f"exporting cluster centroids to csv...")
-export_centroids_csv(load_pkl(centroids_pkl), centroids_csv)
+export_centroids_csv(load_artifact(centroids_file), centroids_csv)
 print(f"exporting cluster IDs to csv...")
-export_clusterids_csv(load_pkl(clusterids_pkl), clusterids_csv)
+export_clusterids_csv(load_artifact(clusterids_file), clusterids_csv)
 print(f"exporting player stats to csv...")
-export_players_csv(load_pkl(stats_pkl), stats_csv)
+export_players_csv(load_artifact(stats_file), stats_csv, num_workers=args.num_workers)
 print("done")
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+""" Delete cached results of pipeline stages. """
+
+import argparse
+from src.analysis.cache import StageCache, prune_cache
+from src.analysis.io import parse_memory_size
+
+parser = argparse.ArgumentParser(description="Delete cached results of pipeline stages.")
+parser.add_argument('cache_dir', help="cache directory passed to the stages with --cache-dir")
+parser.add_argument('--max-size', default=None, type=parse_memory_size,
+                    help="delete the least recently used results until the cache is at most this size "
+                         "(e.g. '10G')")
+parser.add_argument('--stage', default=None, nargs='+', help="delete every result of these stages")
+args = parser.parse_args()
+if args.max_size is None and args.stage is None:
+    parser.error("nothing to delete: give --max-size and/or --stage")
+
+for stage in args.stage or []:
+    StageCache(args.cache_dir, stage).clear()
+    print(f"cleared cached results of {stage}")
+if args.max_size is not None:
+    freed = prune_cache(args.cache_dir, args.max_size)
+    print(f"freed {freed / 1024 ** 2:.1f} MB from {args.cache_dir}")
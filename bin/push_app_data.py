@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+""" Publish pipeline artifacts as a release and build its application database. """
+
+import argparse
+import os
+import subprocess
+import sys
+from src.analysis.publish import publish_artifacts, publish_manifest, load_manifest, release_name, \
+    release_history, stale_collections, MANIFEST_NAME, PUBLISH_WORKERS
+from src.common import connect_mongo
+
+parser = argparse.ArgumentParser(description="Upload application data to production.")
+parser.add_argument('--release-uri', default=os.environ.get('OSRS_RELEASE_URI'),
+                    help="S3 URL of the directory holding releases and their manifest")
+parser.add_argument('--num-workers', default=PUBLISH_WORKERS, type=int, help="number of parts to upload at once")
+parser.add_argument('--skip-db', action='store_true',
+                    help="if set, only upload artifacts (the release keeps the last release's collection)")
+args = parser.parse_args()
+
+if not args.release_uri:
+    raise ValueError("no release URI given (set OSRS_RELEASE_URI or pass --release-uri)")
+
+files = {name: os.environ[var] for name, var in [('app-data', 'APP_DATA_FILE'),
+                                                 ('player-stats', 'PLAYER_STATS_FILE'),
+                                                 ('player-clusterids', 'CLUSTER_IDS_FILE'),
+                                                 ('cluster-centroids', 'CLUSTER_CENTROIDS_FILE'),
+                                                 ('cluster-quartiles', 'CLUSTER_QUARTILES_FILE'),
+                                                 ('cluster-xyz', 'CLUSTER_XYZ_FILE')]}
+manifest_url = f"{args.release_uri.rstrip('/')}/{MANIFEST_NAME}"
+appdata_uri = os.environ.get('OSRS_APPDATA_URI', '')
+if appdata_uri.startswith('s3://') and appdata_uri != manifest_url:
+    print(f"warning: OSRS_APPDATA_URI is {appdata_uri}, which releases no longer update. "
+          f"Apps must set it to {manifest_url} to get the app data and database of new releases.")
+previous = load_manifest(manifest_url, missing_ok=True) or {}
+release = release_name()
+
+# Each release gets its own collection, built in another process while the artifacts upload. The
+# app switches to it along with the app data when the manifest naming both is written.
+collection = previous.get('collection')
+db_load = None
+if not args.skip_db:
+    collection = f"{os.environ['OSRS_MONGO_COLL']}-{release}"
+    print(f"exporting player stats to database collection '{collection}' in the background...")
+    db_load = subprocess.Popen([sys.executable, 'scripts/build_app_db.py',
+                                '--stats-file', files['player-stats'], '--clusterids-file', files['player-clusterids'],
+                                '--mongo-url', os.environ['OSRS_MONGO_URI'], '--collection', collection])
+
+try:
+    manifest = publish_artifacts(files, args.release_uri, num_workers=args.num_workers, release=release,
+                                 write_manifest=False)
+    if db_load is not None and db_load.wait() != 0:
+        sys.exit(f"database export failed, so release {release} was uploaded but not made current")
+except BaseException:
+    if db_load is not None and db_load.poll() is None:
+        db_load.terminate()
+    raise
+if collection is not None:
+    manifest['collection'] = collection
+manifest['history'] = release_history(previous)
+publish_manifest(manifest, args.release_uri)
+
+# Collections of older releases are dropped, keeping the last one for apps that haven't restarted yet.
+# Only collections this script built for a release (as listed in the history) are dropped.
+stale = stale_collections(manifest)
+if stale:
+    db = connect_mongo(os.environ['OSRS_MONGO_URI'])
+    existing = set(db.list_collection_names())
+    for name in stale:
+        if name in existing:
+            print(f"dropping collection '{name}' of an old release")
+            db.drop_collection(name)
+
+print(f"published release {release}")
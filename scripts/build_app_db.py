@@ -5,13 +5,49 @@
 import argparse
 import sys
 
+import numpy as np
 import pandas as pd
 from pymongo.collection import Collection
 from tqdm import tqdm
 
 from src.analysis.appdata import PlayerResults, player_to_mongodoc
-from src.analysis.io import load_pkl
-from src.common import connect_mongo
+from src.analysis.io import load_artifact, parse_memory_size, chunk_rows, open_frame, frame_index
+from src.common import osrs_skills, connect_mongo
+
+STAGING_SUFFIX = '-staging'  # suffix of the collection a new collection is built in
+
+
+def insert_players(players: pd.DataFrame, clusterids: pd.DataFrame, collection: Collection,
+                   batch_size: int, pbar: tqdm):
+    clusterids = clusterids.loc[players.index]
+    splits = list(clusterids.columns)
+    for start in range(0, len(players), batch_size):
+        unames = players.index[start:start + batch_size]
+        # Converting to lists gives plain ints for the database, whatever the stored dtypes.
+        stats = players.iloc[start:start + batch_size].to_numpy().tolist()
+        ids = clusterids.iloc[start:start + batch_size].to_numpy().tolist()
+        batch = [player_to_mongodoc(PlayerResults(username=uname, stats=player_stats,
+                                                  clusterids=dict(zip(splits, player_clusterids))))
+                 for uname, player_stats, player_clusterids in zip(unames, stats, ids)]
+        collection.insert_many(batch)
+        pbar.update(len(batch))
+
+
+def staging_collection(collection: Collection) -> Collection:
+    """ Get an empty collection to build the given one in, so that the one
+    in use stays intact until the new one is complete (see swap_in()). """
+
+    staging = collection.database[f'{collection.name}{STAGING_SUFFIX}']
+    staging.drop()  # left over from a build that failed
+    return staging
+
+
+def swap_in(staging: Collection, collection: Collection):
+    """ Replace a collection with the one built in its place, in one step. """
+
+    if collection.count_documents({}) > 0:
+        print("replacing existing collection")
+    staging.rename(collection.name, dropTarget=True)
 
 
 def main(players: pd.DataFrame,
@@ -19,27 +55,54 @@ def main(players: pd.DataFrame,
          collection: Collection,
          batch_size: int = 5000):
 
-    if collection.count_documents({}) > 0:
-        print("found existing collection, dropping")
-        coll.drop()
-
+    staging = staging_collection(collection)
     with tqdm(total=len(players)) as pbar:
-        def export_batch(docs):
-            collection.insert_many(docs)
-            pbar.update(len(docs))
-
-        batch = []
-        for uname, player_stats in players.iterrows():
-            player_clusterids = clusterids.loc[uname].to_dict()
-            player = PlayerResults(username=uname, stats=list(player_stats), clusterids=player_clusterids)
-            batch.append(player_to_mongodoc(player))
-
-            if len(batch) >= batch_size:
-                export_batch(batch)
-                batch = []
-
-        if batch:
-            export_batch(batch)
+        insert_players(players, clusterids, staging, batch_size, pbar)
+    swap_in(staging, collection)
+
+
+def check_aligned(players_index, clusterids_index, rows: int):
+    """ Check that stats and cluster IDs are stored for the same players in
+    the same order, since the out-of-core export pairs them up by row. """
+
+    if len(players_index) != len(clusterids_index):
+        raise ValueError(f"stats file has {len(players_index)} players but cluster IDs file has "
+                         f"{len(clusterids_index)}; both must come from the same cleaned dataset")
+    for start in range(0, len(players_index), rows):
+        ours = np.asarray(players_index[start:start + rows]).astype(str)
+        theirs = np.asarray(clusterids_index[start:start + rows]).astype(str)
+        if not np.array_equal(ours, theirs):
+            row = start + int(np.flatnonzero(ours != theirs)[0])
+            raise ValueError(f"stats and cluster IDs files are not aligned: row {row} is player "
+                             f"'{ours[row - start]}' in one and '{theirs[row - start]}' in the other")
+
+
+def main_out_of_core(stats_file: str,
+                     clusterids_file: str,
+                     collection: Collection,
+                     memory_budget: int,
+                     batch_size: int = 5000):
+    """ Export players to the database from column files of player stats and
+    cluster IDs, loading a chunk of players at a time. """
+
+    players = open_frame(stats_file)
+    clusterids = open_frame(clusterids_file)
+    players_index, clusterids_index = frame_index(players), frame_index(clusterids)
+    skills = osrs_skills(include_total=True)
+    splits = clusterids.meta['artifact']['columns']
+    nplayers = players.meta['nrows']
+    rows = max(batch_size, chunk_rows(memory_budget, 1024))  # rows are expanded into Python objects
+    check_aligned(players_index, clusterids_index, rows)
+
+    staging = staging_collection(collection)
+    with tqdm(total=nplayers) as pbar:
+        for start in range(0, nplayers, rows):
+            unames = players_index[start:start + rows].astype(object)
+            stats_df = pd.DataFrame({skill: players[skill][start:start + rows] for skill in skills}, index=unames)
+            clusterids_df = pd.DataFrame({split: clusterids[split][start:start + rows] for split in splits},
+                                         index=clusterids_index[start:start + rows].astype(object))
+            insert_players(stats_df, clusterids_df, staging, batch_size, pbar)
+    swap_in(staging, collection)
 
 
 if __name__ == '__main__':
@@ -48,17 +111,27 @@ if __name__ == '__main__':
     parser.add_argument('--clusterids-file', required=True, help="load player cluster IDs from this file")
     parser.add_argument('--mongo-url', required=True, help="use Mongo instance running at this URL")
     parser.add_argument('--collection', required=True, help="export player stats to this collection")
+    parser.add_argument('--memory-budget', default=None, type=parse_memory_size,
+                        help="if set (e.g. '4G'), stream stats and cluster IDs from disk in chunks "
+                             "to stay within this much memory")
     args = parser.parse_args()
 
     print("exporting player stats to database...")
 
-    players_df = load_pkl(args.stats_file)
-    clusterids_df = load_pkl(args.clusterids_file)
     coll = connect_mongo(args.mongo_url, args.collection)
-
-    last_uname = players_df.index[-1]
-    if coll.find_one({'_id': last_uname.lower()}):
+    if args.memory_budget is not None:
+        unames = frame_index(open_frame(args.stats_file))
+        last_uname = str(unames[-1]) if len(unames) else None
+    else:
+        players_df = load_artifact(args.stats_file)
+        clusterids_df = load_artifact(args.clusterids_file)
+        last_uname = players_df.index[-1]
+
+    if last_uname is not None and coll.find_one({'_id': last_uname.lower()}):
         print("database collection is already populated")
         sys.exit(0)
 
-    main(players_df, clusterids_df, coll)
+    if args.memory_budget is not None:
+        main_out_of_core(args.stats_file, args.clusterids_file, coll, args.memory_budget)
+    else:
+        main(players_df, clusterids_df, coll)
@@ -3,62 +3,58 @@
 """ Condense raw stats file from scraping into a clean skills dataset. """
 
 import argparse
-import shlex
-import subprocess
+import os
 
-import numpy as np
 import pandas as pd
-from tqdm import tqdm
-
-from src.common import osrs_skills, csv_api_stats
-from src.analysis.io import dump_pkl
-from src.scrape.export import csv_to_player
-
-
-def main(in_file: str, out_file: str):
-    print("reading raw scrape data...")
-    stdout = subprocess.check_output(shlex.split(f"wc -l {in_file}"))  # count lines in file
-    nlines = int(stdout.decode().strip().split()[0])  # stdout has both line count and filename
-    with open(in_file, 'r') as f:
-        f.readline()  # discard header
-        players = []
-        for line in tqdm(f.readlines(), total=nlines - 1):
-            players.append(csv_to_player(line.strip(), check_len=False))
-
-    # Deduplicate any records with matching usernames by taking the later one.
-    print("deduplicating...")
-    seen = {}  # mapping from usernames to players seen so far
-    for p in tqdm(players):
-        if p.username.lower() not in seen.keys():
-            seen[p.username.lower()] = p
-        else:
-            existing = seen[p.username.lower()]
-            seen[p.username.lower()] = p if p.ts > existing.ts else existing
-
-    players = seen.values()
-
-    # Sort from best to worst and reassign ranks.
+
+from src.common import osrs_skills
+from src.analysis.io import dump_artifact, parse_memory_size
+from src.scrape.clean import read_raw_players, sort_players, dump_full_stats, \
+    merge_full_stats, load_full_stats, full_stats_to_levels, clean_out_of_core
+
+
+def main(in_file: str, out_file: str, num_workers: int = 1, full_stats_file: str = None,
+         quarantine_file: str = None, pack: bool = False):
+    # Records with matching usernames are deduplicated while reading by taking the later one.
+    print(f"reading raw scrape data ({num_workers} workers)...")
+    players = read_raw_players(in_file, num_workers=num_workers, full_stats=full_stats_file is not None,
+                               quarantine_file=quarantine_file)
+
+    # Sort from best to worst. Ranks are implied by row order.
     print("sorting...")
-    players = sorted(players, reverse=True)
-    for n, player in enumerate(players, start=1):
-        player.rank = n
+    players = sort_players(players)
 
-    # Cast to a pandas DataFrame.
-    print("converting to DataFrame...")
     skills = osrs_skills(include_total=True)
-    skill_lvl_inds = np.array([csv_api_stats().index(f'{s}_level') for s in skills])
+    players_df = pd.DataFrame({skill: players[skill].to_numpy() for skill in skills},
+                              index=players['username'].to_numpy())
+
+    dump_artifact(players_df, out_file, index_label='username', pack=pack)
+    print(f"wrote results to {out_file}")
+
+    if full_stats_file is not None:
+        dump_full_stats(players, full_stats_file)
+        print(f"wrote full stats to {full_stats_file}")
+
 
-    unames = []
-    stats = np.zeros((len(players), len(skills)), dtype='int')
-    for i, p in tqdm(enumerate(players), total=len(players)):
-        stats[i, :] = p.stats[skill_lvl_inds]
-        unames.append(p.username)
-    stats[stats == -1] = 0          # missing data
-    stats = stats.astype('uint16')  # save size since all values in range 0-2277
+def merge(delta_file: str, out_file: str, full_stats_file: str, num_workers: int = 1,
+          quarantine_file: str = None, pack: bool = False):
+    """ Merge the records in a partial scrape into an existing cleaned dataset.
+    The full stats file is updated in place (see merge_full_stats()), but
+    the skill levels dataset is written out again in full: its rows are in
+    rank order, which the merged players can change anywhere from the top
+    down, so that part of a merge takes time in proportion to the size of
+    the dataset. """
 
-    players_df = pd.DataFrame(data=stats, index=unames, columns=skills)
+    print(f"reading new scrape data ({num_workers} workers)...")
+    delta = read_raw_players(delta_file, num_workers=num_workers, full_stats=True, quarantine_file=quarantine_file)
 
-    dump_pkl(players_df, out_file)
+    print(f"merging into {full_stats_file}...")
+    counts = merge_full_stats(full_stats_file, delta)
+    print(f"{counts['added']} players added, {counts['replaced']} replaced, {counts['ignored']} older records ignored")
+
+    # Ranks are implied by row order, so the skill levels dataset is written out in full.
+    columns = load_full_stats(full_stats_file, ['username'] + [f'{s}_level' for s in osrs_skills(include_total=True)])
+    dump_artifact(full_stats_to_levels(columns), out_file, index_label='username', pack=pack)
     print(f"wrote results to {out_file}")
 
 
@@ -66,5 +62,30 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Clean up and condense raw stats data.")
     parser.add_argument('--in-file', required=True, help="raw CSV file from scraping process")
     parser.add_argument('--out-file', required=True, help="output cleaned dataset to this file")
+    parser.add_argument('--full-stats-file', default=None, help="if provided, also write all stats to this column file")
+    parser.add_argument('--incremental', action='store_true', help="merge records from the input file into the "
+                                                                   "existing dataset in --full-stats-file")
+    parser.add_argument('--quarantine-file', default=None, help="if provided, write records which fail "
+                                                                "validation to this CSV file")
+    parser.add_argument('--num-workers', default=os.cpu_count(), type=int, help="number of processes for parsing")
+    parser.add_argument('--memory-budget', default=None, type=parse_memory_size,
+                        help="if set (e.g. '4G'), stream data from disk in chunks to stay within this much memory "
+                             "and write the cleaned dataset a chunk at a time")
+    parser.add_argument('--pack-levels', action='store_true',
+                        help="pack skill levels into 7 bits each in the output file to make it smaller")
     args = parser.parse_args()
-    main(args.in_file, args.out_file)
+
+    if args.incremental:
+        if args.full_stats_file is None or not os.path.isfile(args.full_stats_file):
+            raise ValueError("incremental mode requires an existing --full-stats-file to merge into")
+        merge(args.in_file, args.out_file, args.full_stats_file, args.num_workers, args.quarantine_file,
+              args.pack_levels)
+    elif args.memory_budget is not None:
+        if args.pack_levels:
+            raise ValueError("--pack-levels is not supported with --memory-budget")
+        print(f"reading raw scrape data out of core ({args.num_workers} workers)...")
+        clean_out_of_core(args.in_file, args.out_file, args.memory_budget, args.num_workers,
+                          args.full_stats_file, args.quarantine_file)
+    else:
+        main(args.in_file, args.out_file, args.num_workers, args.full_stats_file, args.quarantine_file,
+             args.pack_levels)
@@ -4,62 +4,612 @@
 
 import argparse
 import collections
-from typing import Tuple, List, Dict, OrderedDict
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Tuple, List, Dict, OrderedDict
 
 import numpy as np
 import pandas as pd
+from numpy.typing import NDArray
+from tqdm import tqdm
 
-from src.analysis.io import load_pkl, dump_pkl, load_json
-from src.analysis.models import fit_kmeans, cluster_l2
+from src.analysis.io import load_artifact, dump_artifact, load_json, parse_memory_size, allocate_columns, chunk_rows, \
+    artifact_meta, frame_layout, open_frame, index_columns
+from src.analysis.cache import StageCache, hash_data
+from src.analysis.models import fit_kmeans, fit_minibatch_kmeans, refine_kmeans, kmeans_inertia, cluster_l2, \
+    assignment_mismatch, set_num_threads, assign_clusters, extend_centroids, adjusted_rand_index, ASSIGN_CHECK_ROWS
+
+
+MIN_POINTS_PER_CENTROID = 39  # fewest training points per cluster before faiss warns
+MINIBATCH_ROWS = 65536        # most players per batch in mini-batch k-means
+MINIBATCH_INIT_ITERS = 20     # iterations of full k-means on a sample to initialize mini-batch k-means
+WARM_START_ITERS = 20         # most k-means iterations when refining centroids from a previous run
+WARM_START_TOLERANCE = 0.05   # refit from scratch if a warm start's inertia is worse than the baseline by this fraction
+SWEEP_SAMPLE_ROWS = 100000    # players in each of the two samples clustered by a k sweep
+SWEEP_K_FACTORS = [0.25, 0.5, 1, 2, 4]  # multiples of the configured k tried by a sweep if none are given
+EXACT_ASSIGN = ['flat', 'lut']  # assignment methods that find the nearest cluster, so aren't checked
+
+
+def split_features(stats: NDArray) -> Tuple[NDArray, NDArray]:
+    """ Get the feature vectors and weights used to cluster a set of players. """
+
+    # Player weight is proportional to the number of ranked skills.
+    weights = np.sum(stats != 0, axis=1) / stats.shape[1]
+
+    # Replace missing data, i.e. unranked stats, with 1s. This is
+    # a reasonable substitution for clustering purposes since an
+    # unranked stat is known to be relatively low.
+    stats = stats.copy()
+    stats[stats == 0] = 1
+    return stats, weights
+
+
+def collapse_duplicates(stats: NDArray, weights: NDArray, nclusters: int) -> Tuple[NDArray, NDArray, NDArray]:
+    """ Reduce a set of players to their unique feature vectors, each weighted
+    by the total weight of the players who have it. Weighted k-means has the
+    same objective on these as on every player, but takes time in proportion
+    to the number of unique vectors, which is much smaller for splits where
+    many accounts are identical (e.g. fresh or maxed accounts).
+
+    :param stats: 2D array of feature vectors
+    :param weights: 1D array of weights corresponding to the vectors
+    :param nclusters: number of clusters to be fit, which there must be at least as
+                      many unique vectors as (otherwise the players are returned as they are)
+    :return: unique vectors, their weights, and the row of each player's vector among them (or None)
+    """
+    stats = np.ascontiguousarray(stats)
+    rows = stats.view(np.dtype((np.void, stats.dtype.itemsize * stats.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    if len(first) < nclusters:
+        return stats, weights, None
+
+    # Unique vectors are put in order of first appearance, which unlike the order of their bytes is
+    # the same for any dtype, so that k-means is initialized the same way from float32 or float64 stats.
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    inverse = rank[inverse.ravel()]
+    return stats[first[order]], np.bincount(inverse, weights=weights, minlength=len(first)), inverse
+
+
+def sort_centroids(centroids: NDArray) -> NDArray:
+    """ Sort clusters by total level descending. """
+
+    total_levels = np.sum(centroids, axis=1)
+    sort_inds = np.argsort(total_levels)[::-1]
+    return centroids[sort_inds]
+
+
+def warm_start(prev_centroids: Dict[str, pd.DataFrame], split: str, skills: List[str], nclusters: int,
+               tolerance: float = WARM_START_TOLERANCE) -> Tuple[NDArray, float, float]:
+    """ Get the centroids of a split from a previous run to start clustering
+    from, and the highest inertia at which a refinement of them is kept.
+    The limit is set from the baseline inertia: that of the last fit from
+    scratch, which warm-started runs carry forward, so that a chain of warm
+    starts can't drift ever further from a good fit.
+
+    :param prev_centroids: centroids for each split from a previous run, as written by this script
+    :param split: name of the split
+    :param skills: skills in the split
+    :param nclusters: number of clusters in the split
+    :param tolerance: fraction by which the inertia may exceed the baseline
+    :return: initial centroids, the inertia limit and the baseline inertia, or
+             Nones if the previous run's centroids can't be used for this split
+    """
+    prev = (prev_centroids or {}).get(split)
+    if prev is None:
+        return None, None, None
+    if list(prev.columns) != list(skills) or len(prev) != nclusters:
+        print(f"previous centroids for split '{split}' have different skills or k, fitting from scratch")
+        return None, None, None
+    if 'inertia' not in prev.attrs:
+        print(f"previous centroids for split '{split}' have no recorded inertia, fitting from scratch")
+        return None, None, None
+    baseline = prev.attrs.get('baseline_inertia', prev.attrs['inertia'])
+    return np.array(prev.to_numpy(), dtype='float32'), baseline * (1 + tolerance), baseline
+
+
+def fit_centroids(stats: NDArray, weights: NDArray, nclusters: int, verbose: bool = True,
+                  init: NDArray = None, max_inertia: float = None) -> Tuple[NDArray, float, bool]:
+    """ Fit centroids to a set of players, sorted by total level descending.
+    Given initial centroids (e.g. those of the previous release), they are
+    refined by a short k-means run instead, and only if that ends with an
+    inertia above max_inertia are the centroids fit from scratch.
+
+    :return: centroids, their inertia (weighted mean squared distance of players to their
+             nearest centroid), and whether they were refined from the initial centroids
+    """
+    if init is not None:
+        centroids, inertia = refine_kmeans(stats, weights, init, max_iter=WARM_START_ITERS, verbose=verbose)
+        if inertia <= max_inertia:
+            return sort_centroids(centroids), inertia, True
+        print(f"warm start reached inertia {inertia:.4g}, above the limit of {max_inertia:.4g}, fitting from scratch")
+    centroids = fit_kmeans(stats, k=nclusters, w=weights, verbose=verbose)
+    return sort_centroids(centroids), kmeans_inertia(stats, weights, centroids), False
+
+
+def centroids_frame(centroids: NDArray, skills: List[str], inertia: float, baseline: float = None) -> pd.DataFrame:
+    """ Centroids of a split as a DataFrame, with their inertia kept in its attrs (and in the artifact),
+    along with the baseline inertia for warm starts (see warm_start()), which is their own inertia
+    unless they were warm-started. """
+
+    frame = pd.DataFrame(centroids, index=range(len(centroids)), columns=skills)
+    frame.attrs['inertia'] = float(inertia)
+    frame.attrs['baseline_inertia'] = float(inertia if baseline is None else baseline)
+    return frame
+
+
+def report_mismatch(split: str, nwrong: int, nchecked: int):
+    """ Report how many of the players checked after approximate assignment didn't get their nearest cluster. """
+
+    print(f"approximate assignment for split '{split}': {nwrong} of {nchecked} players checked "
+          f"({nwrong / max(1, nchecked):.3%}) were not assigned their nearest cluster")
+
+
+def cluster_split(stats: NDArray, skills: List[str], nclusters: int, verbose: bool = True,
+                  init: NDArray = None, max_inertia: float = None, baseline: float = None,
+                  assign_index: str = 'flat', assign_effort: int = None, split: str = None) -> OrderedDict[str, Any]:
+    """ Fit centroids for one split of the dataset and assign each player to
+    a cluster. If players are assigned with an approximate index, a sample
+    of them is checked against exact assignment and the mismatches reported. """
+
+    features, weights = split_features(stats)
+    points, point_weights, inverse = collapse_duplicates(features, weights, nclusters)
+    centroids, inertia, warm = fit_centroids(points, point_weights, nclusters, verbose, init, max_inertia)
+    if assign_index == 'lut':
+        # Lookup tables read the levels as they are stored (e.g. uint8), one player's standing in for each point.
+        levels = stats
+        if inverse is not None:
+            levels = np.empty((len(points), stats.shape[1]), dtype=stats.dtype)
+            levels[inverse] = stats
+        clusterids = cluster_l2(levels, centroids, 'lut')
+    else:
+        clusterids = cluster_l2(points, centroids, assign_index, assign_effort)
+    if inverse is not None:
+        clusterids = clusterids[inverse]
+    if assign_index not in EXACT_ASSIGN:
+        report_mismatch(split, *assignment_mismatch(features, centroids, clusterids))
+    return collections.OrderedDict([
+        ('centroids', centroids_frame(centroids, skills, inertia, baseline if warm else None)),
+        ('clusterids', clusterids)
+    ])
+
+
+def _init_worker(nthreads: int):
+    set_num_threads(nthreads)
+
+
+def _cluster_split_shared(split: str, stats_name: str, shape: Tuple[int, int], cols: List[int], skills: List[str],
+                          nclusters: int, out_name: str, out_col: int, nsplits: int, verbose: bool,
+                          init: NDArray = None, max_inertia: float = None, baseline: float = None,
+                          assign_index: str = 'flat', assign_effort: int = None) -> pd.DataFrame:
+    # Runs in a worker process on the player matrix shared by the parent. Spawned workers share
+    # the parent's resource tracker, so attaching does not make them clean up the blocks on exit.
+    stats_shm, out_shm = SharedMemory(name=stats_name), SharedMemory(name=out_name)
+    try:
+        stats = np.ndarray(shape, dtype='float32', buffer=stats_shm.buf)
+        print(f"clustering split '{split}' with k = {nclusters}...")
+        result = cluster_split(stats[:, cols], skills, nclusters, verbose,  # copies only this split's columns
+                               init, max_inertia, baseline, assign_index, assign_effort, split)
+        clusterids = np.ndarray((shape[0], nsplits), dtype='int64', buffer=out_shm.buf)
+        clusterids[:, out_col] = result['clusterids']
+        del stats, clusterids  # release views of the shared buffers so they can be closed
+        return result['centroids']
+    finally:
+        stats_shm.close()
+        out_shm.close()
+
+
+def cluster_parallel(players: pd.DataFrame, splits: OrderedDict[str, List[str]], k_per_split: Dict[str, int],
+                     num_workers: int, verbose: bool = True,
+                     warm_starts: Dict[str, Tuple[NDArray, float, float]] = None, assign_index: str = 'flat',
+                     assign_effort: int = None) -> Tuple[NDArray, Dict[str, pd.DataFrame]]:
+    """ Cluster several splits of the dataset at once in worker processes.
+    The stats for every skill used by any split are put in shared memory
+    once, and each worker takes only its split's columns from there and
+    writes cluster IDs straight into a shared output array. The CPU threads
+    used by faiss are divided between the workers.
+
+    :param warm_starts: initial centroids, inertia limit and baseline inertia for each split (see warm_start())
+    :param assign_index: kind of index used to assign players to clusters (see cluster_l2())
+    :param assign_effort: search effort of an approximate index
+    :return: array of cluster IDs with a column per split, and centroids for each split
+    """
+    nplayers = len(players)
+    all_skills = [skill for skill in players.columns if any(skill in skills for skills in splits.values())]
+    nthreads = max(1, (os.cpu_count() or 1) // num_workers)
+    stats_shm = SharedMemory(create=True, size=max(1, 4 * nplayers * len(all_skills)))
+    out_shm = SharedMemory(create=True, size=max(1, 8 * nplayers * len(splits)))
+    try:
+        stats = np.ndarray((nplayers, len(all_skills)), dtype='float32', buffer=stats_shm.buf)
+        for j, skill in enumerate(all_skills):
+            stats[:, j] = players[skill].to_numpy()
+
+        # Workers are spawned rather than forked, since forking after faiss has started threads can deadlock.
+        # Splits that take longest are started first so that the last one to finish starts as early as possible.
+        order = sorted(splits.keys(), key=lambda split: -len(splits[split]) * k_per_split[split])
+        print(f"clustering {len(splits)} splits with {num_workers} workers ({nthreads} threads each)...")
+        with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(nthreads,)) as executor:
+            futures = {split: executor.submit(_cluster_split_shared, split, stats_shm.name, stats.shape,
+                                              [all_skills.index(skill) for skill in splits[split]], splits[split],
+                                              k_per_split[split], out_shm.name, list(splits.keys()).index(split),
+                                              len(splits), verbose, *(warm_starts or {}).get(split, (None, None, None)),
+                                              assign_index, assign_effort)
+                       for split in order}
+            centroids = {split: futures[split].result() for split in splits.keys()}
+        clusterids = np.ndarray((nplayers, len(splits)), dtype='int64', buffer=out_shm.buf).copy()
+        del stats
+    finally:
+        for shm in [stats_shm, out_shm]:
+            shm.close()
+            shm.unlink()
+    return clusterids, centroids
 
 
 def main(players: pd.DataFrame,
          splits: OrderedDict[str, List[str]],
          k_per_split: OrderedDict[str, int],
-         verbose: bool = True) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame]:
+         verbose: bool = True,
+         cache: StageCache = None,
+         num_workers: int = 1,
+         prev_centroids: Dict[str, pd.DataFrame] = None,
+         warm_start_tolerance: float = WARM_START_TOLERANCE,
+         assign_index: str = 'flat',
+         assign_effort: int = None) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame]:
 
     unames = players.index
     centroids_per_split = collections.OrderedDict()
     clusterids = np.zeros((len(players), len(splits)), dtype='int')
 
+    # Splits with cached results are skipped, and the rest are clustered in parallel if there are workers for it.
+    warm_starts = {split: warm_start(prev_centroids, split, skills, k_per_split[split], warm_start_tolerance)
+                   for split, skills in splits.items()}
+    todo = collections.OrderedDict()
     for i, (split, skills) in enumerate(splits.items()):
         nclusters = k_per_split[split]
-        print(f"clustering split '{split}' with k = {nclusters}...")
         stats = players[skills]  # take a subset of skills as features
-        stats = stats.to_numpy()
-
-        # Player weight is proportional to the number of ranked skills.
-        weights = np.sum(stats != 0, axis=1) / stats.shape[1]
+        # Results fitted from scratch with exact assignment keep their keys when other options are added.
+        assign_params = [] if assign_index == 'flat' else [assign_index, assign_effort]
+        init_params = [] if warm_starts[split][0] is None else list(warm_starts[split])
+        key = cache.key(stats, nclusters, *assign_params, *init_params) if cache is not None else None
+        result = cache.load(key) if cache is not None else None
+        if result is not None:
+            print(f"using cached result for split '{split}'")
+            clusterids[:, i] = result['clusterids']
+            centroids_per_split[split] = result['centroids']
+        else:
+            todo[split] = key
 
-        # Replace missing data, i.e. unranked stats, with 1s. This is
-        # a reasonable substitution for clustering purposes since an
-        # unranked stat is known to be relatively low.
-        stats[stats == 0] = 1
-        centroids = fit_kmeans(stats, k=nclusters, w=weights, verbose=verbose)
+    if num_workers > 1 and len(todo) > 1:
+        todo_splits = collections.OrderedDict((split, splits[split]) for split in todo)
+        split_clusterids, split_centroids = cluster_parallel(players, todo_splits, k_per_split,
+                                                             min(num_workers, len(todo)), verbose, warm_starts,
+                                                             assign_index, assign_effort)
+        results = {split: collections.OrderedDict([('centroids', split_centroids[split]),
+                                                   ('clusterids', split_clusterids[:, j])])
+                   for j, split in enumerate(todo)}
+    else:
+        results = {}
+        for split in todo:
+            print(f"clustering split '{split}' with k = {k_per_split[split]}...")
+            results[split] = cluster_split(players[splits[split]].to_numpy(), splits[split], k_per_split[split],
+                                           verbose, *warm_starts[split], assign_index, assign_effort, split)
 
-        # Sort clusters by total level descending.
-        total_levels = np.sum(centroids, axis=1)
-        sort_inds = np.argsort(total_levels)[::-1]
-        centroids = centroids[sort_inds]
-
-        clusterids[:, i] = cluster_l2(stats, centroids)
-        centroids = pd.DataFrame(centroids, index=range(nclusters), columns=skills)
-        centroids_per_split[split] = centroids
+    for split, key in todo.items():
+        if cache is not None:
+            cache.dump(key, results[split])
+        clusterids[:, list(splits.keys()).index(split)] = results[split]['clusterids']
+        centroids_per_split[split] = results[split]['centroids']
+    centroids_per_split = collections.OrderedDict((split, centroids_per_split[split]) for split in splits)
 
     clusterids = pd.DataFrame(clusterids, index=unames, columns=splits.keys())
 
     return clusterids, centroids_per_split
 
 
+def main_out_of_core(stats_file: str,
+                     splits: OrderedDict[str, List[str]],
+                     k_per_split: OrderedDict[str, int],
+                     out_clusterids: str,
+                     memory_budget: int,
+                     verbose: bool = True,
+                     minibatch: bool = False,
+                     prev_centroids: Dict[str, pd.DataFrame] = None,
+                     warm_start_tolerance: float = WARM_START_TOLERANCE,
+                     assign_index: str = 'flat',
+                     assign_effort: int = None) -> Dict[str, pd.DataFrame]:
+    """ Cluster players from a column file of stats without loading the whole
+    dataset. Centroids are fit to a random sample of as many players as the
+    memory budget allows, then every player is assigned to its nearest
+    centroid a chunk at a time and the cluster IDs are written to a column
+    file as they are computed. In mini-batch mode, centroids fit to a small
+    sample are instead refined with mini-batch k-means on every player,
+    streaming batches from the file until the fit converges. Either way,
+    centroids from a previous run are refined rather than fit from scratch
+    if they are given.
+
+    :param stats_file: column file with a username column and a column per skill
+    :param splits: skills in each split of the dataset
+    :param k_per_split: number of clusters for each split
+    :param out_clusterids: write cluster IDs to this column file
+    :param memory_budget: approximate number of bytes of memory to work within
+    :param verbose: whether to print info after each training iteration
+    :param minibatch: whether to fit centroids with mini-batch k-means
+    :param prev_centroids: centroids for each split from a previous run to start from
+    :param warm_start_tolerance: fraction by which the inertia of a warm start may exceed
+                                 the baseline (see warm_start()) before centroids are fit from scratch
+    :param assign_index: kind of index used to assign players to clusters, 'flat' (exact), 'hnsw' or 'ivf',
+                         or 'lut' for lookup tables (see cluster_l2())
+    :param assign_effort: search effort of an approximate index
+    :return: cluster centroids for each split
+    """
+    players = open_frame(stats_file)
+    index = players.meta['artifact']
+    nplayers = index['nrows']
+
+    # The cluster IDs are indexed by the same usernames, stored the same way.
+    index_cols = index_columns(players)
+    layout = collections.OrderedDict((name, (values.dtype, values.shape)) for name, values in index_cols.items())
+    layout.update((split, ('int64', (nplayers,))) for split in splits.keys())
+    meta = artifact_meta(frame_layout(list(splits.keys()), nplayers, index=index['index'],
+                                      index_format=index.get('index_format')))
+    clusterids = allocate_columns(layout, out_clusterids, meta=meta)
+    for name, values in index_cols.items():
+        if not values.size:
+            continue
+        out = clusterids.memmap(name, 'r+')
+        rows = chunk_rows(memory_budget, values.dtype.itemsize)
+        for start in range(0, len(values), rows):
+            out[start:start + rows] = values[start:start + rows]
+        out.flush()
+
+    rng = np.random.default_rng(0)
+    centroids_per_split = collections.OrderedDict()
+    for split, skills in splits.items():
+        nclusters = k_per_split[split]
+        row_bytes = 8 * len(skills) + 16  # features, their float32 copy, and nearest centroid
+        rows = chunk_rows(memory_budget, row_bytes)
+        if minibatch:
+            rows = min(rows, MINIBATCH_ROWS)
+        nsample = min(nplayers, max(rows, nclusters * MIN_POINTS_PER_CENTROID))
+
+        print(f"sampling {nsample} players for split '{split}'...")
+        sample = []
+        for start in tqdm(range(0, nplayers, rows)):
+            end = min(start + rows, nplayers)
+            if nsample < nplayers:
+                inds = start + np.flatnonzero(rng.random(end - start) < nsample / nplayers)
+            else:
+                inds = np.arange(start, end)
+            sample.append(np.stack([players[skill][inds] for skill in skills], axis=1))
+        stats, weights = split_features(np.concatenate(sample))
+        init, max_inertia, baseline = warm_start(prev_centroids, split, skills, nclusters, warm_start_tolerance)
+
+        if minibatch:
+            warm = init is not None
+            if init is None:
+                print(f"initializing split '{split}' with k = {nclusters}...")
+                init = fit_kmeans(stats, nclusters, weights, verbose, niter=MINIBATCH_INIT_ITERS, nredo=1)
+
+            def batches():
+                # Chunks are visited in a random order since players are stored sorted by total level.
+                for start in tqdm(rng.permutation(np.arange(0, nplayers, rows))):
+                    chunk = np.stack([players[skill][start:start + rows] for skill in skills], axis=1)
+                    yield split_features(chunk)
+
+            def sample_weights(init):
+                # The initial centroids carry the weight of the sample players nearest to them.
+                return np.bincount(assign_clusters(stats, init)[0], weights=weights, minlength=nclusters)
+
+            print(f"clustering split '{split}' in mini-batches of {rows} players...")
+            centroids, inertia = fit_minibatch_kmeans(batches, init, sample_weights(init), verbose=verbose)
+            if max_inertia is not None and inertia > max_inertia:
+                print(f"warm start reached inertia {inertia:.4g}, above the limit of {max_inertia:.4g}, "
+                      f"fitting from scratch")
+                init = fit_kmeans(stats, nclusters, weights, verbose, niter=MINIBATCH_INIT_ITERS, nredo=1)
+                centroids, inertia = fit_minibatch_kmeans(batches, init, sample_weights(init), verbose=verbose)
+                warm = False
+            centroids = sort_centroids(centroids)
+        else:
+            print(f"clustering split '{split}' with k = {nclusters}...")
+            stats, weights, _ = collapse_duplicates(stats, weights, nclusters)
+            centroids, inertia, warm = fit_centroids(stats, weights, nclusters, verbose, init, max_inertia)
+        del stats, weights, sample
+
+        print(f"assigning players to clusters for split '{split}'...")
+        out = clusterids.memmap(split, 'r+')
+        nwrong, nchecked = 0, 0
+        for start in tqdm(range(0, nplayers, rows)):
+            chunk = np.stack([players[skill][start:start + rows] for skill in skills], axis=1)
+            if assign_index == 'lut':
+                chunk_ids = cluster_l2(chunk, centroids, 'lut')  # the stored levels are used as they are
+            else:
+                stats, _ = split_features(chunk)
+                chunk_ids = cluster_l2(stats, centroids, assign_index, assign_effort)
+            out[start:start + rows] = chunk_ids
+            if assign_index not in EXACT_ASSIGN:
+                # Every chunk contributes its share of the players checked.
+                nsample = -(-ASSIGN_CHECK_ROWS * len(chunk) // nplayers)
+                chunk_wrong, chunk_checked = assignment_mismatch(stats, centroids, chunk_ids, nsample, seed=start)
+                nwrong, nchecked = nwrong + chunk_wrong, nchecked + chunk_checked
+        if nplayers:
+            out.flush()
+        del out
+        if assign_index not in EXACT_ASSIGN:
+            report_mismatch(split, nwrong, nchecked)
+
+        centroids_per_split[split] = centroids_frame(centroids, skills, inertia, baseline if warm else None)
+
+    return centroids_per_split
+
+
+def _sweep_chain(points: NDArray, weights: NDArray, skills: List[str], ks: List[int], cache_dir: str,
+                 seed: int, verbose: bool) -> List[pd.DataFrame]:
+    # Fits centroids for increasing values of k, each starting from the fit for the k before it
+    # plus centroids seeded k-means++ style. Results are cached per k, keyed by the sample and
+    # every k up to it, since each fit depends on those before it.
+    cache = StageCache(cache_dir, 'cluster_sweep') if cache_dir else None
+    sample_hash = hash_data(points, weights) if cache is not None else None
+    results, centroids = [], None
+    for i, k in enumerate(ks):
+        key = cache.key(sample_hash, ks[:i + 1], seed) if cache is not None else None
+        result = cache.load(key) if cache is not None else None
+        if result is None:
+            print(f"fitting k = {k}...")
+            if centroids is None:
+                centroids = fit_kmeans(points, k, weights, verbose, nredo=1)
+                inertia = kmeans_inertia(points, weights, centroids)
+            else:
+                init = extend_centroids(points, weights, centroids, k, seed=seed + i)
+                centroids, inertia = refine_kmeans(points, weights, init, max_iter=WARM_START_ITERS, verbose=verbose)
+            result = centroids_frame(sort_centroids(centroids), skills, inertia)
+            if cache is not None:
+                cache.dump(key, result)
+        centroids = np.array(result.to_numpy(), dtype='float32')
+        results.append(result)
+    return results
+
+
+def sweep_k(players: pd.DataFrame, splits: OrderedDict[str, List[str]], ks_per_split: Dict[str, List[int]],
+            nsample: int = SWEEP_SAMPLE_ROWS, num_workers: int = 1, cache_dir: str = None,
+            verbose: bool = False) -> Dict[str, List[Dict[str, Any]]]:
+    """ Evaluate several numbers of clusters for each split, to help choose k.
+    Two disjoint random samples of players are clustered for every k, and
+    the fits are compared on the first sample. The chain of fits for each
+    sample and split runs in its own worker process, with each k started
+    from the fit for the k before it, so a sweep costs little more than one
+    full fit. Fits are cached per split and k, so adding values of k to a
+    sweep only fits the new ones.
+
+    :param players: player stats, which may be memory-mapped (only the sampled rows are read)
+    :param splits: skills in each split of the dataset
+    :param ks_per_split: numbers of clusters to try for each split
+    :param nsample: number of players in each sample
+    :param num_workers: number of processes fitting at once
+    :param cache_dir: if provided, reuse fits for samples and values of k that were seen before
+    :param verbose: whether to print info after each training iteration
+    :return: for each split, a list with an entry for each k giving its inertia (weighted mean squared
+             distance of players to their nearest centroid), the distribution of cluster sizes as
+             fractions of players, and its stability, the adjusted Rand index between the clusterings
+             of the two samples' fits (1 if they group players identically, about 0 if unrelated)
+    """
+    rng = np.random.default_rng(0)
+    samples = {}
+    for split, skills in splits.items():
+        ks = sorted(set(ks_per_split[split]))
+        rows = rng.permutation(len(players))[:2 * nsample]
+        halves = [np.sort(rows[:len(rows) // 2]), np.sort(rows[len(rows) // 2:])]
+        features = [split_features(np.stack([players[skill].to_numpy()[half] for skill in skills], axis=1))
+                    for half in halves]
+        # Samples are always collapsed to their unique points, which bound the number of clusters that can be fit.
+        points = [collapse_duplicates(x, w, 1) for x, w in features]
+        too_many = [k for k in ks if k > len(points[0][0]) or k > len(points[1][0])]
+        if too_many:
+            print(f"skipping k = {too_many} for split '{split}', which exceed the number of distinct players sampled")
+        samples[split] = (features[0][0], points, [k for k in ks if k not in too_many])
+
+    tasks = [(split, i) for split in splits for i in range(2) if samples[split][2]]
+    args = {(split, i): (samples[split][1][i][0], samples[split][1][i][1], splits[split], samples[split][2],
+                         cache_dir, i, verbose) for split, i in tasks}
+    print(f"sweeping k for {len(splits)} splits on samples of {nsample} players...")
+    if num_workers > 1 and len(tasks) > 1:
+        nworkers = min(num_workers, len(tasks))
+        nthreads = max(1, (os.cpu_count() or 1) // nworkers)
+        with ProcessPoolExecutor(nworkers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(nthreads,)) as executor:
+            futures = {task: executor.submit(_sweep_chain, *args[task]) for task in tasks}
+            fits = {task: future.result() for task, future in futures.items()}
+    else:
+        fits = {task: _sweep_chain(*args[task]) for task in tasks}
+
+    report = collections.OrderedDict()
+    for split in splits:
+        x, _, ks = samples[split]
+        report[split] = []
+        for j, k in enumerate(ks):
+            ids = [assign_clusters(x, fits[(split, i)][j].to_numpy())[0] for i in range(2)]
+            sizes = np.bincount(ids[0], minlength=k) / len(x)
+            report[split].append(collections.OrderedDict([
+                ('k', k),
+                ('inertia', fits[(split, 0)][j].attrs['inertia']),
+                ('sizes', collections.OrderedDict(zip(['min', 'p25', 'median', 'p75', 'max'],
+                                                      np.percentile(sizes, [0, 25, 50, 75, 100]).tolist()))),
+                ('empty', int(np.sum(sizes == 0))),
+                ('stability', adjusted_rand_index(ids[0], ids[1]))
+            ]))
+    return report
+
+
+def print_sweep(report: Dict[str, List[Dict[str, Any]]]):
+    """ Print the results of a k sweep as a table per split. """
+
+    for split, entries in report.items():
+        print(f"\nsplit '{split}'")
+        print(f"{'k':>7}{'inertia':>12}{'smallest':>10}{'median':>10}{'largest':>10}{'empty':>7}{'stability':>11}")
+        for entry in entries:
+            sizes = entry['sizes']
+            print(f"{entry['k']:>7}{entry['inertia']:>12.2f}{sizes['min']:>10.3%}{sizes['median']:>10.3%}"
+                  f"{sizes['max']:>10.3%}{entry['empty']:>7}{entry['stability']:>11.3f}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Cluster players according to account similarity.")
-    parser.add_argument('--in-file', required=True, type=str, help="load player stats from this file")
-    parser.add_argument('--out-clusterids', required=True, type=str, help="write cluster IDs to this file")
-    parser.add_argument('--out-centroids', required=True, type=str, help="write cluster centroids to this file")
-    parser.add_argument('--params-file', required=True, type=str, help="load clustering parameters from this file")
-    parser.add_argument('--splits-file', required=True, type=str, help="load skills in each split from this file")
-    parser.add_argument('--verbose', action='store_true', help="if set, output progress during training")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fit = subparsers.add_parser('fit', help="cluster players with the k for each split in the params file")
+    fit.add_argument('--in-file', required=True, type=str, help="load player stats from this file")
+    fit.add_argument('--out-clusterids', required=True, type=str, help="write cluster IDs to this file")
+    fit.add_argument('--out-centroids', required=True, type=str, help="write cluster centroids to this file")
+    fit.add_argument('--params-file', required=True, type=str, help="load clustering parameters from this file")
+    fit.add_argument('--splits-file', required=True, type=str, help="load skills in each split from this file")
+    fit.add_argument('--verbose', action='store_true', help="if set, output progress during training")
+    fit.add_argument('--cache-dir', default=None, type=str, help="if provided, reuse results for splits whose "
+                                                                 "data and parameters are unchanged")
+    fit.add_argument('--memory-budget', default=None, type=parse_memory_size,
+                     help="if set (e.g. '4G'), stream stats from a column file in chunks to stay within "
+                          "this much memory and write cluster IDs a chunk at a time")
+    fit.add_argument('--num-workers', default=os.cpu_count(), type=int,
+                     help="number of processes clustering splits at once (CPU threads are divided between them)")
+    fit.add_argument('--minibatch', action='store_true',
+                     help="with --memory-budget, fit centroids with mini-batch k-means over every player "
+                          "instead of full k-means over a sample")
+    fit.add_argument('--init-centroids', default=None, type=str,
+                     help="if provided, refine the centroids in this file (e.g. from the last release) "
+                          "instead of fitting them from scratch")
+    fit.add_argument('--warm-start-tolerance', default=WARM_START_TOLERANCE, type=float,
+                     help="fit centroids from scratch if refining those from --init-centroids gives an "
+                          "inertia worse than that of the last fit from scratch by more than this fraction")
+    fit.add_argument('--assign-index', default='flat', choices=['flat', 'hnsw', 'ivf', 'lut'],
+                     help="index used to assign players to their nearest cluster: exact ('flat'), "
+                          "approximate and faster for large k ('hnsw' or 'ivf'), in which case the fraction "
+                          "of a sample of players not assigned their nearest cluster is reported, or "
+                          "exact lookup tables over levels, faster for small k ('lut', best with numba)")
+    fit.add_argument('--assign-effort', default=None, type=int,
+                     help="search effort of an approximate index, higher for fewer mismatches "
+                          "(HNSW efSearch or IVF nprobe)")
+
+    sweep = subparsers.add_parser('sweep', help="compare several values of k for each split on samples of players")
+    sweep.add_argument('--in-file', required=True, type=str, help="load player stats from this file")
+    sweep.add_argument('--params-file', required=True, type=str, help="load clustering parameters from this file")
+    sweep.add_argument('--splits-file', required=True, type=str, help="load skills in each split from this file")
+    sweep.add_argument('--k', default=None, type=int, nargs='+',
+                       help="values of k to try for every split (default is multiples of each split's k "
+                            f"in the params file: {', '.join(str(f) for f in SWEEP_K_FACTORS)})")
+    sweep.add_argument('--nsample', default=SWEEP_SAMPLE_ROWS, type=int,
+                       help="number of players in each of the two samples clustered")
+    sweep.add_argument('--num-workers', default=os.cpu_count(), type=int,
+                       help="number of processes fitting at once (CPU threads are divided between them)")
+    sweep.add_argument('--cache-dir', default=None, type=str,
+                       help="if provided, reuse fits for values of k tried before on the same data")
+    sweep.add_argument('--out-file', default=None, type=str, help="if provided, write the results to this JSON file")
+    sweep.add_argument('--verbose', action='store_true', help="if set, output progress during training")
     args = parser.parse_args()
+    if args.command == 'fit' and args.minibatch and args.memory_budget is None:
+        raise ValueError("--minibatch streams data from disk, so it needs --memory-budget")
 
     splits = load_json(args.splits_file)
     k_per_split = {split: params['k'] for split, params in load_json(args.params_file).items()}
@@ -67,13 +617,48 @@ if __name__ == "__main__":
         if split not in k_per_split:
             raise ValueError(f"params file is missing k parameter for split '{split}'")
 
-    players_df = load_pkl(args.in_file)
-    clusterids_df, centroids_dict = main(players_df,
-                                         k_per_split=k_per_split,
-                                         splits=load_json(args.splits_file),
-                                         verbose=args.verbose)
-
-    dump_pkl(clusterids_df, args.out_clusterids)
-    print(f"wrote player cluster IDs to {args.out_clusterids}")
-    dump_pkl(centroids_dict, args.out_centroids)
-    print(f"wrote cluster centroids to {args.out_clusterids}")
+    if args.command == 'sweep':
+        ks_per_split = {split: args.k or [max(2, round(k_per_split[split] * f)) for f in SWEEP_K_FACTORS]
+                        for split in splits}
+        report = sweep_k(load_artifact(args.in_file, index=False), splits, ks_per_split, nsample=args.nsample,
+                         num_workers=args.num_workers, cache_dir=args.cache_dir, verbose=args.verbose)
+        print_sweep(report)
+        if args.out_file is not None:
+            with open(args.out_file, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"wrote sweep results to {args.out_file}")
+    else:
+        cache = StageCache(args.cache_dir, 'cluster_players') if args.cache_dir else None
+        prev_centroids = None
+        if args.init_centroids is not None and os.path.isfile(args.init_centroids):
+            # Copied into memory, since the file may be the one that is about to be overwritten.
+            prev_centroids = {split: centroids.copy(deep=True)
+                              for split, centroids in load_artifact(args.init_centroids).items()}
+        if args.memory_budget is not None:
+            centroids_dict = main_out_of_core(args.in_file,
+                                              k_per_split=k_per_split,
+                                              splits=splits,
+                                              out_clusterids=args.out_clusterids,
+                                              memory_budget=args.memory_budget,
+                                              verbose=args.verbose,
+                                              minibatch=args.minibatch,
+                                              prev_centroids=prev_centroids,
+                                              warm_start_tolerance=args.warm_start_tolerance,
+                                              assign_index=args.assign_index,
+                                              assign_effort=args.assign_effort)
+        else:
+            players_df = load_artifact(args.in_file)
+            clusterids_df, centroids_dict = main(players_df,
+                                                 k_per_split=k_per_split,
+                                                 splits=splits,
+                                                 verbose=args.verbose,
+                                                 cache=cache,
+                                                 num_workers=args.num_workers,
+                                                 prev_centroids=prev_centroids,
+                                                 warm_start_tolerance=args.warm_start_tolerance,
+                                                 assign_index=args.assign_index,
+                                                 assign_effort=args.assign_effort)
+            dump_artifact(clusterids_df, args.out_clusterids, index_label='username')
+        print(f"wrote player cluster IDs to {args.out_clusterids}")
+        dump_artifact(centroids_dict, args.out_centroids)
+        print(f"wrote cluster centroids to {args.out_centroids}")
@@ -8,38 +8,81 @@ from typing import List, OrderedDict
 import numpy as np
 import pandas as pd
 import xarray as xr
+from numpy.typing import NDArray
 from tqdm import tqdm
 
-from src.analysis.models import compute_stat_quartiles
-from src.analysis.io import load_pkl, dump_pkl, load_json
+from src.analysis.cache import StageCache, cached
+from src.analysis.models import compute_stat_quartiles, quartiles_from_counts
+from src.analysis.io import load_artifact, dump_artifact, load_json, parse_memory_size, chunk_rows, open_frame
+
+
+def quartiles_to_xarray(split_quartiles: NDArray, skills: List[str]) -> xr.DataArray:
+    return xr.DataArray(
+        split_quartiles,
+        dims=["percentile", "clusterid", "skill"],
+        coords={
+            "percentile": [0, 25, 50, 75, 100],
+            "clusterid": range(split_quartiles.shape[1]),
+            "skill": skills
+        })
 
 
 def main(players: pd.DataFrame, clusterids: pd.DataFrame,
-         splits: OrderedDict[str, List[str]]) -> OrderedDict[str, xr.DataArray]:
+         splits: OrderedDict[str, List[str]], cache: StageCache = None) -> OrderedDict[str, xr.DataArray]:
 
     quartiles = {}
     for split, skills in splits.items():
         skills = ['total'] + skills  # include total level when computing quartiles for each split
-        split_stats = players[skills].to_numpy()
+        split_stats = players[skills]
         split_clusterids = clusterids[split].to_numpy()
-        nclusters = max(split_clusterids) + 1
+
+        def split_quartiles():
+            print(f"computing quartiles for split '{split}'...")
+            stats = split_stats.to_numpy()
+            nclusters = max(split_clusterids) + 1
+            result = np.zeros((5, nclusters, len(skills)))
+            for i in tqdm(range(nclusters)):
+                this_cluster_inds = split_clusterids == i
+                this_cluster_stats = stats[this_cluster_inds]
+                result[:, i, :] = compute_stat_quartiles(this_cluster_stats)
+            return quartiles_to_xarray(result, skills)
+
+        quartiles[split] = cached(cache, f"split '{split}'", split_quartiles, split_stats, split_clusterids)
+
+    return quartiles
+
+
+def main_out_of_core(stats_file: str, clusterids_file: str, splits: OrderedDict[str, List[str]],
+                     memory_budget: int) -> OrderedDict[str, xr.DataArray]:
+    """ Compute cluster quartiles from column files of player stats and
+    cluster IDs a chunk at a time. Only a histogram of each stat for each
+    cluster is kept in memory, from which the quartiles are derived. """
+
+    players = open_frame(stats_file)
+    clusterids = open_frame(clusterids_file)
+
+    quartiles = {}
+    for split, skills in splits.items():
+        skills = ['total'] + skills  # include total level when computing quartiles for each split
+        split_clusterids = clusterids[split]
+        nplayers = len(split_clusterids)
+        nclusters = int(split_clusterids.max(initial=-1)) + 1
+        nvalues = {skill: int(players[skill].max(initial=0)) + 1 for skill in skills}
+        counts = {skill: np.zeros((nclusters, nvalues[skill]), dtype='int64') for skill in skills}
 
         print(f"computing quartiles for split '{split}'...")
+        rows = chunk_rows(memory_budget, 8 * (len(skills) + 1))
+        for start in tqdm(range(0, nplayers, rows)):
+            ids = np.asarray(split_clusterids[start:start + rows], dtype='int64')
+            for skill in skills:
+                values = players[skill][start:start + rows].astype('int64')
+                flat = np.bincount(ids * nvalues[skill] + values, minlength=nclusters * nvalues[skill])
+                counts[skill] += flat.reshape(nclusters, nvalues[skill])
+
         split_quartiles = np.zeros((5, nclusters, len(skills)))
-        for i in tqdm(range(nclusters)):
-            this_cluster_inds = split_clusterids == i
-            this_cluster_stats = split_stats[this_cluster_inds]
-            split_quartiles[:, i, :] = compute_stat_quartiles(this_cluster_stats)
-
-        split_quartiles = xr.DataArray(
-            split_quartiles,
-            dims=["percentile", "clusterid", "skill"],
-            coords={
-                "percentile": [0, 25, 50, 75, 100],
-                "clusterid": range(nclusters),
-                "skill": skills
-            })
-        quartiles[split] = split_quartiles
+        for i, skill in enumerate(skills):
+            split_quartiles[:, :, i] = quartiles_from_counts(counts[skill])
+        quartiles[split] = quartiles_to_xarray(split_quartiles, skills)
 
     return quartiles
 
@@ -50,10 +93,21 @@ if __name__ == '__main__':
     parser.add_argument('--clusterids-file', required=True, type=str, help="load player cluster IDs from this file")
     parser.add_argument('--splits-file', required=True, type=str, help="load skills in each split from this file")
     parser.add_argument('--out-file', required=True, type=str, help="write cluster quartiles to this file")
+    parser.add_argument('--memory-budget', default=None, type=parse_memory_size,
+                        help="if set (e.g. '4G'), stream stats and cluster IDs from disk in chunks "
+                             "to stay within this much memory")
+    parser.add_argument('--cache-dir', default=None, type=str, help="if provided, reuse results for splits whose "
+                                                                    "data is unchanged")
     args = parser.parse_args()
 
-    players_df = load_pkl(args.stats_file)
-    clusterids_df = load_pkl(args.clusterids_file)
-    quartiles_dict = main(players_df, clusterids_df, splits=load_json(args.splits_file))
-    dump_pkl(quartiles_dict, args.out_file)
+    splits = load_json(args.splits_file)
+    cache = StageCache(args.cache_dir, 'compute_quartiles') if args.cache_dir else None
+    if args.memory_budget is not None:
+        quartiles_dict = main_out_of_core(args.stats_file, args.clusterids_file, splits, args.memory_budget)
+    else:
+        skills = ['total'] + sorted({skill for split_skills in splits.values() for skill in split_skills})
+        players_df = load_artifact(args.stats_file, columns=skills, index=False)
+        clusterids_df = load_artifact(args.clusterids_file, columns=list(splits.keys()), index=False)
+        quartiles_dict = main(players_df, clusterids_df, splits=splits, cache=cache)
+    dump_artifact(quartiles_dict, args.out_file)
     print(f"wrote cluster quartiles to {args.out_file}")
@@ -8,17 +8,19 @@ import logging
 import os
 import sys
 import traceback
+from functools import partial
 
 import aiohttp
 
-from src.scrape.common import RequestFailed
-from src.scrape.export import get_top_rank, get_page_jobs, export_records
+from src.scrape.common import RequestFailed, RetryList
+from src.scrape.export import get_top_rank, get_page_jobs, export_records, export_recovered
 from src.scrape.common import DoneScraping
 from src.scrape.workers import JobQueue, JobCounter, Worker, \
-    request_page, request_stats, enqueue_page_usernames, enqueue_stats
+    request_page, request_stats, enqueue_page_usernames, enqueue_stats, sweep_retries
 
 
 N_PAGE_WORKERS = 2   # number of page workers downloading rank/username info
+N_SWEEP_WORKERS = 4  # number of concurrent requests when retrying skipped players
 UNAME_BUFSIZE = 100  # maximum length of buffer containing username jobs for stats workers
 
 
@@ -46,6 +48,8 @@ async def main(out_file: str, start_rank: int, stop_rank: int, num_workers: int)
     pageworkers = [Worker(in_queue=page_q, out_queue=uname_q, job_counter=currentpage)
                    for _ in range(N_PAGE_WORKERS)]
 
+    # Players skipped after repeated failures are saved for a later retry sweep.
+    retries = RetryList(f"{out_file}.retry")
     currentrank = JobCounter(value=start_rank)
     statworkers = [Worker(in_queue=uname_q, out_queue=export_q, job_counter=currentrank)
                    for _ in range(num_workers)]
@@ -61,7 +65,8 @@ async def main(out_file: str, start_rank: int, stop_rank: int, num_workers: int)
             ))
         for i, w in enumerate(statworkers):
             T.append(asyncio.create_task(
-                w.run(sess, request_fn=request_stats, enqueue_fn=enqueue_stats, delay=i * 0.1)
+                w.run(sess, request_fn=partial(request_stats, retries=retries),
+                      enqueue_fn=enqueue_stats, delay=i * 0.1)
             ))
         try:
             await asyncio.gather(*T)  # allow first exception to be caught
@@ -73,6 +78,22 @@ async def main(out_file: str, start_rank: int, stop_rank: int, num_workers: int)
             await asyncio.gather(*T, return_exceptions=True)  # suppress CancelledErrors
 
 
+async def sweep(out_file: str):
+    """ Retry players who were skipped while scraping and save any recovered
+    records alongside the output file, to be merged when it is cleaned. """
+
+    retries = RetryList(f"{out_file}.retry")
+    if not len(retries):
+        return
+
+    logprint(f"retrying {len(retries)} skipped players...", level='info')
+    async with aiohttp.ClientSession() as sess:
+        recovered = await sweep_retries(sess, retries, num_workers=N_SWEEP_WORKERS)
+    if recovered:
+        export_recovered(out_file, recovered)
+    logprint(f"recovered {len(recovered)} players, {len(retries)} left to retry", level='info')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Download player data from the OSRS hiscores.")
     parser.add_argument('--start-rank', required=True, type=int, help="start data collection at this player rank")
@@ -98,6 +119,7 @@ if __name__ == '__main__':
 
     existing_rank = get_top_rank(args.out_file)
     if existing_rank and existing_rank >= args.stop_rank:
+        asyncio.run(sweep(args.out_file))
         logprint("nothing to do", level='info')
         sys.exit(0)
 
@@ -112,6 +134,7 @@ if __name__ == '__main__':
 
     try:
         asyncio.run(main(args.out_file, args.start_rank, args.stop_rank, args.num_workers))
+        asyncio.run(sweep(args.out_file))
     except RequestFailed as e:
         logging.error(f"caught RequestFailed: {e}")
         sys.exit(1)
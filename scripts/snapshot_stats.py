@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+""" Add the current player stats dataset to the history of snapshots. """
+
+import argparse
+import os
+
+from src.analysis.io import load_artifact
+from src.analysis.snapshots import SnapshotStore
+
+
+def main(stats_file: str, snapshot_dir: str, label: str):
+    store = SnapshotStore(snapshot_dir)
+    if label in store.labels:
+        print(f"snapshot '{label}' is already stored")
+        return
+
+    print("loading player stats...")
+    players = load_artifact(stats_file)
+
+    print(f"adding snapshot '{label}' to {snapshot_dir}...")
+    counts = store.add(players, label)
+    print(f"{counts['added']} players added, {counts['changed']} changed, {counts['removed']} removed")
+
+    nbytes = sum(os.path.getsize(os.path.join(snapshot_dir, entry['file'])) for entry in store.manifest['snapshots'])
+    print(f"store holds {len(store.labels)} snapshots in {nbytes / 1024 ** 2:.1f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add player stats to the snapshot history.")
+    parser.add_argument('--stats-file', required=True, help="load player stats from this file")
+    parser.add_argument('--snapshot-dir', required=True, help="directory of the snapshot store")
+    parser.add_argument('--label', required=True, help="name for the snapshot, e.g. the date of the scrape")
+    args = parser.parse_args()
+
+    main(args.stats_file, args.snapshot_dir, args.label)
@@ -44,10 +44,7 @@ def player_to_mongodoc(player: PlayerResults) -> Dict[str, Any]:
 def get_cluster_sizes(cluster_ids: NDArray) -> NDArray:
     """ Compute the number of occurrences for each cluster ID in an array. """
 
-    ids, counts = np.unique(cluster_ids, return_counts=True)
-    sizes = np.zeros(max(ids) + 1)
-    sizes[ids] = counts
-    return sizes.astype('int')
+    return np.bincount(np.asarray(cluster_ids)).astype('int')
 
 
 def get_cluster_uniqueness(cluster_sizes: NDArray) -> NDArray:
@@ -0,0 +1,148 @@
+""" Content-addressed cache for the results of pipeline stages. """
+
+import hashlib
+import json
+import os
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from src.analysis.io import dump_artifact, load_artifact
+
+CACHE_VERSION = 1                   # bump to invalidate every cached result
+HASH_BLOCK_BYTES = 64 * 1024 ** 2   # size of the blocks in which arrays are fed to the hash
+
+
+def _update(h, obj: Any):
+    if isinstance(obj, pd.DataFrame):
+        _update(h, ['frame'] + [str(col) for col in obj.columns])
+        _update(h, obj.index)
+        for col in obj.columns:
+            _update(h, obj[col].to_numpy())
+    elif isinstance(obj, pd.Series):
+        _update(h, obj.index)
+        _update(h, obj.to_numpy())
+    elif isinstance(obj, pd.Index):
+        _update(h, ['index', str(obj.name)])
+        _update(h, obj.to_numpy())
+    elif isinstance(obj, xr.DataArray):
+        _update(h, ['dataarray'] + [str(dim) for dim in obj.dims])
+        _update(h, {str(dim): obj.coords[dim].values.tolist() for dim in obj.dims if dim in obj.coords})
+        _update(h, obj.values)
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            obj = obj.astype(str)
+        flat = np.ascontiguousarray(obj).reshape(-1)
+        _update(h, {'dtype': flat.dtype.str, 'shape': list(obj.shape)})
+        step = max(1, HASH_BLOCK_BYTES // max(1, flat.dtype.itemsize))
+        for start in range(0, len(flat), step):
+            h.update(flat[start:start + step].data)
+    else:
+        value = json.dumps(obj, sort_keys=True, default=str).encode('utf-8')
+        h.update(np.uint64(len(value)).tobytes())
+        h.update(value)
+
+
+def hash_data(*parts: Any) -> str:
+    """ Compute a SHA-256 digest of some data. Each part may be an array,
+    DataFrame, DataArray or any JSON-serializable value. Arrays are hashed
+    by dtype, shape and contents and DataFrames by column names, index and
+    data. """
+
+    h = hashlib.sha256()
+    for part in parts:
+        _update(h, part)
+    return h.hexdigest()
+
+
+class StageCache:
+    """ Directory of results from one stage of the pipeline, each stored as
+    an artifact named by a hash of the data and parameters it was computed
+    from. Stages cache results per split, so changing the inputs for one
+    split only recomputes that split. Results are kept until they are
+    deleted with clear() or prune_cache(). """
+
+    def __init__(self, cache_dir: str, stage: str):
+        self.stage = stage
+        self.dir = os.path.join(cache_dir, stage)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def key(self, *parts: Any) -> str:
+        return hash_data(self.stage, CACHE_VERSION, *parts)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.dir, f'{key}.cols')
+
+    def load(self, key: str) -> Any:
+        """ Get the result stored under a key, or None if there isn't one. """
+
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path)  # the modification time records when a result was last used
+        return load_artifact(path)
+
+    def dump(self, key: str, result: Any):
+        path = self.path(key)
+        dump_artifact(result, path + '.tmp')
+        os.replace(path + '.tmp', path)  # never leave a partially-written result under the key
+
+    def clear(self):
+        """ Delete every result stored for this stage. """
+
+        for path, _, _ in _cached_results(self.dir):
+            os.remove(path)
+
+
+def _cached_results(cache_dir: str) -> List[Tuple[str, int, float]]:
+    # Path, size and last use of each result under a directory, least recently used first.
+    results = []
+    for root, _, files in os.walk(cache_dir):
+        for file in files:
+            if file.endswith('.cols'):
+                stat = os.stat(os.path.join(root, file))
+                results.append((os.path.join(root, file), stat.st_size, stat.st_mtime))
+    return sorted(results, key=lambda result: result[2])
+
+
+def prune_cache(cache_dir: str, max_bytes: int) -> int:
+    """ Delete the least recently used results from a cache directory (of
+    any stage) until the rest take up at most the given number of bytes.
+
+    :param cache_dir: directory holding a StageCache for each stage
+    :param max_bytes: size the cache is reduced to
+    :return: number of bytes freed
+    """
+    results = _cached_results(cache_dir)
+    excess = sum(size for _, size, _ in results) - max_bytes
+    freed = 0
+    for path, size, _ in results:
+        if freed >= excess:
+            break
+        os.remove(path)
+        freed += size
+    return freed
+
+
+def cached(cache: StageCache, name: str, compute: Callable[[], Any], *key_parts: Any) -> Any:
+    """ Compute a result, or reuse it from a cache if it was already computed
+    from the same data and parameters.
+
+    :param cache: cache to use (if None, always compute the result)
+    :param name: description of the result for progress output
+    :param compute: function computing the result, which must be storable as an artifact
+    :param key_parts: all data and parameters that the result depends on
+    :return: computed or cached result
+    """
+    if cache is None:
+        return compute()
+    key = cache.key(*key_parts)
+    result = cache.load(key)
+    if result is not None:
+        print(f"using cached result for {name}")
+        return result
+    result = compute()
+    cache.dump(key, result)
+    return result
@@ -1,16 +1,22 @@
 """ Loading and saving data. """
 
 import collections
-import csv
+import dataclasses
+import gzip
 import json
 import pickle
-from typing import OrderedDict, Any
+from multiprocessing import Pool
+from typing import OrderedDict, Any, Dict, Iterator, List, Tuple, Union
 
 import numpy as np
 import pandas as pd
+import xarray as xr
+from numpy.typing import NDArray
 from tqdm import tqdm
 
-from src.common import osrs_skills
+from src.common import osrs_skills, level_dtype
+from src.analysis.appdata import SplitResults
+from src.analysis.names import NameTable
 
 
 def load_json(file: str) -> Any:
@@ -28,13 +34,458 @@ def dump_pkl(obj: Any, file: str):
         pickle.dump(obj, f)
 
 
+COLUMNS_MAGIC = b'OSRSCOLS'  # first bytes of a column file
+COLUMNS_VERSION = 1          # format version written to a column file's manifest
+COLUMNS_ALIGN = 64           # byte alignment of each array stored in a column file
+
+
+def _align(n: int) -> int:
+    return -(-n // COLUMNS_ALIGN) * COLUMNS_ALIGN
+
+
+def _write_column_header(f, layout: Dict[str, Tuple[np.dtype, Tuple[int, ...]]], meta: Dict[str, Any]) -> int:
+    """ Write the magic bytes and manifest for a column file with arrays of
+    the given dtypes and shapes. Returns the total size of the file. """
+
+    schema = []
+    offset = 0
+    for name, (dtype, shape) in layout.items():
+        dtype = np.dtype(dtype)
+        if dtype.hasobject:
+            raise ValueError(f"column '{name}' has object dtype and cannot be stored in a column file")
+        schema.append({'name': name, 'dtype': dtype.str, 'shape': list(shape), 'offset': offset})
+        offset += _align(dtype.itemsize * int(np.prod(shape)))
+
+    manifest = {'version': COLUMNS_VERSION, 'columns': schema, 'meta': meta or {}}
+    header = json.dumps(manifest).encode('utf-8')
+    data_start = _align(len(COLUMNS_MAGIC) + 8 + len(header))
+
+    f.write(COLUMNS_MAGIC)
+    f.write(np.uint64(len(header)).tobytes())
+    f.write(header)
+    f.write(b'\0' * (data_start - f.tell()))
+    return data_start + offset
+
+
+def dump_columns(columns: Dict[str, NDArray], file: str, meta: Dict[str, Any] = None):
+    """ Write a set of named arrays to a column file. The file begins with a
+    JSON manifest giving the dtype, shape and location of each array, and each
+    array is stored contiguously after it so that any one of them can be
+    memory-mapped without reading the others.
+
+    :param columns: mapping from names to arrays of any fixed-size dtype
+    :param file: write column file to this path
+    :param meta: optional JSON-serializable metadata to store in the manifest
+    """
+    with open(file, 'wb') as f:
+        _write_column_header(f, {name: (arr.dtype, arr.shape) for name, arr in columns.items()}, meta)
+        for arr in columns.values():
+            arr = np.ascontiguousarray(arr)
+            f.write(arr.reshape(-1).view('uint8').data)
+            f.write(b'\0' * (_align(arr.nbytes) - arr.nbytes))
+
+
+def allocate_columns(layout: Dict[str, Tuple[Any, Tuple[int, ...]]], file: str,
+                     meta: Dict[str, Any] = None) -> 'ColumnFile':
+    """ Create a column file holding zeroed arrays of the given dtypes and
+    shapes, to be filled in place through ColumnFile.memmap(name, 'r+'). This
+    lets a column file be written a piece at a time without holding any of
+    its arrays in memory. """
+
+    with open(file, 'wb') as f:
+        size = _write_column_header(f, layout, meta)
+        f.truncate(size)
+    return ColumnFile(file)
+
+
+def is_column_file(file: str) -> bool:
+    with open(file, 'rb') as f:
+        return f.read(len(COLUMNS_MAGIC)) == COLUMNS_MAGIC
+
+
+def parse_memory_size(size: str) -> int:
+    """ Convert a human-readable size like '512M' or '4G' to a number of bytes. """
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def chunk_rows(memory_budget: int, row_bytes: int) -> int:
+    """ Number of rows to process at a time so that a chunk, along with the
+    temporary copies made while working on it, stays within a memory budget. """
+
+    return max(1, memory_budget // (4 * row_bytes))
+
+
+class ColumnFile:
+    """ Read-only handle to a column file written by dump_columns(). Arrays
+    are memory-mapped on access, so opening the file and reading a single
+    column never loads the rest of the data. The contents of a column file
+    may also be given as bytes, in which case arrays are views of them. """
+
+    def __init__(self, file: Union[str, bytes]):
+        self.file = file
+        self._buffer = file if isinstance(file, (bytes, bytearray, memoryview)) else None
+        if self._buffer is not None:
+            head = bytes(self._buffer[:len(COLUMNS_MAGIC) + 8])
+        else:
+            with open(file, 'rb') as f:
+                head = f.read(len(COLUMNS_MAGIC) + 8)
+        if head[:len(COLUMNS_MAGIC)] != COLUMNS_MAGIC:
+            raise ValueError(f"{self._name()} is not a column file")
+        header_len = int(np.frombuffer(head[len(COLUMNS_MAGIC):], dtype='uint64')[0])
+        if self._buffer is not None:
+            header = bytes(self._buffer[len(head):len(head) + header_len])
+        else:
+            with open(file, 'rb') as f:
+                f.seek(len(head))
+                header = f.read(header_len)
+        manifest = json.loads(header.decode('utf-8'))
+        if manifest['version'] > COLUMNS_VERSION:
+            raise ValueError(f"{self._name()} has column file version {manifest['version']}, "
+                             f"this code reads up to version {COLUMNS_VERSION}")
+        self.version = manifest['version']
+        self.meta = manifest['meta']
+        self.schema = collections.OrderedDict((c['name'], c) for c in manifest['columns'])
+        self._data_start = _align(len(COLUMNS_MAGIC) + 8 + header_len)
+
+    def _name(self) -> str:
+        return "buffer" if self._buffer is not None else str(self.file)
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.schema.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.schema
+
+    def __getitem__(self, name: str) -> NDArray:
+        return self.memmap(name)
+
+    def memmap(self, name: str, mode: str = 'r') -> NDArray:
+        col = self.schema[name]
+        dtype, shape = np.dtype(col['dtype']), tuple(col['shape'])
+        count = int(np.prod(shape))
+        if dtype.itemsize * count == 0:
+            return np.empty(shape, dtype=dtype)
+        offset = self._data_start + col['offset']
+        if self._buffer is not None:
+            if mode not in ('r', 'c'):
+                raise ValueError(f"column file held in memory can only be opened read-only, not '{mode}'")
+            return np.frombuffer(self._buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+        return np.memmap(self.file, dtype=dtype, mode=mode, shape=shape, offset=offset)
+
+
+def smallest_int_dtype(arr: NDArray) -> np.dtype:
+    """ Get the smallest signed integer dtype which can hold every value in an array. """
+
+    lo, hi = (int(arr.min()), int(arr.max())) if arr.size else (0, 0)
+    for dtype in ['int8', 'int16', 'int32']:
+        if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype('int64')
+
+
+ARTIFACT_VERSION = 3  # version of the artifact layout (2 added packed levels, 3 added name tables)
+LEVEL_BITS = 7        # bits per skill level in packed artifacts (enough for levels 0-99, but not total level)
+PACK_CHUNK_ROWS = 65536  # number of rows packed or unpacked at a time
+
+
+def _join(path: str, name: str) -> str:
+    return f'{path}/{name}' if path else name
+
+
+def _to_column(values: Union[pd.Series, pd.Index, NDArray]) -> NDArray:
+    values = np.asarray(values)
+    if values.dtype.hasobject:
+        values = values.astype(str)  # strings are stored as fixed-width unicode
+    return values
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def pack_levels(levels: NDArray, bits: int = LEVEL_BITS) -> NDArray:
+    """ Pack a 2D array of skill levels into a fixed number of bits per level.
+    Each row is packed into a whole number of bytes, so rows can still be
+    sliced from the packed array.
+
+    :param levels: array of levels, with a row per player and a column per skill
+    :param bits: number of bits per level (every level must be less than 2 ** bits)
+    :return: uint8 array with a row of ceil(ncols * bits / 8) bytes per player
+    """
+    levels = np.asarray(levels)
+    if levels.size and (levels.min() < 0 or levels.max() >= 2 ** bits):
+        raise ValueError(f"levels must be in the range 0-{2 ** bits - 1} to be packed into {bits} bits")
+    nrows, ncols = levels.shape
+    packed = np.empty((nrows, (ncols * bits + 7) // 8), dtype='uint8')
+    for start in range(0, nrows, PACK_CHUNK_ROWS):
+        block = levels[start:start + PACK_CHUNK_ROWS].astype('uint8')
+        block_bits = np.unpackbits(block[:, :, None], axis=2)[:, :, 8 - bits:]
+        packed[start:start + len(block)] = np.packbits(block_bits.reshape(len(block), ncols * bits), axis=1)
+    return packed
+
+
+def unpack_levels(packed: NDArray, ncols: int, bits: int = LEVEL_BITS) -> NDArray:
+    """ Unpack an array of levels written by pack_levels() into a uint8 array with ncols columns. """
+
+    nrows = len(packed)
+    levels = np.empty((nrows, ncols), dtype='uint8')
+    for start in range(0, nrows, PACK_CHUNK_ROWS):
+        block = np.asarray(packed[start:start + PACK_CHUNK_ROWS])
+        block_bits = np.zeros((len(block), ncols, 8), dtype='uint8')
+        block_bits[:, :, 8 - bits:] = np.unpackbits(block, axis=1, count=ncols * bits).reshape(len(block), ncols, bits)
+        levels[start:start + len(block)] = np.packbits(block_bits, axis=2)[:, :, 0]
+    return levels
+
+
+def frame_layout(columns: List[str], nrows: int, index: str = None, index_name: str = None,
+                 path: str = '', index_format: str = None) -> Dict[str, Any]:
+    """ Layout entry in an artifact's manifest for a DataFrame whose columns
+    (and index, if any) are stored as arrays under the given path. An index
+    of strings is stored as a name table (index_format 'names'), otherwise
+    it is a plain array. """
+
+    return {'kind': 'frame', 'path': path, 'columns': list(columns), 'nrows': nrows,
+            'index': index, 'index_name': index_name, 'index_format': index_format}
+
+
+def artifact_meta(layout: Dict[str, Any]) -> Dict[str, Any]:
+    """ Column file metadata marking the file as an artifact with the given layout. """
+
+    meta = {'artifact_version': ARTIFACT_VERSION, 'artifact': layout}
+    if layout['kind'] == 'frame':
+        meta['nrows'] = layout['nrows']
+    return meta
+
+
+def _encode(obj: Any, path: str, columns: Dict[str, NDArray], index_label: str = None,
+            pack: bool = False) -> Dict[str, Any]:
+    def add(name, values):
+        if name in columns:
+            raise ValueError(f"artifact has more than one array named '{name}'")
+        columns[name] = _to_column(values)
+
+    if isinstance(obj, pd.DataFrame):
+        names = list(obj.columns)
+        if not all(isinstance(name, str) for name in names):
+            raise ValueError("DataFrame columns must have string names to be stored in an artifact")
+        index = obj.index
+        index_format = None
+        if isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1:
+            index_col = None  # implied by row order
+        elif index.inferred_type == 'string':
+            index_col = index_label or index.name or '__index__'
+            index_format = 'names'
+            for name, values in NameTable.build(index).to_columns(_join(path, index_col)).items():
+                add(name, values)
+        else:
+            index_col = index_label or index.name or '__index__'
+            add(_join(path, index_col), index)
+        skills = osrs_skills()
+        packed = [name for name in names if pack and name in skills and obj[name].dtype == 'uint8']
+        for name in names:
+            if name not in packed:
+                add(_join(path, name), obj[name])
+        layout = frame_layout(names, len(obj), index_col, index.name, path, index_format)
+        if obj.attrs:
+            layout['attrs'] = _to_json(obj.attrs)
+        if packed:
+            levels = np.stack([obj[name].to_numpy() for name in packed], axis=1)
+            add(_join(path, '__levels__'), pack_levels(levels))
+            layout['packed'] = {'path': _join(path, '__levels__'), 'columns': packed, 'bits': LEVEL_BITS}
+        return layout
+
+    if isinstance(obj, xr.DataArray):
+        add(path or 'values', obj.values)
+        return {'kind': 'dataarray', 'path': path or 'values', 'dims': list(obj.dims),
+                'coords': {dim: _to_json(obj.coords[dim].values) for dim in obj.dims if dim in obj.coords}}
+
+    if isinstance(obj, np.ndarray):
+        add(path or 'values', obj)
+        return {'kind': 'array', 'path': path or 'values'}
+
+    if isinstance(obj, SplitResults):
+        fields = collections.OrderedDict()
+        for field in dataclasses.fields(obj):
+            value = getattr(obj, field.name)
+            if isinstance(value, (pd.DataFrame, xr.DataArray, np.ndarray)):
+                fields[field.name] = _encode(value, _join(path, field.name), columns)
+            else:
+                fields[field.name] = {'kind': 'json', 'value': _to_json(value)}
+        return {'kind': 'splitresults', 'fields': fields}
+
+    if isinstance(obj, dict):
+        items = []
+        for key, value in obj.items():
+            if not isinstance(key, str):
+                raise ValueError("mapping keys must be strings to be stored in an artifact")
+            items.append([key, _encode(value, _join(path, key), columns, index_label, pack)])
+        return {'kind': 'mapping', 'items': items}
+
+    raise ValueError(f"cannot store object of type {type(obj).__name__} in an artifact")
+
+
+def _decode(cf: ColumnFile, layout: Dict[str, Any], columns: List[str] = None, index: bool = True) -> Any:
+    kind = layout['kind']
+    if kind == 'frame':
+        names = layout['columns'] if columns is None else list(columns)
+        for name in names:
+            if name not in layout['columns']:
+                raise ValueError(f"artifact has no column '{name}'")
+        packed = layout.get('packed') or {'columns': []}
+        if any(name in packed['columns'] for name in names):
+            levels = unpack_levels(cf[packed['path']], len(packed['columns']), packed['bits'])
+            unpacked = {name: np.ascontiguousarray(levels[:, i]) for i, name in enumerate(packed['columns'])}
+        data = collections.OrderedDict((name, unpacked[name] if name in packed['columns'] else
+                                        cf.memmap(_join(layout['path'], name), 'c')) for name in names)
+        if index and layout['index'] is not None:
+            index_path = _join(layout['path'], layout['index'])
+            if layout.get('index_format') == 'names':
+                row_index = pd.Index(NameTable.from_columns(cf, index_path).to_numpy(), name=layout['index_name'])
+            else:
+                row_index = pd.Index(cf[index_path], name=layout['index_name'])
+        else:
+            row_index = pd.RangeIndex(layout['nrows'])
+        frame = pd.DataFrame(data, index=row_index, copy=False) if data else pd.DataFrame(index=row_index)
+        frame.attrs.update(layout.get('attrs', {}))
+        return frame
+
+    if kind == 'dataarray':
+        return xr.DataArray(cf.memmap(layout['path'], 'c'), dims=layout['dims'], coords=layout['coords'])
+
+    if kind == 'array':
+        return cf.memmap(layout['path'], 'c')
+
+    if kind == 'splitresults':
+        return SplitResults(**{name: field['value'] if field['kind'] == 'json' else _decode(cf, field)
+                               for name, field in layout['fields'].items()})
+
+    if kind == 'mapping':
+        keys = [key for key, _ in layout['items']]
+        if columns is not None:
+            for key in columns:
+                if key not in keys:
+                    raise ValueError(f"artifact has no entry '{key}'")
+        return collections.OrderedDict((key, _decode(cf, item, index=index)) for key, item in layout['items']
+                                       if columns is None or key in columns)
+
+    raise ValueError(f"unknown artifact layout '{kind}'")
+
+
+def dump_artifact(obj: Any, file: str, index_label: str = None, pack: bool = False):
+    """ Write the output of a pipeline stage to a column file. The object may
+    be a DataFrame, DataArray, array or SplitResults, or a mapping from
+    strings to any of these. Its arrays are stored as raw columns and the
+    structure needed to rebuild it goes in the manifest, so that it can be
+    memory-mapped back in rather than unpickled. The attrs of a DataFrame
+    are kept in the manifest too, so they must be JSON-serializable.
+
+    :param obj: object to write
+    :param file: write artifact to this file
+    :param index_label: store a DataFrame's index under this name (default is the name of the index)
+    :param pack: store uint8 skill level columns packed into LEVEL_BITS bits each, which makes
+                 the file smaller but means they have to be unpacked (copied) when loaded
+    """
+    columns = collections.OrderedDict()
+    layout = _encode(obj, '', columns, index_label, pack)
+    dump_columns(columns, file, meta=artifact_meta(layout))
+
+
+def load_artifact(file: Union[str, bytes], columns: List[str] = None, index: bool = True) -> Any:
+    """ Load the output of a pipeline stage written by dump_artifact(). Arrays
+    are memory-mapped (copy-on-write) rather than read, so only the data that
+    is actually used is loaded from disk. Pickle files are loaded as well to
+    support outputs written before the column format was adopted.
+
+    :param file: path to an artifact, or its contents as bytes
+    :param columns: load only these columns of a DataFrame, or these keys of a mapping
+    :param index: if False, give a DataFrame a range index instead of loading the stored one
+    :return: the stored object
+    """
+    in_memory = isinstance(file, (bytes, bytearray, memoryview))
+    if in_memory and bytes(file[:len(COLUMNS_MAGIC)]) != COLUMNS_MAGIC:
+        return pickle.loads(file)
+    if not in_memory and not is_column_file(file):
+        return load_pkl(file)
+
+    cf = ColumnFile(file)
+    if 'artifact' not in cf.meta:
+        raise ValueError(f"{cf._name()} is a column file but not a pipeline artifact")
+    if cf.meta['artifact_version'] > ARTIFACT_VERSION:
+        raise ValueError(f"{cf._name()} has artifact version {cf.meta['artifact_version']}, "
+                         f"this code reads up to version {ARTIFACT_VERSION}")
+    return _decode(cf, cf.meta['artifact'], columns, index)
+
+
+def open_frame(file: str) -> ColumnFile:
+    """ Open a DataFrame artifact to read its columns directly, e.g. a chunk at a time. """
+
+    cf = ColumnFile(file)
+    layout = cf.meta.get('artifact', {})
+    if layout.get('kind') != 'frame':
+        raise ValueError(f"{cf._name()} is not a DataFrame artifact")
+    if layout.get('packed'):
+        raise ValueError(f"{cf._name()} has packed levels, so its columns cannot be read directly "
+                         f"(load it with load_artifact() instead)")
+    return cf
+
+
+def frame_index(cf: ColumnFile) -> Union[NameTable, NDArray, None]:
+    """ Get the stored index of a DataFrame artifact opened with open_frame(),
+    as a name table or array which can be read a slice at a time (or None
+    if the index is implied by row order). """
+
+    layout = cf.meta['artifact']
+    if layout['index'] is None:
+        return None
+    path = _join(layout['path'], layout['index'])
+    if layout.get('index_format') == 'names':
+        return NameTable.from_columns(cf, path)
+    return cf[path]
+
+
+def index_columns(cf: ColumnFile) -> OrderedDict[str, NDArray]:
+    """ Get the arrays storing the index of a DataFrame artifact opened with
+    open_frame(), by name, e.g. to copy the index to another artifact. """
+
+    layout = cf.meta['artifact']
+    if layout['index'] is None:
+        return collections.OrderedDict()
+    path = _join(layout['path'], layout['index'])
+    if layout.get('index_format') == 'names':
+        return collections.OrderedDict(NameTable.from_columns(cf, path).to_columns(path))
+    return collections.OrderedDict([(path, cf[path])])
+
+
+def load_names(file: Union[str, bytes]) -> NameTable:
+    """ Load the usernames indexing a DataFrame artifact as a name table, to
+    look players up by name without building a pandas index. """
+
+    cf = ColumnFile(file)
+    if cf.meta.get('artifact', {}).get('kind') != 'frame' or cf.meta['artifact']['index'] is None:
+        raise ValueError(f"{cf._name()} is not a DataFrame artifact with an index")
+    index = frame_index(cf)
+    return index if isinstance(index, NameTable) else NameTable.build(index.astype(str))
+
+
 def import_players_csv(file: str) -> pd.DataFrame:
     """ Read player stats dataset from a CSV file. """
 
     stats_df = pd.read_csv(file, index_col='username')
     stats_df.drop('rank', axis=1, inplace=True)
     stats_df[np.isnan(stats_df)] = 1
-    return stats_df.astype('uint16')
+    return stats_df.astype({skill: level_dtype(skill) for skill in stats_df.columns})
 
 
 def import_clusterids_csv(file: str) -> pd.DataFrame:
@@ -70,21 +521,124 @@ def import_centroids_csv(file: str) -> OrderedDict[str, pd.DataFrame]:
     return centroids_per_split
 
 
-def export_players_csv(players_df: pd.DataFrame, file: str):
-    """ Write a player stats dataset to CSV file. """
+EXPORT_CHUNK_ROWS = 100000  # number of rows formatted at a time when writing a CSV file
+
+
+def _csv_field(values: NDArray, blank_zeros: bool = False) -> NDArray:
+    """ Format an array of values as CSV fields, returned as byte strings
+    padded with null bytes. Values are written as csv.writer would write
+    them, with QUOTE_MINIMAL quoting for strings. """
+
+    if values.dtype.kind in 'OUS':
+        strs = np.asarray(values, dtype=str)
+        try:
+            fields = strs.astype('S')
+        except UnicodeEncodeError:
+            fields = np.char.encode(strs, 'utf-8')
+        needs_quotes = np.zeros(len(fields), dtype='bool')
+        for char in [b',', b'"', b'\r', b'\n']:
+            needs_quotes |= np.char.find(fields, char) >= 0
+        if needs_quotes.any():
+            fields = fields.astype(object)
+            fields[needs_quotes] = [b'"' + f.replace(b'"', b'""') + b'"' for f in fields[needs_quotes]]
+            fields = fields.astype('S')
+        return fields
+
+    if values.dtype.kind in 'iu' and values.dtype != np.uint64:
+        fields = _int_field(values)
+    else:
+        fields = values.astype('S')  # same digits as str() for numpy floats
+    if blank_zeros:
+        fields[values == 0] = b''
+    return fields
+
+
+def _int_field(values: NDArray) -> NDArray:
+    """ Format integers as byte strings by computing their decimal digits
+    arithmetically, which is much faster than converting them with astype().
+    Fields are padded with null bytes on the left rather than the right. """
+
+    values = values.astype('int64')
+    magnitude = np.abs(values)
+    ndigits = len(str(int(magnitude.max()))) if len(values) else 1
+    chars = np.zeros((len(values), ndigits + 1), dtype='uint8')
+    chars[:, 0] = np.where(values < 0, ord('-'), 0)
+    rest = magnitude.copy()
+    for place in range(ndigits):
+        digit = rest % 10
+        rest //= 10
+        shown = magnitude >= 10 ** place if place > 0 else True
+        chars[:, ndigits - place] = np.where(shown, ord('0') + digit, 0)
+    return chars.view(f'S{ndigits + 1}').reshape(len(values))
+
+
+def _csv_lines(fields: List[NDArray], lineterminator: bytes = b'\r\n') -> bytes:
+    """ Join columns of formatted fields into CSV lines. The fields are laid
+    out side by side in a byte matrix along with the delimiters, and the
+    null bytes padding each field are dropped to leave the lines. """
+
+    nrows = len(fields[0])
+    if nrows == 0:
+        return b''
+    parts = []
+    for i, field in enumerate(fields):
+        if i > 0:
+            parts.append(np.full((nrows, 1), ord(','), dtype='uint8'))
+        parts.append(np.ascontiguousarray(field).view('uint8').reshape(nrows, field.dtype.itemsize))
+    parts.append(np.tile(np.frombuffer(lineterminator, dtype='uint8'), (nrows, 1)))
+    lines = np.hstack(parts)
+    return lines[lines != 0].tobytes()
+
+
+def _format_csv_chunk(args) -> bytes:
+    columns, blank_zeros, lineterminator, compress = args
+    data = _csv_lines([_csv_field(c, b) for c, b in zip(columns, blank_zeros)], lineterminator)
+    return gzip.compress(data, compresslevel=6, mtime=0) if compress else data
+
+
+def _write_csv(file: str, header: List[str], chunks: Iterator[Tuple[List[NDArray], List[bool]]], nrows: int,
+               lineterminator: bytes = b'\r\n', num_workers: int = 1):
+    """ Write chunks of columns to a CSV file, formatting chunks in parallel
+    across worker processes if more than one is requested. A file name
+    ending in .gz is gzip-compressed, with each chunk compressed separately
+    as one member of the file. """
+
+    compress = str(file).endswith('.gz')
+    head = [_csv_field(np.array([name])) for name in header]
+    tasks = ((columns, blank_zeros, lineterminator, compress) for columns, blank_zeros in chunks)
+    with open(file, 'wb') as f, tqdm(total=nrows) as pbar:
+        f.write(_format_csv_chunk((head, [False] * len(head), lineterminator, compress)))
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                for data, (start, end) in zip(pool.imap(_format_csv_chunk, tasks), _chunk_bounds(nrows)):
+                    f.write(data)
+                    pbar.update(end - start)
+        else:
+            for task, (start, end) in zip(tasks, _chunk_bounds(nrows)):
+                f.write(_format_csv_chunk(task))
+                pbar.update(end - start)
+
+
+def _chunk_bounds(nrows: int) -> List[Tuple[int, int]]:
+    chunk_size = EXPORT_CHUNK_ROWS
+    return [(start, min(start + chunk_size, nrows)) for start in range(0, nrows, chunk_size)]
+
+
+def export_players_csv(players_df: pd.DataFrame, file: str, num_workers: int = 1):
+    """ Write a player stats dataset to CSV file. Unranked stats (zeros) are
+    left blank and rank is given by row order. """
 
     print("writing player stats...")
-    with open(file, 'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(['username', 'rank'] + list(players_df.columns))
-        for rank, (uname, stats) in tqdm(enumerate(players_df.iterrows(), 1), total=len(players_df)):
-            line = [uname, rank]
-            for n in stats:
-                if n == 0:
-                    line.append('')
-                else:
-                    line.append(n)
-            writer.writerow(line)
+    unames = players_df.index.to_numpy()
+    stats = [players_df[col].to_numpy() for col in players_df.columns]
+
+    def chunks():
+        for start, end in _chunk_bounds(len(players_df)):
+            columns = [unames[start:end], np.arange(start + 1, end + 1)] + [s[start:end] for s in stats]
+            yield columns, [False, False] + [True] * len(stats)
+
+    header = ['username', 'rank'] + list(players_df.columns)
+    _write_csv(file, header, chunks(), len(players_df), num_workers=num_workers)
 
 
 def export_clusterids_csv(clusterids_df: pd.DataFrame, file: str):
@@ -97,14 +651,15 @@ def export_centroids_csv(centroids_dict: OrderedDict[str, pd.DataFrame], file):
     """ Write centroids that results from clustering to CSV file. """
 
     header = ['split', 'clusterid'] + osrs_skills(include_total=False)
-    with open(file, 'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(header)
-        for split, split_centroids in centroids_dict.items():
-            lines = []
-            for clusterid, centroid in split_centroids.iterrows():
-                skill_vals = []
-                for s in osrs_skills():
-                    skill_vals.append('' if s not in centroid.index else centroid[s])
-                lines.append([split, clusterid] + skill_vals)
-            writer.writerows(lines)
+    lines = [_csv_lines([_csv_field(np.array([name])) for name in header])]
+    for split, split_centroids in centroids_dict.items():
+        nclusters = len(split_centroids)
+        fields = [_csv_field(np.full(nclusters, split)), _csv_field(split_centroids.index.to_numpy())]
+        for skill in osrs_skills():
+            if skill in split_centroids.columns:
+                fields.append(_csv_field(split_centroids[skill].to_numpy()))
+            else:
+                fields.append(np.zeros(nclusters, dtype='S1'))
+        lines.append(_csv_lines(fields))
+    with open(file, 'wb') as f:
+        f.write(b''.join(lines))
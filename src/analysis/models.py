@@ -1,16 +1,31 @@
 """ Core machine learning models. """
 
+import functools
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Tuple
 
 import faiss
 import numpy as np
-import umap
 from numpy.typing import NDArray
 
 os.environ["KMP_WARNINGS"] = 'off'  # suppress OMP deprecation warning from UMAP (github.com/numba/numba/issues/5275)
 
+ASSIGN_CHUNK_ROWS = 65536  # number of vectors assigned to clusters at a time
+ASSIGN_CHECK_ROWS = 100000  # number of vectors checked against exact search after approximate assignment
+ASSIGN_EFFORT = {'hnsw': 8, 'ivf': 4}  # default search effort of approximate indexes (efSearch, nprobe)
+HNSW_NEIGHBORS = 32        # number of links per centroid in an HNSW graph
+LUT_LEVELS = 100           # levels 0-99 covered by lookup tables, 0 meaning unranked
+LUT_BLOCK_ROWS = 64        # number of vectors per task of the compiled kernel
 
-def fit_kmeans(x: NDArray, k: int, w: NDArray, verbose=True) -> NDArray:
+
+def set_num_threads(nthreads: int):
+    """ Limit the number of threads used by faiss in this process. """
+
+    faiss.omp_set_num_threads(nthreads)
+
+
+def fit_kmeans(x: NDArray, k: int, w: NDArray, verbose=True, niter: int = 100, nredo: int = 10) -> NDArray:
     """ Determine centroids for a set of k clusters such that when each
     vector in x is assigned to the nearest cluster, the sum of distances
     between each vector and its corresponding centroid is minimized.
@@ -19,39 +34,379 @@ def fit_kmeans(x: NDArray, k: int, w: NDArray, verbose=True) -> NDArray:
     :param k: number of clusters
     :param w: 1D array of weights corresponding to vectors in X
     :param verbose: whether to print info after each training iteration
+    :param niter: number of training iterations
+    :param nredo: number of times to train, keeping the best result
     :return: 2D array of centroids, number of rows is k
     """
-    x = x.copy().astype('float32')  # faiss library needs C-contiguous, float32 arrays
+    x = np.ascontiguousarray(x, dtype='float32')  # faiss library needs C-contiguous, float32 arrays
     npoints, ndims = x.shape
 
-    kmeans = faiss.Kmeans(d=ndims, k=k, seed=0, niter=100, nredo=10,
+    kmeans = faiss.Kmeans(d=ndims, k=k, seed=0, niter=niter, nredo=nredo,
                           verbose=verbose, max_points_per_centroid=npoints)
     kmeans.train(x, weights=w.astype('float32'))
 
     return kmeans.centroids
 
 
-def cluster_l2(x: NDArray, centroids: NDArray) -> NDArray:
+def fit_minibatch_kmeans(batches: Callable[[], Iterable[Tuple[NDArray, NDArray]]], init: NDArray,
+                         init_weights: NDArray = None, max_passes: int = 20, tol: float = 1e-3,
+                         verbose: bool = True) -> Tuple[NDArray, float]:
+    """ Determine k-means centroids from batches of vectors streamed from
+    somewhere (e.g. a file a chunk at a time) rather than held in memory.
+    Each batch moves every centroid towards the weighted mean of the vectors
+    assigned to it, by a step which shrinks as the centroid accumulates
+    weight (mini-batch k-means, Sculley 2010). The initial centroids start
+    out with weight of their own, so that the first batch refines them
+    rather than replacing them with its own means.
+
+    :param batches: function returning an iterable of (vectors, weights) batches, called once per pass
+    :param init: 2D array of initial centroids, e.g. from fit_kmeans() on a sample
+    :param init_weights: weight behind each initial centroid, e.g. that of the sample assigned to it
+                         (by default, the weight of the first batch assigned to it)
+    :param max_passes: most passes to make over the data
+    :param tol: stop once a pass lowers the inertia by less than this fraction
+    :param verbose: whether to print info after each pass
+    :return: 2D array of centroids, and the weighted mean squared distance from each vector
+             to its nearest centroid during the last pass
+    """
+    centroids = np.array(init, dtype='float32')
+    k, ndims = centroids.shape
+    # Total weight assigned to each centroid so far, which is seeded from the first batch if not given.
+    counts = None if init_weights is None else np.array(init_weights, dtype='float64')
+    prev_inertia = None
+    for i in range(max_passes):
+        sqdist_sum, weight_sum = 0.0, 0.0
+        for x, w in batches():
+            x = np.ascontiguousarray(x, dtype='float32')
+            w = np.asarray(w, dtype='float64')
+            ids, sqdists = assign_clusters(x, centroids)
+            sqdist_sum += float(w @ sqdists)
+            weight_sum += float(w.sum())
+
+            batch_weights = np.bincount(ids, weights=w, minlength=k)
+            batch_sums = np.stack([np.bincount(ids, weights=w * x[:, j], minlength=k) for j in range(ndims)], axis=1)
+            if counts is None:
+                counts = batch_weights.copy()
+            counts += batch_weights
+            moved = batch_weights > 0
+            step = (batch_sums[moved] - batch_weights[moved, None] * centroids[moved]) / counts[moved, None]
+            centroids[moved] += step.astype('float32')
+
+        inertia = sqdist_sum / max(weight_sum, np.finfo('float64').tiny)
+        if verbose:
+            print(f"pass {i + 1}: inertia {inertia:.4g}")
+        if prev_inertia is not None and prev_inertia - inertia <= tol * prev_inertia:
+            break
+        prev_inertia = inertia
+
+    return centroids, inertia
+
+
+def refine_kmeans(x: NDArray, w: NDArray, init: NDArray, max_iter: int = 20, tol: float = 1e-4,
+                  verbose: bool = True) -> Tuple[NDArray, float]:
+    """ Improve a set of centroids with weighted k-means (Lloyd) iterations,
+    stopping early once they stop lowering the inertia. Starting from
+    centroids which already fit the data well, e.g. those of the previous
+    release, this converges in a few iterations rather than the hundreds
+    taken by several fits from scratch.
+
+    :param x: 2D array of vectors to cluster
+    :param w: 1D array of weights corresponding to vectors in x
+    :param init: 2D array of initial centroids
+    :param max_iter: most iterations to run
+    :param tol: stop once an iteration lowers the inertia by less than this fraction
+    :param verbose: whether to print info after each iteration
+    :return: 2D array of centroids, and the weighted mean squared distance
+             from each vector to its nearest one of them
+    """
+    x = np.ascontiguousarray(x, dtype='float32')
+    w = np.asarray(w, dtype='float64')
+    centroids = np.array(init, dtype='float32')
+    k, ndims = centroids.shape
+    prev_inertia = None
+    for i in range(max_iter + 1):
+        ids, sqdists = assign_clusters(x, centroids)
+        inertia = float(w @ sqdists) / max(float(w.sum()), np.finfo('float64').tiny)
+        if verbose:
+            print(f"iteration {i}: inertia {inertia:.4g}")
+        if i == max_iter or (prev_inertia is not None and prev_inertia - inertia <= tol * prev_inertia):
+            break
+        prev_inertia = inertia
+
+        # Centroids which were assigned no vectors stay where they are.
+        cluster_weights = np.bincount(ids, weights=w, minlength=k)
+        sums = np.stack([np.bincount(ids, weights=w * x[:, j], minlength=k) for j in range(ndims)], axis=1)
+        moved = cluster_weights > 0
+        centroids[moved] = (sums[moved] / cluster_weights[moved, None]).astype('float32')
+
+    return centroids, inertia
+
+
+def kmeans_inertia(x: NDArray, w: NDArray, centroids: NDArray) -> float:
+    """ Weighted mean squared distance from each vector to its nearest centroid. """
+
+    _, sqdists = assign_clusters(x, centroids)
+    w = np.asarray(w, dtype='float64')
+    return float(w @ sqdists) / max(float(w.sum()), np.finfo('float64').tiny)
+
+
+def centroid_index(centroids: NDArray, method: str = 'flat', effort: int = None) -> faiss.Index:
+    """ Build a faiss index for finding the nearest of a set of centroids.
+    The 'flat' index compares every vector with every centroid, so it is
+    exact but takes time in proportion to the number of centroids. The
+    approximate indexes search only part of them: 'hnsw' walks a graph of
+    neighbouring centroids, and 'ivf' searches the centroids in a few of
+    about sqrt(k) cells. Either may sometimes miss the nearest centroid, less
+    often the higher the search effort.
+
+    :param centroids: 2D array of cluster centroids
+    :param method: 'flat', 'hnsw' or 'ivf'
+    :param effort: candidates kept while searching the HNSW graph (efSearch), or
+                   number of cells searched by the IVF index (nprobe), higher for better recall
+    :return: faiss index holding the centroids
+    """
+    centroids = np.ascontiguousarray(centroids, dtype='float32')
+    k, ndims = centroids.shape
+    effort = effort or ASSIGN_EFFORT.get(method)
+    if method == 'flat':
+        index = faiss.IndexFlatL2(ndims)
+    elif method == 'hnsw':
+        index = faiss.IndexHNSWFlat(ndims, HNSW_NEIGHBORS)
+        index.hnsw.efSearch = effort
+    elif method == 'ivf':
+        nlist = max(1, int(np.sqrt(k)))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(ndims), ndims, nlist)
+        index.cp.min_points_per_centroid = 1  # cells are fit to the centroids themselves, of which there are few
+        index.train(centroids)
+        index.nprobe = min(effort, nlist)
+    else:
+        raise ValueError(f"unknown centroid index '{method}', expected 'flat', 'hnsw' or 'ivf'")
+    index.add(centroids)
+    return index
+
+
+def assign_clusters(x: NDArray, centroids: NDArray, chunk_rows: int = ASSIGN_CHUNK_ROWS,
+                    num_threads: int = 1, method: str = 'flat', effort: int = None) -> Tuple[NDArray, NDArray]:
+    """ Find the nearest centroid to each vector in x, by Euclidean distance.
+    Vectors are searched a chunk at a time, so memory use beyond the output
+    arrays is bounded by the chunk size whatever the number of vectors. A
+    chunk of x which is already float32 and C-contiguous is searched in
+    place, otherwise only that chunk is converted. With an approximate
+    index (see centroid_index()) the search is much faster for large
+    numbers of centroids, but a few vectors may not get the nearest one.
+
+    :param x: 2D array of vectors to assign (may be memory-mapped)
+    :param centroids: 2D array of cluster centroids
+    :param chunk_rows: number of vectors searched at a time
+    :param num_threads: number of chunks searched at once (each search is also
+                        parallelized by faiss, so this helps most when chunks are small)
+    :param method: kind of index to search, 'flat' (exact), 'hnsw' or 'ivf'
+    :param effort: search effort of an approximate index
+    :return: 1D array of cluster IDs (indexes of the nearest centroids), and
+             1D array of squared distances from each vector to its centroid
+    """
+    npoints = len(x)
+    ids = np.empty(npoints, dtype='int64')
+    sqdists = np.empty(npoints, dtype='float32')
+    index = centroid_index(centroids, method, effort)
+
+    def search(start: int):
+        chunk = np.ascontiguousarray(x[start:start + chunk_rows], dtype='float32')
+        chunk_sqdists, chunk_ids = index.search(chunk, k=1)  # searching an index is safe from several threads
+        ids[start:start + len(chunk)] = chunk_ids[:, 0]
+        sqdists[start:start + len(chunk)] = chunk_sqdists[:, 0]
+
+    starts = range(0, npoints, max(1, chunk_rows))
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(search, starts))
+    else:
+        for start in starts:
+            search(start)
+    return ids, sqdists
+
+
+def level_tables(centroids: NDArray) -> NDArray:
+    """ Tables of the squared distance from each possible level to each
+    centroid's value, per dimension. A level of 0 (unranked) is treated as
+    1, as it is by the clustering features.
+
+    :param centroids: 2D array of cluster centroids
+    :return: 3D float32 array indexed by dimension, level and centroid
+    """
+    levels = np.arange(LUT_LEVELS, dtype='float64')
+    levels[0] = 1
+    centroids = np.asarray(centroids, dtype='float64')
+    return np.ascontiguousarray((levels[None, :, None] - centroids.T[:, None, :]) ** 2, dtype='float32')
+
+
+@functools.lru_cache(maxsize=None)
+def _lut_kernel():
+    # Compiled on first use, or None if numba isn't installed. Imported here because it takes seconds to load.
+    # The compiled code isn't cached on disk, since numba would write it next to this module.
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(parallel=True, fastmath=True)
+    def kernel(levels, tables, ids, sqdists):
+        nrows, ndims = levels.shape
+        k = tables.shape[2]
+        for block in numba.prange((nrows + LUT_BLOCK_ROWS - 1) // LUT_BLOCK_ROWS):
+            acc = np.empty(k, dtype=np.float32)
+            for i in range(block * LUT_BLOCK_ROWS, min((block + 1) * LUT_BLOCK_ROWS, nrows)):
+                acc[:] = tables[0, levels[i, 0]]
+                for j in range(1, ndims):
+                    row = tables[j, levels[i, j]]
+                    for c in range(k):
+                        acc[c] += row[c]
+                best = np.argmin(acc)
+                ids[i] = best
+                sqdists[i] = acc[best]
+
+    return kernel
+
+
+def assign_levels(levels: NDArray, centroids: NDArray, chunk_rows: int = ASSIGN_CHUNK_ROWS,
+                  engine: str = None) -> Tuple[NDArray, NDArray]:
+    """ Find the nearest centroid to each vector of skill levels using
+    lookup tables instead of a generic L2 search. Since levels are small
+    integers, the squared distance in each dimension to each centroid is
+    precomputed for every level (see level_tables()), and a vector's
+    distance to a centroid is a sum of table entries, read straight from a
+    uint8 matrix without converting it to float or replacing unranked 0s.
+    Gives the same result as assign_clusters() on split features, up to
+    ties broken by rounding.
+
+    :param levels: 2D array of levels 0-99, ideally uint8 (chunks of other integer types are converted)
+    :param centroids: 2D array of cluster centroids
+    :param chunk_rows: number of vectors assigned at a time
+    :param engine: 'numba' for a compiled kernel, 'numpy' for vectorized lookups, or None
+                   to use numba if it is installed
+    :return: 1D array of cluster IDs, and 1D array of squared distances to them
+    """
+    kernel = _lut_kernel() if engine in (None, 'numba') else None
+    if engine == 'numba' and kernel is None:
+        raise ValueError("the numba engine was requested, but numba is not installed")
+    if engine not in (None, 'numba', 'numpy'):
+        raise ValueError(f"unknown assignment engine '{engine}', expected 'numba' or 'numpy'")
+
+    tables = level_tables(centroids)
+    npoints = len(levels)
+    ids = np.empty(npoints, dtype='int64')
+    sqdists = np.empty(npoints, dtype='float32')
+    for start in range(0, npoints, max(1, chunk_rows)):
+        chunk = levels[start:start + chunk_rows]
+        if chunk.size and (chunk.min() < 0 or chunk.max() >= LUT_LEVELS):
+            raise ValueError(f"lookup tables cover levels 0 to {LUT_LEVELS - 1}, got {chunk.min()} to {chunk.max()}")
+        chunk = np.ascontiguousarray(chunk, dtype='uint8')
+        end = start + len(chunk)
+        if kernel is not None:
+            kernel(chunk, tables, ids[start:end], sqdists[start:end])
+        else:
+            acc = tables[0][chunk[:, 0]]
+            for j in range(1, chunk.shape[1]):
+                acc += tables[j][chunk[:, j]]
+            ids[start:end] = np.argmin(acc, axis=1)
+            sqdists[start:end] = acc[np.arange(len(chunk)), ids[start:end]]
+    return ids, sqdists
+
+
+def assignment_mismatch(x: NDArray, centroids: NDArray, ids: NDArray, nsample: int = ASSIGN_CHECK_ROWS,
+                        seed: int = 0) -> Tuple[int, int]:
+    """ Check approximate cluster assignments against an exact search over a
+    random sample of the vectors.
+
+    :param x: 2D array of vectors which were assigned to clusters
+    :param centroids: 2D array of cluster centroids
+    :param ids: 1D array of the cluster ID assigned to each vector
+    :param nsample: number of vectors to check (all of them if there are fewer)
+    :param seed: seed for sampling the vectors
+    :return: number of sampled vectors whose assigned centroid is farther than
+             their nearest one, and the number of vectors sampled
+    """
+    rows = np.arange(len(x))
+    if len(x) > nsample:
+        rows = np.sort(np.random.default_rng(seed).choice(len(x), nsample, replace=False))
+    exact_ids, exact_sqdists = assign_clusters(x[rows], centroids)
+    centroids = np.asarray(centroids, dtype='float32')
+    assigned_sqdists = np.sum((np.asarray(x[rows], dtype='float32') - centroids[ids[rows]]) ** 2, axis=1)
+    # Assignments to a different centroid at the same distance (a tie) are as good as exact ones.
+    wrong = (ids[rows] != exact_ids) & (assigned_sqdists > exact_sqdists * (1 + 1e-5) + 1e-6)
+    return int(wrong.sum()), len(rows)
+
+
+def cluster_l2(x: NDArray, centroids: NDArray, method: str = 'flat', effort: int = None) -> NDArray:
     """ Cluster the vectors in x according to a given list of cluster
     centroids. Each vector is assigned a cluster ID which is the
     index of the nearest centroid using the Euclidean distance.
 
     :param x: 2D array of vector to cluster
     :param centroids: 2D array of cluster centroids
+    :param method: kind of index to search, 'flat' (exact), 'hnsw' or 'ivf' (see centroid_index()),
+                   or 'lut' to use lookup tables on vectors of skill levels (see assign_levels())
+    :param effort: search effort of an approximate index
     :return: 1D array of cluster IDs
     """
-    x = x.copy().astype('float32')
-    centroids = centroids.copy().astype('float32')
-    npoints, ndims = x.shape
+    if method == 'lut':
+        ids, _ = assign_levels(x, centroids)
+    else:
+        ids, _ = assign_clusters(x, centroids, method=method, effort=effort)
+    return ids
 
-    index = faiss.IndexFlatL2(ndims)
-    index.add(centroids)
-    _, result = index.search(x, k=1)
 
-    clusterids = [i[0] for i in result]  # index.search() returns array of length-1 arrays
-    clusterids = np.array(clusterids).astype('int')
+def extend_centroids(x: NDArray, w: NDArray, centroids: NDArray, k: int, seed: int = 0) -> NDArray:
+    """ Add centroids to a set until there are k of them, by k-means++
+    seeding: each new centroid is a vector drawn with probability
+    proportional to its weight times its squared distance to the nearest
+    centroid so far. This starts k-means for a larger k from a fit for a
+    smaller one.
+
+    :param x: 2D array of vectors being clustered
+    :param w: 1D array of weights corresponding to vectors in x
+    :param centroids: 2D array of existing centroids, which are kept
+    :param k: number of centroids to return
+    :param seed: seed for drawing the new centroids
+    :return: 2D array of k centroids, the existing ones first
+    """
+    rng = np.random.default_rng(seed)
+    x = np.ascontiguousarray(x, dtype='float32')
+    w = np.asarray(w, dtype='float64')
+    _, sqdists = assign_clusters(x, centroids)
+    sqdists = sqdists.astype('float64')
+    new = []
+    for _ in range(k - len(centroids)):
+        p = w * sqdists
+        row = rng.choice(len(x), p=p / p.sum()) if p.sum() > 0 else rng.integers(len(x))
+        new.append(x[row])
+        sqdists = np.minimum(sqdists, np.sum((x - x[row]) ** 2, axis=1))
+    return np.concatenate([np.asarray(centroids, dtype='float32'), np.array(new, dtype='float32').reshape(-1, x.shape[1])])
 
-    return clusterids
+
+def adjusted_rand_index(a: NDArray, b: NDArray) -> float:
+    """ Agreement between two clusterings of the same vectors, adjusted for
+    chance: 1 if they group the vectors identically (whatever the cluster
+    IDs), and about 0 if they agree no more than random clusterings would.
+
+    :param a: 1D array of cluster IDs from one clustering
+    :param b: 1D array of cluster IDs from the other, for the same vectors
+    :return: adjusted Rand index
+    """
+    def pairs(counts):
+        counts = counts.astype('float64')
+        return float(np.sum(counts * (counts - 1) / 2))
+
+    _, a = np.unique(a, return_inverse=True)
+    _, b = np.unique(b, return_inverse=True)
+    a, b = a.ravel().astype('int64'), b.ravel().astype('int64')
+    _, joint = np.unique(a * (int(b.max(initial=0)) + 1) + b, return_counts=True)
+    same_both, same_a, same_b = pairs(joint), pairs(np.bincount(a)), pairs(np.bincount(b))
+    expected = same_a * same_b / max(pairs(np.array([len(a)])), 1)
+    most = (same_a + same_b) / 2
+    if most == expected:
+        return 1.0
+    return (same_both - expected) / (most - expected)
 
 
 def umap_reduce(x: NDArray, d: int, n_neighbors: int, min_dist: float) -> NDArray:
@@ -66,6 +421,7 @@ def umap_reduce(x: NDArray, d: int, n_neighbors: int, min_dist: float) -> NDArra
     :param min_dist: UMAP `min_dist` parameter
     :return: 2D array of projected points with d columns
     """
+    import umap  # imported here because it takes seconds to load, which would slow every worker process
     fit = umap.UMAP(
         n_neighbors=n_neighbors,
         min_dist=min_dist,
@@ -82,3 +438,29 @@ def compute_stat_quartiles(player_vectors: NDArray) -> NDArray:
     # It is possible to have nan as a percentile value when all of the
     # players in a cluster happen to be unranked in a particular stat.
     return np.nanpercentile(player_vectors, axis=0, q=[0, 25, 50, 75, 100])
+
+
+def quartiles_from_counts(counts: NDArray) -> NDArray:
+    """ Compute quartiles from histograms of non-negative integer stats,
+    matching np.percentile (linear interpolation) on the values themselves.
+    This lets quartiles be accumulated over a dataset a chunk at a time.
+
+    :param counts: array whose last axis counts the occurrences of each value 0, 1, 2, ...
+    :return: array of quartiles with shape (5,) + counts.shape[:-1], nan where a histogram is empty
+    """
+    cumcounts = np.cumsum(counts, axis=-1)
+    n = cumcounts[..., -1]
+    q = (np.array([0, 25, 50, 75, 100]) / 100).reshape((5,) + (1,) * n.ndim)
+
+    # Same virtual index, neighbours and interpolation as numpy's 'linear' method.
+    virtual = n * q - q
+    lo = np.clip(np.floor(virtual), 0, np.maximum(n - 1, 0))
+    hi = np.clip(lo + 1, 0, np.maximum(n - 1, 0))
+    gamma = np.where(virtual >= n - 1, 0, virtual - lo)
+
+    # The value at a position in the sorted data is the number of values whose cumulative count does not exceed it.
+    a = np.sum(cumcounts <= lo[..., None], axis=-1).astype('float64')
+    b = np.sum(cumcounts <= hi[..., None], axis=-1).astype('float64')
+    diff = b - a
+    result = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    return np.where(n > 0, result, np.nan)
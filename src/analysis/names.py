@@ -0,0 +1,196 @@
+""" Packed table of usernames with a hash index for lookups by name. """
+
+import itertools
+from typing import Callable, Dict, Iterable, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+FNV_OFFSET = 0xcbf29ce484222325  # FNV-1a (64-bit) hash parameters
+FNV_PRIME = 0x100000001b3
+FNV_MASK = 2 ** 64 - 1
+PACK_CHUNK_NAMES = 65536  # number of names encoded at a time when building a table
+
+
+def fold_name(name: str) -> bytes:
+    """ Encode a username for comparison regardless of case. Only ASCII
+    letters are folded, which covers every character allowed in names. """
+
+    return name.encode('utf-8').lower()
+
+
+def _hash_bytes(key: bytes) -> int:
+    h = FNV_OFFSET
+    for c in key:
+        h = ((h ^ c) * FNV_PRIME) & FNV_MASK
+    return h
+
+
+def _hash_rows(blob: NDArray, offsets: NDArray) -> NDArray:
+    # Same hash as _hash_bytes() over the case-folded bytes of every string, a byte position at a time.
+    starts, lengths = offsets[:-1], np.diff(offsets)
+    hashes = np.full(len(lengths), FNV_OFFSET, dtype='uint64')
+    for j in range(int(lengths.max(initial=0))):
+        rows = np.flatnonzero(lengths > j)
+        c = blob[starts[rows] + j]
+        c = np.where((c >= ord('A')) & (c <= ord('Z')), c + 32, c).astype('uint64')
+        hashes[rows] = (hashes[rows] ^ c) * np.uint64(FNV_PRIME)  # wraps around modulo 2^64
+    return hashes
+
+
+def _pack(names: Iterable[str]) -> Tuple[NDArray, NDArray]:
+    # Blob of the UTF-8 bytes of every string, and the offsets where each one starts (plus the end).
+    # Strings are encoded a chunk at a time, so names can be streamed from disk.
+    blobs, lengths = [], []
+    names = iter(names)
+    while True:
+        encoded = [name.encode('utf-8') for name in itertools.islice(names, PACK_CHUNK_NAMES)]
+        if not encoded:
+            break
+        blobs.append(np.frombuffer(b''.join(encoded), dtype='uint8'))
+        lengths.append(np.fromiter(map(len, encoded), dtype='int64', count=len(encoded)))
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype='int64')
+    offsets = np.zeros(len(lengths) + 1, dtype='int64')
+    np.cumsum(lengths, out=offsets[1:])
+    return np.concatenate(blobs) if blobs else np.zeros(0, dtype='uint8'), offsets
+
+
+def _build_slots(hashes: NDArray, capacity: int = 0) -> NDArray:
+    # Open addressing with linear probing, filled for all rows at once: in each
+    # round, every unplaced row tries its next slot and the lowest row wins
+    # each empty slot, so the first of any names which are equal (ignoring
+    # case) is the one found by lookups.
+    nslots = 1 << max(1, 2 * max(len(hashes), capacity) - 1).bit_length()  # load factor of at most 1/2
+    mask = np.uint64(nslots - 1)
+    slots = np.full(nslots, -1, dtype='int32' if nslots < 2 ** 31 else 'int64')
+    pending = np.arange(len(hashes))
+    pos = (hashes & mask).astype('int64')
+    while len(pending):
+        free = slots[pos] == -1
+        claimed, first = np.unique(pos[free], return_index=True)
+        winners = pending[free][first]
+        slots[claimed] = winners
+        placed = np.zeros(len(hashes), dtype=bool)
+        placed[winners] = True
+        keep = ~placed[pending]
+        pending, pos = pending[keep], (pos[keep] + 1) & (nslots - 1)
+    return slots
+
+
+def hash_names(names: Iterable[str]) -> NDArray:
+    """ Hash case-folded names, the same way as the index of a NameTable. """
+
+    return _hash_rows(*_pack(names))
+
+
+def name_slots(hashes: NDArray, capacity: int = 0) -> NDArray:
+    """ Build a hash table mapping names (given by hash_names()) to their
+    rows, as used by NameTable, with room for at least the given number of
+    names so that more can be added later (see probe_slots()). """
+
+    return _build_slots(hashes, capacity)
+
+
+def probe_slots(slots: NDArray, name: str, name_at: Callable[[int], str]) -> Tuple[int, int]:
+    """ Look up a name, ignoring case, in a hash table of rows whose names
+    are read by the given function.
+
+    :return: row of the name or -1 if it is not in the table, and the slot
+             holding that row (or the empty slot where the name would go)
+    """
+    key = fold_name(name)
+    mask = len(slots) - 1
+    pos = _hash_bytes(key) & mask
+    while True:
+        row = int(slots[pos])
+        if row < 0 or fold_name(name_at(row)) == key:
+            return row, pos
+        pos = (pos + 1) & mask
+
+
+class NameTable:
+    """ Table of strings packed into one blob of UTF-8 bytes with an array of
+    offsets, plus a hash table mapping case-folded strings to their rows.
+    This takes a fraction of the memory of an index of Python strings, can
+    be memory-mapped from an artifact, and finds a name in constant time.
+
+    Rows are read by integer or slice, which give strings or arrays of them. """
+
+    def __init__(self, blob: NDArray, offsets: NDArray, slots: NDArray):
+        self.blob = blob
+        self.offsets = offsets
+        self.slots = slots
+
+    @classmethod
+    def build(cls, names: Iterable[str]) -> 'NameTable':
+        """ Pack a sequence of strings into a table. Names should be unique
+        ignoring case: duplicates are allowed, but each extra copy of a name
+        makes building the table take another pass. The sequence may be a
+        generator, which is consumed a chunk at a time. """
+
+        blob, offsets = _pack(names)
+        return cls(blob, offsets, _build_slots(_hash_rows(blob, offsets)))
+
+    @classmethod
+    def from_columns(cls, columns, path: str) -> 'NameTable':
+        """ Get a table stored under a path in a column file (or dict of arrays). """
+
+        return cls(*[columns[f'{path}/{part}'] for part in ['blob', 'offsets', 'slots']])
+
+    def to_columns(self, path: str) -> Dict[str, NDArray]:
+        """ Get the arrays making up the table, named for storage under a path in a column file. """
+
+        return {f'{path}/blob': self.blob, f'{path}/offsets': self.offsets, f'{path}/slots': self.slots}
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[str, NDArray]:
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            stop = max(start, stop)
+            data = self.blob[self.offsets[start]:self.offsets[stop]].tobytes()
+            bounds = (self.offsets[start:stop + 1] - self.offsets[start]).tolist()
+            out = np.empty(stop - start, dtype=object)
+            out[:] = [data[a:b].decode('utf-8') for a, b in zip(bounds[:-1], bounds[1:])]
+            return out
+        row = int(key) + len(self) if key < 0 else int(key)
+        if not 0 <= row < len(self):
+            raise IndexError(f"row {key} out of range for table of {len(self)} names")
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def take(self, rows: NDArray) -> NDArray:
+        """ Get the strings in some rows of the table. """
+
+        out = np.empty(len(rows), dtype=object)
+        out[:] = [self[row] for row in rows]
+        return out
+
+    def to_numpy(self) -> NDArray:
+        """ Get all strings in the table as an array of Python strings. """
+
+        return self[:]
+
+    def find(self, name: str) -> int:
+        """ Find the row of a name, ignoring case, or -1 if it is not in the table. """
+
+        key = fold_name(name)
+        mask = len(self.slots) - 1
+        pos = _hash_bytes(key) & mask
+        while True:
+            row = int(self.slots[pos])
+            if row < 0:
+                return -1
+            if self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().lower() == key:
+                return row
+            pos = (pos + 1) & mask
+
+    def find_many(self, names: Iterable[str]) -> NDArray:
+        """ Find the rows of several names, ignoring case, with -1 for those not in the table. """
+
+        return np.array([self.find(name) for name in names], dtype='int64')
+
+    def __contains__(self, name: str) -> bool:
+        return self.find(name) >= 0
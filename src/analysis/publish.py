@@ -0,0 +1,195 @@
+""" Publishing pipeline artifacts to S3 as releases. """
+
+import base64
+import datetime
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+from tqdm import tqdm
+
+MANIFEST_NAME = 'manifest.json'    # object naming the artifacts in the current release
+MANIFEST_VERSION = 1               # format version written to release manifests
+PUBLISH_PART_BYTES = 16 * 1024 ** 2  # size of the parts in which artifacts are uploaded
+PUBLISH_WORKERS = 8                # number of parts uploaded at once
+
+
+def _split_s3_url(url: str) -> Tuple[str, str]:
+    bucket, _, prefix = url.replace('s3://', '').partition('/')
+    return bucket, prefix.strip('/')
+
+
+def _checksum(data: bytes) -> str:
+    return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+
+def _read_range(file: str, start: int, size: int) -> bytes:
+    with open(file, 'rb') as f:
+        return os.pread(f.fileno(), size, start)
+
+
+def _file_sha256(file: str) -> str:
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(PUBLISH_PART_BYTES), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def release_name() -> str:
+    """ Name a new release by the current UTC time. """
+
+    return datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+
+
+def publish_artifacts(files: Dict[str, str], url: str, num_workers: int = PUBLISH_WORKERS,
+                      release: str = None, write_manifest: bool = True) -> Dict[str, Any]:
+    """ Upload a set of artifacts as a new release. Every part of every file
+    is uploaded concurrently, with a checksum that S3 verifies on receipt.
+    Artifacts go under a prefix for the release, and the manifest naming
+    them is written only once they have all been uploaded, so readers of
+    the manifest switch from one complete release to the next at once.
+
+    :param files: local files to upload, by artifact name
+    :param url: S3 URL of the directory holding releases and the manifest
+    :param num_workers: number of parts to upload at once
+    :param release: name of the release (default is given by release_name())
+    :param write_manifest: if False, upload the release without making it current
+                           (make it current later with publish_manifest())
+    :return: manifest of the release
+    """
+    bucket, prefix = _split_s3_url(url)
+    release = release or release_name()
+    s3 = boto3.client('s3')  # clients are safe to share between threads
+
+    # Files of one part are uploaded whole, larger ones as multipart uploads.
+    uploads: Dict[str, Dict[str, Any]] = {}
+    tasks: List[Tuple[str, int, int]] = []
+    for name, file in files.items():
+        size = os.path.getsize(file)
+        key = '/'.join(filter(None, [prefix, 'releases', release, os.path.basename(file)]))
+        upload = {'file': file, 'key': key, 'size': size, 'parts': {}, 'upload_id': None}
+        if size > PUBLISH_PART_BYTES:
+            response = s3.create_multipart_upload(Bucket=bucket, Key=key, ChecksumAlgorithm='SHA256')
+            upload['upload_id'] = response['UploadId']
+        uploads[name] = upload
+        tasks += [(name, start, min(PUBLISH_PART_BYTES, size - start))
+                  for start in range(0, max(size, 1), PUBLISH_PART_BYTES)]
+
+    def upload_part(task: Tuple[str, int, int]):
+        name, start, size = task
+        upload = uploads[name]
+        data = _read_range(upload['file'], start, size)
+        if upload['upload_id'] is None:
+            s3.put_object(Bucket=bucket, Key=upload['key'], Body=data, ChecksumSHA256=_checksum(data))
+        else:
+            part = start // PUBLISH_PART_BYTES + 1
+            response = s3.upload_part(Bucket=bucket, Key=upload['key'], UploadId=upload['upload_id'],
+                                      PartNumber=part, Body=data, ChecksumSHA256=_checksum(data))
+            upload['parts'][part] = {'PartNumber': part, 'ETag': response['ETag'],
+                                     'ChecksumSHA256': response.get('ChecksumSHA256', _checksum(data))}
+        pbar.update(size)
+
+    print(f"uploading {len(files)} artifacts to s3://{bucket}/{prefix} as release {release}...")
+    try:
+        with ThreadPoolExecutor(max(1, num_workers)) as executor, \
+                tqdm(total=sum(u['size'] for u in uploads.values()), unit='B', unit_scale=True) as pbar:
+            hashes = {name: executor.submit(_file_sha256, upload['file']) for name, upload in uploads.items()}
+            list(executor.map(upload_part, tasks))
+        for upload in uploads.values():
+            if upload['upload_id'] is not None:
+                parts = [upload['parts'][part] for part in sorted(upload['parts'])]
+                s3.complete_multipart_upload(Bucket=bucket, Key=upload['key'], UploadId=upload['upload_id'],
+                                             MultipartUpload={'Parts': parts})
+                upload['upload_id'] = None
+    finally:
+        for upload in uploads.values():
+            if upload['upload_id'] is not None:
+                s3.abort_multipart_upload(Bucket=bucket, Key=upload['key'], UploadId=upload['upload_id'])
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'release': release,
+        'artifacts': {name: {'key': upload['key'], 'size': upload['size'], 'sha256': hashes[name].result()}
+                      for name, upload in uploads.items()}
+    }
+    if write_manifest:
+        publish_manifest(manifest, url)
+    return manifest
+
+
+def publish_manifest(manifest: Dict[str, Any], url: str):
+    """ Make an uploaded release current by writing its manifest. The
+    manifest may also name the database collection built for the release
+    ('collection'), for the app to look players up in, and list earlier
+    releases and their collections ('history', see release_history()). """
+
+    bucket, prefix = _split_s3_url(url)
+    manifest_key = '/'.join(filter(None, [prefix, MANIFEST_NAME]))
+    boto3.client('s3').put_object(Bucket=bucket, Key=manifest_key, ContentType='application/json',
+                                  Body=json.dumps(manifest, indent=2).encode('utf-8'))
+    print(f"wrote manifest for release {manifest['release']} to s3://{bucket}/{manifest_key}")
+
+
+def release_history(previous: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """ History to record in the manifest of a new release: every earlier
+    release, oldest first, with the database collection it used.
+
+    :param previous: manifest of the release being replaced, or None if there isn't one
+    :return: list of entries giving a release name and its collection (or None)
+    """
+    if not previous:
+        return []
+    entry = {'release': previous['release'], 'collection': previous.get('collection')}
+    return previous.get('history', []) + [entry]
+
+
+def stale_collections(manifest: Dict[str, Any]) -> List[str]:
+    """ Database collections of releases before the previous one, which no
+    app should still be using. Only collections recorded in the manifest's
+    history are given, so others in the database are never touched. """
+
+    history = manifest.get('history', [])
+    keep = {manifest.get('collection')} | {entry['collection'] for entry in history[-1:]}
+    stale = [entry['collection'] for entry in history[:-1] if entry['collection'] not in keep]
+    return [coll for coll in dict.fromkeys(stale) if coll is not None]
+
+
+def load_manifest(manifest_url: str, missing_ok: bool = False) -> Dict[str, Any]:
+    """ Read the manifest of the current release.
+
+    :param manifest_url: S3 URL of the manifest
+    :param missing_ok: if True, return None if nothing has been published yet
+    :return: manifest of the release
+    """
+    bucket, key = _split_s3_url(manifest_url)
+    try:
+        body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    except ClientError as e:
+        if missing_ok and e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    manifest = json.loads(body)
+    if manifest['version'] > MANIFEST_VERSION:
+        raise ValueError(f"manifest {manifest_url} has version {manifest['version']}, "
+                         f"this code reads up to version {MANIFEST_VERSION}")
+    return manifest
+
+
+def artifact_url(manifest: Dict[str, Any], manifest_url: str, name: str) -> str:
+    """ Get the S3 URL of an artifact in a release from its manifest. """
+
+    if name not in manifest['artifacts']:
+        raise ValueError(f"release {manifest['release']} has no artifact '{name}'")
+    bucket, _ = _split_s3_url(manifest_url)
+    return f"s3://{bucket}/{manifest['artifacts'][name]['key']}"
+
+
+def resolve_artifact(manifest_url: str, name: str) -> str:
+    """ Get the S3 URL of an artifact in the release named by a manifest. """
+
+    return artifact_url(load_manifest(manifest_url), manifest_url, name)
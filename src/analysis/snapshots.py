@@ -0,0 +1,228 @@
+""" History of player stats kept as a base snapshot plus deltas. """
+
+import bisect
+import json
+import os
+import string
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+
+from src.analysis.io import dump_artifact, load_artifact, load_json, load_names
+
+SNAPSHOTS_VERSION = 2            # format version written to the manifest of a snapshot store
+MANIFEST_FILE = 'snapshots.json'
+REMOVED_COL = '__removed__'      # delta column marking players who are no longer in the dataset
+ROW_COL = '__row__'              # delta column holding the row of each player in the later snapshot
+KEYFRAME_INTERVAL = 12           # every this many snapshots, one is stored in full so loads replay few deltas
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _keys(index: pd.Index) -> pd.Index:
+    # Players are matched by username ignoring case, the same way as name tables.
+    return pd.Index(index.astype(str).str.translate(_ASCII_LOWER))
+
+
+def _increasing(values: NDArray) -> NDArray:
+    """ Mask of a longest increasing subsequence of an array of distinct values. """
+
+    keep = np.ones(len(values), dtype='bool')
+    if np.all(values[1:] > values[:-1]):
+        return keep
+    tails, tail_pos = [], []  # smallest last value of an increasing subsequence of each length, and its position
+    prev_pos = np.full(len(values), -1)
+    for i, value in enumerate(values):
+        j = bisect.bisect_left(tails, value)
+        prev_pos[i] = tail_pos[j - 1] if j > 0 else -1
+        if j == len(tails):
+            tails.append(value)
+            tail_pos.append(i)
+        else:
+            tails[j], tail_pos[j] = value, i
+    keep[:] = False
+    i = tail_pos[-1]
+    while i >= 0:
+        keep[i] = True
+        i = prev_pos[i]
+    return keep
+
+
+def diff_snapshots(prev: pd.DataFrame, new: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """ Find the rows of player stats which differ between two snapshots.
+    The delta also holds the row of each of its players in the later
+    snapshot, along with any unchanged players that moved out of order
+    relative to the others, so that applying it restores the later
+    snapshot exactly, row order included.
+
+    :param prev: earlier snapshot, indexed by username
+    :param new: later snapshot, indexed by username with the same columns as prev
+    :return: delta holding the rows of players who were added, changed or moved (with their
+             new stats and row in ROW_COL) or removed (flagged in REMOVED_COL), and the
+             number of players added, changed and removed
+    """
+    if list(prev.columns) != list(new.columns):
+        raise ValueError("snapshots must have the same columns to be compared")
+    prev_keys, new_keys = _keys(prev.index), _keys(new.index)
+    pos = prev_keys.get_indexer(new_keys)
+    existing = pos >= 0
+    changed = ~existing
+    # Changes in the case of a username count too, so that reconstructed snapshots have current names.
+    changed[existing] |= prev.index.to_numpy()[pos[existing]] != new.index.to_numpy()[existing]
+    for col in new.columns:
+        changed[existing] |= prev[col].to_numpy()[pos[existing]] != new[col].to_numpy()[existing]
+    removed = new_keys.get_indexer(prev_keys) < 0
+    counts = {'added': int((~existing).sum()), 'changed': int((changed & existing).sum()),
+              'removed': int(removed.sum())}
+
+    # Unchanged players are rebuilt in their earlier order, so those that moved relative to the rest go in the delta.
+    unchanged = np.flatnonzero(~changed)
+    changed[unchanged[~_increasing(pos[unchanged])]] = True
+
+    delta = pd.concat([new[changed], prev[removed]])
+    nchanged = changed.sum()
+    delta[REMOVED_COL] = np.arange(len(delta)) >= nchanged
+    delta[ROW_COL] = np.concatenate([np.flatnonzero(changed), np.full(len(delta) - nchanged, -1)])
+    return delta, counts
+
+
+def apply_delta(prev: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+    """ Rebuild a snapshot from the one before it and the delta between them. """
+
+    removed = delta[REMOVED_COL].to_numpy()
+    dropped = _keys(prev.index).isin(_keys(delta.index))
+    kept, updated = prev[~dropped], delta[~removed].drop(columns=REMOVED_COL)
+    if ROW_COL not in updated:
+        # Deltas of version 1 stores have no rows, and those snapshots were only ever compared by username.
+        players = pd.concat([kept, updated])
+        if 'total' in players:
+            players = players.iloc[np.argsort(-players['total'].to_numpy().astype('int64'), kind='stable')]
+        return players
+
+    # Players in the delta go back to their rows, and the rest fill the others in their earlier order.
+    rows = updated[ROW_COL].to_numpy()
+    order = np.empty(len(kept) + len(updated), dtype='int64')
+    free = np.ones(len(order), dtype='bool')
+    free[rows] = False
+    order[free] = np.arange(len(kept))
+    order[rows] = len(kept) + np.arange(len(updated))
+    return pd.concat([kept, updated.drop(columns=ROW_COL)]).iloc[order]
+
+
+class SnapshotStore:
+    """ Directory holding the history of the player stats dataset. The first
+    snapshot is stored in full and every later one as a delta of only the
+    players who were added, changed or removed since the snapshot before
+    it, so storage grows with churn rather than with the size of the
+    dataset. Every keyframe_interval snapshots one is stored in full
+    instead (a keyframe), so that loading a snapshot only replays the
+    deltas since the keyframe before it. Each file is an artifact indexed
+    by a name table, so one player's history is read without rebuilding
+    any snapshot. """
+
+    def __init__(self, directory: str, keyframe_interval: int = KEYFRAME_INTERVAL):
+        self.dir = directory
+        self.keyframe_interval = keyframe_interval
+        self._latest = None  # label and contents of the latest snapshot, once added or loaded
+        os.makedirs(directory, exist_ok=True)
+        manifest_file = os.path.join(directory, MANIFEST_FILE)
+        if os.path.isfile(manifest_file):
+            self.manifest = load_json(manifest_file)
+            if self.manifest['version'] > SNAPSHOTS_VERSION:
+                raise ValueError(f"snapshot store in {directory} has version {self.manifest['version']}, "
+                                 f"this code reads up to version {SNAPSHOTS_VERSION}")
+        else:
+            self.manifest = {'version': SNAPSHOTS_VERSION, 'snapshots': []}
+
+    @property
+    def labels(self) -> List[str]:
+        return [entry['label'] for entry in self.manifest['snapshots']]
+
+    def _path(self, entry: Dict) -> str:
+        return os.path.join(self.dir, entry['file'])
+
+    def _is_keyframe(self, i: int) -> bool:
+        return i == 0 or self.manifest['snapshots'][i].get('keyframe', False)
+
+    def _position(self, label: str) -> int:
+        if label not in self.labels:
+            raise ValueError(f"no snapshot labelled '{label}' in {self.dir}")
+        return self.labels.index(label)
+
+    def add(self, players: pd.DataFrame, label: str) -> Dict[str, int]:
+        """ Add a snapshot of player stats to the end of the history.
+
+        :param players: stats dataset, indexed by username
+        :param label: name for the snapshot (e.g. the date of the scrape)
+        :return: number of players who were added, changed and removed since the last snapshot
+        """
+        if label in self.labels:
+            raise ValueError(f"snapshot store already has a snapshot labelled '{label}'")
+        i = len(self.labels)
+        if i == 0:
+            entry = {'label': label, 'file': 'base.cols'}
+            dump_artifact(players, self._path(entry), index_label='username')
+            counts = {'added': len(players), 'changed': 0, 'removed': 0}
+        else:
+            prev = self._latest[1] if self._latest is not None and self._latest[0] == self.labels[-1] else self.load()
+            delta, counts = diff_snapshots(prev, players)
+            if i % self.keyframe_interval == 0:
+                entry = {'label': label, 'file': f'keyframe-{i:04d}.cols', 'keyframe': True}
+                dump_artifact(players, self._path(entry), index_label='username')
+            else:
+                entry = {'label': label, 'file': f'delta-{i:04d}.cols'}
+                dump_artifact(delta, self._path(entry), index_label='username')
+        entry.update(nrows=len(players), **counts)
+
+        # The manifest is replaced last, so a failed update leaves the store as it was.
+        self.manifest['snapshots'].append(entry)
+        self.manifest['version'] = SNAPSHOTS_VERSION
+        manifest_file = os.path.join(self.dir, MANIFEST_FILE)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(manifest_file + '.tmp', manifest_file)
+        self._latest = (label, players.copy())
+        return counts
+
+    def load(self, label: str = None) -> pd.DataFrame:
+        """ Rebuild a snapshot (the latest one by default) by applying deltas
+        to the keyframe before it. """
+
+        if not self.labels:
+            raise ValueError(f"snapshot store in {self.dir} is empty")
+        last = len(self.labels) - 1 if label is None else self._position(label)
+        entries = self.manifest['snapshots']
+        if self._latest is not None and self._latest[0] == entries[last]['label']:
+            return self._latest[1].copy()
+        first = max(i for i in range(last + 1) if self._is_keyframe(i))
+        players = load_artifact(self._path(entries[first]))
+        for entry in entries[first + 1:last + 1]:
+            players = apply_delta(players, load_artifact(self._path(entry)))
+        if last == len(entries) - 1:
+            self._latest = (entries[last]['label'], players.copy())
+        return players
+
+    def history(self, username: str) -> pd.DataFrame:
+        """ Get a player's stats in every snapshot they appear in, indexed by
+        snapshot label. The player is found by username ignoring case. """
+
+        rows, labels, current = [], [], None
+        columns, dtypes = None, None
+        for i, entry in enumerate(self.manifest['snapshots']):
+            row = load_names(self._path(entry)).find(username)
+            if row >= 0:
+                frame = load_artifact(self._path(entry), index=False)  # memory-mapped, so only one row is read
+                columns = [col for col in frame.columns if col not in (REMOVED_COL, ROW_COL)]
+                dtypes = frame[columns].dtypes
+                removed = REMOVED_COL in frame and frame[REMOVED_COL].to_numpy()[row]
+                current = None if removed else [frame[col].to_numpy()[row] for col in columns]
+            elif self._is_keyframe(i):
+                current = None
+            if current is not None:
+                rows.append(current)
+                labels.append(entry['label'])
+        if columns is None:
+            return pd.DataFrame(index=pd.Index([], name='snapshot'))
+        return pd.DataFrame(rows, columns=columns, index=pd.Index(labels, name='snapshot')).astype(dtypes)
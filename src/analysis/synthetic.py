@@ -0,0 +1,103 @@
+""" Synthetic player stats for benchmarking at any size of dataset. """
+
+import collections
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+
+from src.common import osrs_skills, level_dtype
+
+SYNTHETIC_CHUNK_ROWS = 1000000  # number of players generated at a time
+UNRANKED_BELOW = 15             # skills below this level are unranked (0), as they fall outside the hiscores
+
+# Share of players of each kind, roughly as seen in the hiscores.
+ARCHETYPES = collections.OrderedDict([
+    ('fresh', 0.15),    # a few hours in, most skills unranked
+    ('casual', 0.45),   # low to mid levels, trained unevenly
+    ('main', 0.30),     # mid to high levels across the board
+    ('pure', 0.07),     # high offensive combat stats with 1 defence and low prayer
+    ('maxed', 0.03)     # 99 in every skill
+])
+
+# Exponents bending a player's overall progress into each skill's level: above 1 for slow
+# skills that lag behind the rest, below 1 for fast ones that get ahead.
+SKILL_DIFFICULTY = {
+    'cooking': 0.7, 'firemaking': 0.7, 'woodcutting': 0.8, 'fletching': 0.8, 'fishing': 0.9,
+    'agility': 1.4, 'runecraft': 1.6, 'slayer': 1.3, 'hunter': 1.2, 'construction': 1.1,
+    'herblore': 1.2, 'thieving': 1.1, 'farming': 1.1
+}
+COMBAT_SKILLS = ['attack', 'defence', 'strength', 'hitpoints', 'ranged', 'prayer', 'magic']
+
+
+def _levels_chunk(rng: np.random.Generator, nrows: int, skills: list) -> Dict[str, NDArray]:
+    kinds = rng.choice(len(ARCHETYPES), size=nrows, p=list(ARCHETYPES.values()))
+    kind = {name: kinds == i for i, name in enumerate(ARCHETYPES)}
+
+    # Overall progress in [0, 1], drawn per kind of player.
+    progress = np.empty(nrows)
+    progress[kind['fresh']] = 0.25 * rng.beta(1, 6, kind['fresh'].sum())
+    progress[kind['casual']] = 0.75 * rng.beta(2, 3, kind['casual'].sum())
+    progress[kind['main']] = 0.55 + 0.45 * rng.beta(4, 2, kind['main'].sum())
+    progress[kind['pure']] = 0.6 * rng.beta(2, 3, kind['pure'].sum())
+    progress[kind['maxed']] = 1
+
+    # Noise shared between combat skills (trained together) and noise per skill, on a log scale.
+    combat_noise = rng.normal(0, 0.15, nrows)
+    levels = {}
+    for skill in skills:
+        noise = rng.normal(0, 0.2, nrows) + (combat_noise if skill in COMBAT_SKILLS else 0)
+        level = 1 + 98 * progress ** SKILL_DIFFICULTY.get(skill, 1.0) * np.exp(noise)
+        levels[skill] = np.clip(np.rint(level), 1, 99)
+
+    # Pures train attack to a few thresholds, strength and ranged high, and keep defence at 1.
+    npure = kind['pure'].sum()
+    pure_levels = {
+        'attack': rng.choice([40, 50, 60, 75], npure, p=[0.2, 0.2, 0.4, 0.2]),
+        'strength': rng.integers(80, 100, npure),
+        'defence': np.ones(npure),
+        'hitpoints': rng.integers(60, 95, npure),
+        'ranged': rng.integers(70, 100, npure),
+        'prayer': rng.choice([1, 13, 31, 44, 52], npure),
+        'magic': rng.integers(55, 100, npure)
+    }
+    for skill, values in pure_levels.items():
+        if skill in levels:
+            levels[skill][kind['pure']] = values
+    for skill in skills:
+        levels[skill][kind['maxed']] = 99
+    if 'hitpoints' in levels:
+        levels['hitpoints'] = np.maximum(levels['hitpoints'], 10)  # every account starts with 10 hitpoints
+    return levels
+
+
+def synthetic_players(nrows: int, seed: int = 0, names: bool = False) -> pd.DataFrame:
+    """ Generate a dataset of player stats like the one scraped from the
+    hiscores, for benchmarking at sizes other than that of the real one.
+    Players are a mix of kinds (fresh, casual, main, pure and maxed
+    accounts) whose levels follow an overall progress per player, with
+    skills differing in how fast they are trained, combat skills trained
+    together, and levels below UNRANKED_BELOW unranked (0). Like the real
+    dataset, players are sorted by total level descending.
+
+    :param nrows: number of players
+    :param seed: seed for the random generator, so a dataset can be generated again
+    :param names: if True, index players by made-up usernames (otherwise by rank from 0)
+    :return: DataFrame with a column for the total level and for each skill
+    """
+    skills = osrs_skills()
+    rng = np.random.default_rng(seed)
+    columns = {skill: np.empty(nrows, dtype=level_dtype(skill)) for skill in ['total'] + skills}
+    for start in range(0, nrows, SYNTHETIC_CHUNK_ROWS):
+        end = min(start + SYNTHETIC_CHUNK_ROWS, nrows)
+        levels = _levels_chunk(rng, end - start, skills)
+        columns['total'][start:end] = sum(levels.values())  # the total counts unranked skills too
+        for skill in skills:
+            columns[skill][start:end] = np.where(levels[skill] < UNRANKED_BELOW, 0, levels[skill])
+
+    order = np.argsort(-columns['total'].astype('int32'), kind='stable')
+    players = pd.DataFrame({name: values[order] for name, values in columns.items()}, copy=False)
+    if names:
+        players.index = pd.Index([f'player{i}' for i in range(nrows)], name='username')
+    return players
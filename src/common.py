@@ -1,14 +1,16 @@
 """ Shared definitions. """
 
 import json
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
-from io import BytesIO
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 
 import boto3
 import certifi
+from botocore.exceptions import BotoCoreError, ClientError
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from tqdm import TqdmWarning, tqdm
@@ -26,6 +28,13 @@ def osrs_skills(include_total: bool = False) -> List[str]:
     return skill_names
 
 
+def level_dtype(skill: str) -> str:
+    """ Get the dtype for storing levels in a skill. Total level goes up to
+    2277 so it needs 16 bits, while other skills fit in 8. """
+
+    return 'uint16' if skill == 'total' else 'uint8'
+
+
 @lru_cache()
 def csv_api_stats() -> List[str]:
     """ Load the list of header fields returned from the OSRS hiscores CSV API. """
@@ -37,26 +46,94 @@ def csv_api_stats() -> List[str]:
         return stat_names
 
 
-@lru_cache()
-def download_s3_obj(url: str) -> bytes:
-    """ Download an S3 object blob with progress bar. """
+S3_PART_BYTES = 8 * 1024 ** 2  # size of the byte ranges in which S3 objects are downloaded
+S3_DOWNLOAD_WORKERS = 8        # number of byte ranges downloaded at once
+S3_CACHE_DIR = os.getenv('OSRS_S3_CACHE_DIR', os.path.join(Path.home(), '.cache', 'osrs-hiscores', 's3'))
 
+
+def _split_s3_url(url: str) -> Tuple[str, str]:
     bucket, objkey = url.replace('s3://', '').split('/', maxsplit=1)
+    return bucket, objkey
+
+
+def s3_object_missing(error: Exception) -> bool:
+    """ Check whether an error from S3 means that the object doesn't exist. """
 
-    s3 = boto3.client('s3')
-    response = s3.head_object(Bucket=bucket, Key=objkey)
-    size = response['ContentLength']
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in ('404', 'NoSuchKey')
+
+
+def download_s3_file(url: str, file: str, num_workers: int = S3_DOWNLOAD_WORKERS) -> str:
+    """ Download an S3 object to a local file with progress bar. The object
+    is fetched as byte ranges in parallel, each streamed straight to its
+    place in the file. The object's ETag is kept next to the file, so an
+    up-to-date copy is not downloaded again. If S3 can't be reached (e.g.
+    there are no credentials), an existing copy is used as it is, but not if
+    the object is missing (see s3_object_missing()).
+
+    :param url: S3 URL of the object
+    :param file: write object to this file
+    :param num_workers: number of byte ranges to download at once
+    :return: path of the downloaded file
+    """
+    bucket, objkey = _split_s3_url(url)
+    s3 = boto3.client('s3')  # clients are safe to share between threads
+    try:
+        response = s3.head_object(Bucket=bucket, Key=objkey)
+    except (BotoCoreError, ClientError) as e:
+        if not os.path.isfile(file) or s3_object_missing(e):
+            raise
+        print(f"could not check s3://{bucket}/{objkey} ({e}), using existing copy {file}")
+        return file
+    size, etag = response['ContentLength'], response['ETag']
+
+    etag_file = f'{file}.etag'
+    if os.path.isfile(file) and os.path.isfile(etag_file) and os.path.getsize(file) == size:
+        with open(etag_file, 'r') as f:
+            if f.read() == etag:
+                return file
 
     print(f"downloading s3://{bucket}/{objkey}")
-    f = BytesIO()
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    part_file = f'{file}.part'
+    with open(part_file, 'wb') as f:
+        f.truncate(size)
 
     warnings.filterwarnings("ignore", category=TqdmWarning)  # supress warning from float iteration
-    with tqdm(total=size, unit='B', unit_scale=True) as pbar:
-        s3.download_fileobj(bucket, objkey, f,
-                            Callback=lambda n: pbar.update(n))
-
-    f.seek(0)  # put cursor back at beginning of file
-    return f.read()
+    fd = os.open(part_file, os.O_WRONLY)
+    try:
+        with tqdm(total=size, unit='B', unit_scale=True) as pbar:
+            def fetch(start: int):
+                end = min(start + S3_PART_BYTES, size) - 1
+                # IfMatch makes the download fail rather than mix ranges of two versions of the object.
+                body = s3.get_object(Bucket=bucket, Key=objkey, Range=f'bytes={start}-{end}', IfMatch=etag)['Body']
+                for block in body.iter_chunks(chunk_size=1024 ** 2):
+                    os.pwrite(fd, block, start)
+                    start += len(block)
+                    pbar.update(len(block))
+
+            with ThreadPoolExecutor(max(1, num_workers)) as executor:
+                list(executor.map(fetch, range(0, size, S3_PART_BYTES)))
+    finally:
+        os.close(fd)
+
+    os.replace(part_file, file)
+    with open(etag_file, 'w') as f:
+        f.write(etag)
+    return file
+
+
+def download_s3_obj(url: str, cache_dir: str = None, num_workers: int = S3_DOWNLOAD_WORKERS) -> str:
+    """ Get a local copy of an S3 object, downloading it into a disk cache
+    if the cached copy is missing or out of date. Consumers open or
+    memory-map the file rather than holding the object in memory.
+
+    :param url: S3 URL of the object
+    :param cache_dir: directory of cached objects (default is S3_CACHE_DIR)
+    :param num_workers: number of byte ranges to download at once
+    :return: path of the cached copy
+    """
+    bucket, objkey = _split_s3_url(url)
+    return download_s3_file(url, os.path.join(cache_dir or S3_CACHE_DIR, bucket, objkey), num_workers)
 
 
 def connect_mongo(url: str, collection: str = None) -> Collection:
@@ -0,0 +1,595 @@
+""" Code for cleaning up raw scraped data. """
+
+import collections
+import os
+import tempfile
+from io import BytesIO
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Tuple, OrderedDict
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+from tqdm import tqdm
+
+from src.common import osrs_skills, csv_api_stats, level_dtype
+from src.analysis.io import dump_columns, smallest_int_dtype, allocate_columns, chunk_rows, artifact_meta, \
+    frame_layout, ColumnFile
+from src.analysis.names import NameTable, hash_names, name_slots, probe_slots
+from src.scrape.common import recovered_file
+
+CHUNK_BYTES = 64 * 1024 ** 2  # size of the blocks in which a raw scrape file is read
+DEDUP_BATCH_ROWS = 1000000    # least number of parsed records merged into the deduplicated result at a time
+MAX_USERNAME_LEN = 12         # longest username allowed by the game
+FULL_STATS_SPARE = 0.125      # spare rows left in a full stats file for players added by merges, as a fraction of its rows
+FULL_STATS_MIN_SPARE = 1024   # least number of spare rows left in a full stats file
+
+
+def raw_byte_ranges(in_file: str, chunk_bytes: int = CHUNK_BYTES) -> List[Tuple[int, int]]:
+    """ Split the records in a raw scrape file into byte ranges of roughly
+    the given size, each of which starts and ends on a line boundary. """
+
+    size = os.path.getsize(in_file)
+    ranges = []
+    with open(in_file, 'rb') as f:
+        f.readline()  # skip header
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()  # advance to the end of the current line
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def raw_file_ranges(in_file: str, chunk_bytes: int = CHUNK_BYTES) -> List[Tuple[str, int, int]]:
+    """ Split a raw scrape file into byte ranges (see raw_byte_ranges()),
+    followed by those of its sidecar of recovered records if it has one, so
+    that records recovered by retry sweeps are cleaned along with the rest. """
+
+    ranges = [(in_file, start, end) for start, end in raw_byte_ranges(in_file, chunk_bytes)]
+    sidecar = recovered_file(in_file)
+    if os.path.isfile(sidecar):
+        ranges += [(sidecar, start, end) for start, end in raw_byte_ranges(sidecar, chunk_bytes)]
+    return ranges
+
+
+def parse_byte_range(in_file: str, start: int, end: int,
+                     full_stats: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """ Parse and deduplicate the records in one byte range of a raw scrape
+    file, setting aside any which fail validation. """
+
+    with open(in_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    players, rejects = parse_raw_chunk(data, full_stats, offset=start)
+    rejects.insert(0, 'file', os.path.basename(in_file))
+    return dedup_players(players), rejects
+
+
+def stat_dtype(stat: str) -> str:
+    """ Get a dtype wide enough for any value of a stat from the CSV API. """
+
+    if stat == 'total_xp':
+        return 'int64'
+    if stat.endswith('_level'):
+        return 'int16'
+    return 'int32'
+
+
+def stat_range(stat: str) -> Tuple[int, int]:
+    """ Get the range of valid values for a stat from the CSV API. Missing
+    data (-1 or an empty field) is always allowed. """
+
+    if stat == 'total_level':
+        return 1, 2277
+    if stat == 'total_xp':
+        return 0, 23 * 200_000_000
+    if stat.endswith('_level'):
+        return 1, 99
+    if stat.endswith('_xp'):
+        return 0, 200_000_000
+    if stat.endswith('_rank'):
+        return 1, np.iinfo('int32').max
+    return 0, np.iinfo('int32').max
+
+
+def split_bad_lines(data: bytes, nfields: int) -> Tuple[bytes, NDArray, NDArray, List[Tuple[int, str]]]:
+    """ Remove lines which are empty or have the wrong number of fields from
+    a block of CSV data. Field separators are counted for every line at once.
+
+    :return: the remaining data, start and end offsets of each remaining line,
+        and an (offset, reason) pair for each line that was removed
+    """
+    buf = np.frombuffer(data, dtype='uint8')
+    ends = np.flatnonzero(buf == ord('\n'))
+    if len(buf) and buf[-1] != ord('\n'):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype('int64')
+    commas = np.flatnonzero(buf == ord(','))
+    counts = np.searchsorted(commas, ends) - np.searchsorted(commas, starts) + 1
+    empty = starts == ends
+    bad = np.flatnonzero(empty | (counts != nfields))
+    if not len(bad):
+        return data, starts, ends, []
+
+    rejects = [(int(starts[i]), 'empty line' if empty[i] else f"expected {nfields} fields, found {counts[i]}")
+               for i in bad]
+    pieces, pos = [], 0
+    for i in bad:
+        pieces.append(data[pos:starts[i]])
+        pos = ends[i] + 1
+    pieces.append(data[pos:])
+    good = np.ones(len(starts), dtype='bool')
+    good[bad] = False
+    return b''.join(pieces), starts[good], ends[good], rejects
+
+
+def validate_raw_fields(raw: pd.DataFrame) -> NDArray:
+    """ Check the values in a table of raw records, one column at a time.
+    Columns which failed to parse as numbers are coerced in place.
+
+    :return: reason for rejecting each record, or None if it is valid
+    """
+    reasons = np.full(len(raw), None, dtype=object)
+
+    def reject(mask, reason):
+        reasons[mask & ~reasons.astype(bool)] = reason  # keep the first reason found
+
+    usernames = raw['username'].fillna('')
+    reject(((usernames.str.len() == 0) | (usernames.str.len() > MAX_USERNAME_LEN)).to_numpy(), "invalid username")
+
+    for stat in [c for c in raw.columns if c not in ('username', 'ts')]:
+        values = raw[stat]
+        if not pd.api.types.is_numeric_dtype(values):
+            numeric = pd.to_numeric(values, errors='coerce')
+            reject((numeric.isna() & values.notna()).to_numpy(), f"non-numeric {stat}")
+            values = raw[stat] = numeric
+        values = values.to_numpy(dtype='float64')
+        lo, hi = stat_range(stat)
+        present = ~np.isnan(values) & (values != -1)
+        reject(present & (values != np.floor(values)), f"non-integer {stat}")
+        reject(present & ((values < lo) | (values > hi)), f"{stat} out of range")
+
+    ts = raw['ts'].fillna('')
+    iso = r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{1,6})?'
+    valid_ts = np.array(ts.str.fullmatch(iso), dtype='bool')
+    try:
+        np.array(ts[valid_ts].to_numpy(dtype=str), dtype='datetime64[us]')
+    except ValueError:  # well-formed but impossible date somewhere, find it
+        for i in np.flatnonzero(valid_ts):
+            try:
+                np.datetime64(ts.iloc[i])
+            except ValueError:
+                valid_ts[i] = False
+    reject(~valid_ts, "invalid timestamp")
+    return reasons
+
+
+def parse_raw_chunk(data: bytes, full_stats: bool = False, offset: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """ Parse a block of lines from a raw scrape file into a table of typed
+    columns. The result has a column for username, rank, total xp and
+    timestamp, plus a column of levels for each skill (including total level)
+    where 0 means the player is unranked in that skill. If full_stats is set,
+    it also has a column for every stat from the CSV API, named as in the
+    raw file and with -1 for missing data.
+
+    Records which fail validation are left out and returned in a second
+    table, with their byte offset in the file (given the offset of the
+    block), the reason they were rejected and the original line.
+    """
+    skills = osrs_skills(include_total=True)
+    header = ['username'] + csv_api_stats() + ['ts']
+    usecols = ['username', 'total_rank', 'total_xp', 'ts'] + [f'{s}_level' for s in skills]
+    if full_stats:
+        usecols = header
+
+    rejects = []
+    good_data, starts, ends, bad_lines = split_bad_lines(data, nfields=len(header))
+    for line_offset, reason in bad_lines:
+        end = data.find(b'\n', line_offset)
+        rejects.append((offset + line_offset, reason, data[line_offset:end if end >= 0 else None]))
+
+    if good_data.strip():
+        # Only empty fields count as missing so that usernames like 'null' survive.
+        raw = pd.read_csv(BytesIO(good_data), header=None, names=header, usecols=usecols, quoting=3,
+                          dtype={'username': str, 'ts': str}, keep_default_na=False, na_values=[''])
+    else:
+        raw = pd.DataFrame(columns=usecols)
+
+    reasons = validate_raw_fields(raw)
+    invalid = np.flatnonzero(reasons.astype(bool))
+    for i in invalid:
+        rejects.append((offset + int(starts[i]), reasons[i], data[starts[i]:ends[i]]))
+    if len(invalid):
+        raw = raw.drop(raw.index[invalid])
+
+    chunk = pd.DataFrame({
+        'username': raw['username'].to_numpy(dtype=object),
+        'rank': raw['total_rank'].fillna(-1).to_numpy(dtype='int64'),
+        'total_xp': raw['total_xp'].fillna(-1).to_numpy(dtype='int64'),
+        'ts': np.array(raw['ts'].to_numpy(dtype=str), dtype='datetime64[us]'),
+    })
+    levels = raw[[f'{s}_level' for s in skills]].fillna(0).to_numpy()
+    levels[levels < 0] = 0  # missing data
+    for i, skill in enumerate(skills):
+        chunk[skill] = levels[:, i].astype(level_dtype(skill))
+    if full_stats:
+        stats = pd.DataFrame({stat: raw[stat].fillna(-1).to_numpy().astype(stat_dtype(stat))
+                              for stat in csv_api_stats() if stat not in chunk})
+        chunk = pd.concat([chunk, stats], axis=1)
+
+    rejects = pd.DataFrame(sorted(rejects), columns=['offset', 'reason', 'line'])
+    rejects['line'] = [line.decode('utf-8', errors='replace').rstrip('\r') for line in rejects['line']]
+    return chunk, rejects
+
+
+def dedup_players(players: pd.DataFrame, keys: pd.DataFrame = None) -> pd.DataFrame:
+    """ Drop records whose usernames match (ignoring case) an earlier one,
+    keeping the record with the latest timestamp. Ties go to the record which
+    appears first. Players may instead be identified by other columns of
+    keys, given for the same rows. """
+
+    keys = players['username'].str.lower() if keys is None else keys
+    order = np.argsort(-players['ts'].to_numpy().astype('int64'), kind='stable')
+    keep = np.zeros(len(players), dtype='bool')
+    keep[order[~keys.iloc[order].duplicated(keep='first').to_numpy()]] = True
+    return players[keep]
+
+
+def sort_players(players: pd.DataFrame) -> pd.DataFrame:
+    """ Sort players from best to worst by total level, then by total xp,
+    then by original rank. """
+
+    order = np.lexsort((-players['rank'].to_numpy(),
+                        players['total_xp'].to_numpy(),
+                        players['total'].to_numpy()))[::-1]
+    return players.iloc[order]
+
+
+def _parse_byte_range(args):
+    return parse_byte_range(*args)
+
+
+def _sort_key(total_level: NDArray, total_xp: NDArray) -> NDArray:
+    """ Pack total level and total xp into one integer which sorts players
+    from best to worst when taken in ascending order. """
+
+    return -(np.maximum(total_level, 0).astype('int64') * 2 ** 34 + total_xp.astype('int64') + 1)
+
+
+def _allocate_full_stats(file: str, dtypes: Dict[str, np.dtype], hashes: NDArray) -> ColumnFile:
+    """ Create a full stats column file for players in rank order, given the
+    hashes of their usernames (see hash_names()), to be filled in with their
+    usernames, stats and timestamps. Rows are stored in the
+    order players were added, with spare rows at the end for players added
+    later. The number of rows in use, the rows in rank order and a hash
+    index of usernames are columns of their own, so merges update them in
+    place. """
+
+    nrows = len(hashes)
+    capacity = nrows + max(FULL_STATS_MIN_SPARE, int(nrows * FULL_STATS_SPARE))
+    slots = name_slots(hashes, capacity)
+    layout = collections.OrderedDict([('nrows', ('int64', (1,))),
+                                      ('order', ('int64', (capacity,))),
+                                      ('username', (f'U{MAX_USERNAME_LEN}', (capacity,)))])
+    layout.update((stat, (dtypes[stat], (capacity,))) for stat in csv_api_stats())
+    layout['ts'] = ('datetime64[us]', (capacity,))
+    layout['slots'] = (slots.dtype, slots.shape)
+
+    out = allocate_columns(layout, file)
+    out.memmap('nrows', 'r+')[0] = nrows
+    out.memmap('slots', 'r+')[:] = slots
+    if nrows:
+        out.memmap('order', 'r+')[:nrows] = np.arange(nrows)
+    return out
+
+
+def dump_full_stats(players: pd.DataFrame, file: str):
+    """ Write the username, timestamp and every CSV API stat for a table of
+    players (parsed with full_stats set) in rank order to a column file. Each
+    stat is stored with the smallest integer dtype that holds all of its
+    values. The file has room for more players, so that later scrapes can be
+    merged into it in place by merge_full_stats(). """
+
+    dtypes = {stat: smallest_int_dtype(players[stat].to_numpy()) for stat in csv_api_stats()}
+    out = _allocate_full_stats(file, dtypes, hash_names(players['username']))
+    if len(players):
+        for col in ['username'] + csv_api_stats() + ['ts']:
+            out.memmap(col, 'r+')[:len(players)] = players[col].to_numpy()
+
+
+def load_full_stats(file: str, columns: List[str] = None) -> OrderedDict[str, NDArray]:
+    """ Read the columns of a full stats file (all of them by default) in rank order. """
+
+    stats = ColumnFile(file)
+    order = stats['order'][:int(stats['nrows'][0])]
+    columns = columns or ['username'] + csv_api_stats() + ['ts']
+    return collections.OrderedDict((col, stats[col][order]) for col in columns)
+
+
+def _search_order(order: NDArray, stats: ColumnFile, key: NDArray, rank: NDArray) -> NDArray:
+    """ Find where players with the given sort keys and ranks go among the
+    rows of a full stats file in rank order, by a binary search for all of
+    them at once which reads only the rows it compares against. """
+
+    lo, hi = np.zeros(len(key), dtype='int64'), np.full(len(key), len(order), dtype='int64')
+    while np.any(lo < hi):
+        mid = (lo + hi) // 2
+        rows = order[np.minimum(mid, len(order) - 1)]
+        mid_key = _sort_key(stats['total_level'][rows], stats['total_xp'][rows])
+        mid_rank = stats['total_rank'][rows]
+        before = (lo < hi) & ((mid_key < key) | ((mid_key == key) & (mid_rank < rank)))
+        lo, hi = np.where(before, mid + 1, lo), np.where(before | (lo >= hi), hi, mid)
+    return lo
+
+
+def merge_full_stats(file: str, delta: pd.DataFrame) -> Dict[str, int]:
+    """ Merge newly scraped records into a full stats file written by
+    dump_full_stats(), in place. A new record replaces an existing one for
+    the same username only if it has a later timestamp. Existing players are
+    found through the file's hash index of usernames, replaced records are
+    overwritten in their rows, new players are written to spare rows at the
+    end, and the players affected are placed in rank order by a binary
+    search, so only the rows of the new records and the permutation giving
+    rank order are written. If the file has no room left or a value doesn't
+    fit the dtype of its column, the merged dataset is written out in full.
+
+    Known limitation: the permutation is a single array, so a merge still
+    takes O(n) time and memory to read it and insert into it, and rewrites
+    it from the first position that changed (i.e. from the best ranked
+    player affected) to the end. That is 8 bytes per player rather than a
+    whole record, but it isn't proportional to the size of the merge.
+
+    :param file: full stats column file
+    :param delta: new records, parsed with full_stats set
+    :return: number of players added and replaced, and of records ignored because they were older
+    """
+    delta = sort_players(dedup_players(delta))
+    stats = ColumnFile(file)
+    nrows, capacity = int(stats['nrows'][0]), len(stats['order'])
+    usernames, slots = stats['username'], stats.memmap('slots', 'r+')
+    rows = np.array([probe_slots(slots, name, usernames.__getitem__)[0] for name in delta['username']],
+                    dtype='int64')
+
+    # Drop new records which are older than the existing record for that player.
+    matched = rows >= 0
+    newer = np.ones(len(delta), dtype='bool')
+    newer[matched] = delta['ts'].to_numpy()[matched] > stats['ts'][rows[matched]]
+    counts = {'added': int((~matched).sum()), 'replaced': int((matched & newer).sum()),
+              'ignored': int((~newer).sum())}
+    delta, rows, matched = delta[newer], rows[newer], matched[newer]
+
+    fits = nrows + counts['added'] <= capacity and all(
+        np.can_cast(smallest_int_dtype(delta[stat].to_numpy()), stats.schema[stat]['dtype'])
+        for stat in csv_api_stats())
+    if not fits:
+        print(f"no room to merge in place, rewriting {file}...")
+        prev = pd.DataFrame(load_full_stats(file))
+        prev['rank'], prev['total'] = prev['total_rank'], prev['total_level']
+        players = dedup_players(pd.concat([prev, delta[prev.columns]], ignore_index=True))
+        del prev, stats, usernames, slots
+        dump_full_stats(sort_players(players), file)
+        return counts
+
+    # Take the replaced players out of rank order and find where every new record goes.
+    order = np.array(stats['order'][:nrows])
+    replaced = np.zeros(capacity, dtype='bool')
+    replaced[rows[matched]] = True
+    kept = ~replaced[order]
+    first = nrows if kept.all() else int(np.argmin(kept))  # rank order is unchanged before this position
+    order = order[kept]
+    pos = _search_order(order, stats, _sort_key(delta['total'].to_numpy(), delta['total_xp'].to_numpy()),
+                        delta['rank'].to_numpy())
+
+    # New players go in spare rows, and are added to the index one at a time so that they probe past each other.
+    rows[~matched] = nrows + np.arange(counts['added'])
+    for name, row in zip(delta['username'][~matched], rows[~matched]):
+        _, slot = probe_slots(slots, name, usernames.__getitem__)
+        slots[slot] = row
+    for col in ['username'] + csv_api_stats() + ['ts']:
+        dest = stats.memmap(col, 'r+')
+        dest[rows] = delta[col].to_numpy()
+        dest.flush()
+    order = np.insert(order, pos, rows)
+    if len(pos):
+        first = min(first, int(pos.min()))
+    stats.memmap('order', 'r+')[first:len(order)] = order[first:]
+    stats.memmap('nrows', 'r+')[0] = len(order)
+    slots.flush()
+    return counts
+
+
+def full_stats_to_levels(columns: OrderedDict[str, NDArray]) -> pd.DataFrame:
+    """ Build the cleaned skill levels dataset from a set of full stats columns in rank order. """
+
+    skills = osrs_skills(include_total=True)
+    levels = collections.OrderedDict()
+    for skill in skills:
+        values = np.asarray(columns[f'{skill}_level'])
+        levels[skill] = np.where(values < 0, 0, values).astype(level_dtype(skill))  # negative means missing
+    return pd.DataFrame(levels, index=np.asarray(columns['username']).astype(object))
+
+
+def _iter_byte_ranges(ranges: List[Tuple[str, int, int]], num_workers: int = 1,
+                      full_stats: bool = False) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """ Parse byte ranges of raw scrape files, in parallel across worker
+    processes if more than one is requested, yielding the records and rejects
+    from each range in file order. """
+
+    tasks = [(file, start, end, full_stats) for file, start, end in ranges]
+    with tqdm(total=sum(end - start for _, start, end in ranges), unit='B', unit_scale=True) as pbar:
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                for (_, start, end), result in zip(ranges, pool.imap(_parse_byte_range, tasks)):
+                    pbar.update(end - start)
+                    yield result
+        else:
+            for (_, start, end), task in zip(ranges, tasks):
+                result = _parse_byte_range(task)
+                pbar.update(end - start)
+                yield result
+
+
+def _report_rejects(rejects: List[pd.DataFrame], quarantine_file: str = None):
+    if rejects:
+        rejects = pd.concat(rejects, ignore_index=True)
+    else:
+        rejects = pd.DataFrame(columns=['file', 'offset', 'reason', 'line'])
+    if len(rejects):
+        print(f"rejected {len(rejects)} malformed records")
+    if quarantine_file is not None:
+        rejects.to_csv(quarantine_file, index=False)
+        print(f"wrote rejected records to {quarantine_file}")
+
+
+def read_raw_players(in_file: str, chunk_bytes: int = CHUNK_BYTES, num_workers: int = 1,
+                     full_stats: bool = False, quarantine_file: str = None) -> pd.DataFrame:
+    """ Parse every record in a raw scrape file, including any records in its
+    sidecar of recovered records (see raw_file_ranges()), and deduplicate
+    them. The file is split into byte ranges which are parsed and
+    deduplicated independently, in parallel across worker processes if more
+    than one is requested. Parsed ranges are merged into the result as they
+    arrive, keeping only the latest record for each username, so peak memory
+    is bounded by the size of the deduplicated dataset plus a batch of
+    ranges rather than by the size of the file.
+
+    :param in_file: raw CSV file from scraping process
+    :param chunk_bytes: approximate size of the byte range handled by each task
+    :param num_workers: number of processes to parse with
+    :param full_stats: if set, keep every stat rather than skill levels only
+    :param quarantine_file: if provided, write records which fail validation to this CSV file
+    :return: table of parsed records, deduplicated as by dedup_players()
+    """
+    players, _ = parse_raw_chunk(b'', full_stats)
+    pending: List[pd.DataFrame] = []
+    npending = 0
+    rejects: List[pd.DataFrame] = []
+    ranges = raw_file_ranges(in_file, chunk_bytes)
+    for chunk, bad in _iter_byte_ranges(ranges, num_workers, full_stats):
+        pending.append(chunk)
+        npending += len(chunk)
+        if len(bad):
+            rejects.append(bad)
+
+        # Merging costs time in proportion to the rows kept so far, so it is
+        # put off until at least as many rows are waiting to be merged.
+        if npending >= max(len(players), DEDUP_BATCH_ROWS):
+            players = dedup_players(pd.concat([players] + pending, ignore_index=True))
+            pending, npending = [], 0
+    _report_rejects(rejects, quarantine_file)
+
+    return dedup_players(pd.concat([players] + pending, ignore_index=True)).reset_index(drop=True)
+
+
+def _gather_columns(out: ColumnFile, sources: Dict[str, NDArray], order: NDArray, memory_budget: int):
+    """ Fill columns of a preallocated column file with rows taken from
+    (possibly memory-mapped) source arrays in the given order, a chunk of
+    rows at a time. """
+
+    for name, src in sources.items():
+        if not len(order):
+            continue
+        dest = out.memmap(name, 'r+')
+        rows = chunk_rows(memory_budget, src.dtype.itemsize + order.dtype.itemsize)
+        for i in range(0, len(order), rows):
+            chunk = order[i:i + rows]
+            dest[i:i + len(chunk)] = src[chunk]
+        dest.flush()
+        del dest
+
+
+def clean_out_of_core(in_file: str, out_file: str, memory_budget: int, num_workers: int = 1,
+                      full_stats_file: str = None, quarantine_file: str = None):
+    """ Clean a raw scrape file without holding the parsed dataset in memory.
+    Only the fields needed to deduplicate and sort records are kept in
+    memory, with usernames reduced to a hash; every other column (usernames
+    included) is spilled to a scratch file as it is parsed, then gathered
+    into sorted order a chunk at a time.
+
+    :param in_file: raw CSV file from scraping process
+    :param out_file: write cleaned dataset to this file, in the same format as the in-memory path
+    :param memory_budget: approximate number of bytes of memory to work within
+    :param num_workers: number of processes to parse with
+    :param full_stats_file: if provided, also write all stats to this column file
+    :param quarantine_file: if provided, write records which fail validation to this CSV file
+    """
+    full_stats = full_stats_file is not None
+    skills = osrs_skills(include_total=True)
+    key_cols = ['rank', 'total_xp', 'ts', 'total']
+    empty, _ = parse_raw_chunk(b'', full_stats)
+    spill_cols = [col for col in empty.columns if col not in key_cols]
+    spill_dtypes = {col: empty[col].dtype for col in spill_cols}
+    spill_dtypes['username'] = np.dtype(f'U{MAX_USERNAME_LEN}')
+    chunk_bytes = max(1024 ** 2, memory_budget // (8 * max(1, num_workers)))
+
+    scratch_dir = os.path.dirname(os.path.abspath(out_file))
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp_dir:
+        keys: List[pd.DataFrame] = [empty[key_cols].assign(key=np.zeros(0, dtype='uint64'))]
+        rejects: List[pd.DataFrame] = []
+        bounds = {col: (0, 0) for col in spill_cols}
+        spill_files = {col: os.path.join(tmp_dir, f'{i}.bin') for i, col in enumerate(spill_cols)}
+        spills = {col: open(file, 'wb') for col, file in spill_files.items()}
+        try:
+            ranges = raw_file_ranges(in_file, chunk_bytes)
+            for chunk, bad in _iter_byte_ranges(ranges, num_workers, full_stats):
+                keys.append(chunk[key_cols].assign(key=hash_names(chunk['username'])))
+                rejects.append(bad)
+                for col in spill_cols:
+                    values = chunk[col].to_numpy(dtype=spill_dtypes[col])
+                    spills[col].write(np.ascontiguousarray(values).data)
+                    if len(values) and col != 'username':
+                        lo, hi = bounds[col]
+                        bounds[col] = (min(lo, int(values.min())), max(hi, int(values.max())))
+        finally:
+            for f in spills.values():
+                f.close()
+        _report_rejects(rejects, quarantine_file)
+
+        keys = pd.concat(keys, ignore_index=True)
+        nparsed = len(keys)
+        sources = collections.OrderedDict()
+        for col in spill_cols:
+            if nparsed:
+                sources[col] = np.memmap(spill_files[col], dtype=spill_dtypes[col], mode='r', shape=(nparsed,))
+            else:
+                sources[col] = np.empty(0, dtype=spill_dtypes[col])
+        for col in key_cols:
+            sources[col] = keys[col].to_numpy()
+
+        # Only row positions are carried through dedup and sort. Players are
+        # identified by the hash of their username, and the few rows whose
+        # hashes are shared are told apart by reading their usernames back.
+        print("deduplicating...")
+        _, inverse, counts = np.unique(keys['key'].to_numpy(), return_inverse=True, return_counts=True)
+        shared = np.flatnonzero(counts[inverse] > 1)
+        keys['name'] = 0
+        if len(shared):
+            keys.loc[shared, 'name'] = pd.factorize(pd.Series(sources['username'][shared]).str.lower())[0]
+        keys = dedup_players(keys, keys[['key', 'name']])
+        print("sorting...")
+        keys = sort_players(keys)
+        order, hashes = keys.index.to_numpy(), keys['key'].to_numpy()
+        nrows = len(order)
+        rows = chunk_rows(memory_budget, spill_dtypes['username'].itemsize)
+        names = NameTable.build(name for i in range(0, nrows, rows)
+                                for name in sources['username'][order[i:i + rows]]).to_columns('username')
+
+        layout = collections.OrderedDict((name, (values.dtype, values.shape)) for name, values in names.items())
+        layout.update((col, (sources[col].dtype, (nrows,))) for col in skills)
+        meta = artifact_meta(frame_layout(skills, nrows, index='username', index_format='names'))
+        out = allocate_columns(layout, out_file, meta=meta)
+        for name, values in names.items():
+            if values.size:
+                out.memmap(name, 'r+')[:] = values
+        _gather_columns(out, {col: sources[col] for col in skills}, order, memory_budget)
+        print(f"wrote results to {out_file}")
+
+        if full_stats:
+            bounds['total_xp'] = (int(sources['total_xp'].min(initial=0)), int(sources['total_xp'].max(initial=0)))
+            dtypes = {stat: smallest_int_dtype(np.array(bounds[stat])) for stat in csv_api_stats()}
+            out = _allocate_full_stats(full_stats_file, dtypes, hashes)
+            cols = ['username'] + csv_api_stats() + ['ts']
+            _gather_columns(out, {col: sources[col] for col in cols}, order, memory_budget)
+            print(f"wrote full stats to {full_stats_file}")
@@ -1,7 +1,8 @@
 """ Shared classes for the scraping process. """
 
+import os
 from datetime import datetime
-from typing import List
+from typing import List, Dict, Iterator, Tuple
 
 import numpy as np
 
@@ -68,3 +69,41 @@ class PlayerRecord:
 
     def __le__(self, other):
         return not other < self
+
+
+class RetryList:
+    """ Persistent list of players whose stats could not be fetched while
+    scraping. Each line of the backing file is a (rank, username) pair. """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.players: Dict[str, int] = {}  # mapping from usernames to ranks
+        if os.path.isfile(file):
+            with open(file, 'r') as f:
+                for line in f:
+                    rank, username = line.rstrip('\n').split(',', maxsplit=1)
+                    self.players[username] = int(rank)
+
+    def add(self, rank: int, username: str):
+        self.players[username] = rank
+        with open(self.file, 'a') as f:
+            f.write(f"{rank},{username}\n")
+
+    def remove(self, usernames: List[str]):
+        for username in usernames:
+            self.players.pop(username, None)
+        with open(self.file, 'w') as f:
+            for rank, username in self:
+                f.write(f"{rank},{username}\n")
+
+    def __len__(self):
+        return len(self.players)
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        return iter(sorted((rank, username) for username, rank in self.players.items()))
+
+
+def recovered_file(scrape_file: str) -> str:
+    """ Get the name of the sidecar file holding records recovered by retry
+    sweeps, which are merged with the scrape file when it is cleaned. """
+    return f"{scrape_file}.recovered"
@@ -4,31 +4,124 @@ import asyncio
 import csv
 import os
 from datetime import datetime
-from typing import List
+from typing import List, Tuple
 
 from tqdm import tqdm
 
 from src.common import csv_api_stats
-from src.scrape.common import DoneScraping, PlayerRecord
+from src.scrape.common import DoneScraping, PlayerRecord, recovered_file
 from src.scrape.workers import PageJob
 
 
-async def export_records(in_queue: asyncio.Queue, out_file: str, total: int):
-    """ Write player records appearing on a queue to a CSV file. """
+INDEX_BLOCK_SIZE = 10000  # number of ranks covered by each entry in a scrape file's rank index
+
+
+class RankIndex:
+    """ Sidecar index for a scrape file which maps blocks of ranks to byte
+    offsets. Each line of the index file is a (rank, offset) pair giving the
+    first rank written in a block and the position of its record in the file,
+    so that any range of ranks can be read without scanning the whole file.
+    """
+    def __init__(self, scrape_file: str, block_size: int = INDEX_BLOCK_SIZE):
+        self.file = f"{scrape_file}.idx"
+        self.block_size = block_size
+        self.entries: List[Tuple[int, int]] = []
+        if os.path.isfile(self.file):
+            with open(self.file, 'r') as f:
+                for line in f:
+                    rank, offset = line.split(',')
+                    self.entries.append((int(rank), int(offset)))
+
+    def add(self, rank: int, offset: int):
+        """ Record the offset for a rank if it is the first one seen in its block. """
+
+        if self.entries and (rank - 1) // self.block_size <= (self.entries[-1][0] - 1) // self.block_size:
+            return
+        self.entries.append((rank, offset))
+        with open(self.file, 'a') as f:
+            f.write(f"{rank},{offset}\n")
+
+    def seek_offset(self, rank: int) -> int:
+        """ Get the offset of the latest indexed record at or before the given rank. """
+
+        offset = None
+        for indexed_rank, indexed_offset in self.entries:
+            if indexed_rank > rank:
+                break
+            offset = indexed_offset
+        return offset
+
+    def partitions(self, ranks_per_part: int) -> List[Tuple[int, int]]:
+        """ Split the indexed part of the scrape file into byte ranges, each
+        starting on a record boundary and covering at least the given number
+        of ranks (the last range extends to the end of the file). """
+
+        starts = []
+        for rank, offset in self.entries:
+            if not starts or rank - starts[-1][0] >= ranks_per_part:
+                starts.append((rank, offset))
+        bounds = [offset for _, offset in starts] + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+async def export_records(in_queue: asyncio.Queue, out_file: str, total: int,
+                         index_block_size: int = INDEX_BLOCK_SIZE):
+    """ Write player records appearing on a queue to a CSV file. The byte offset
+    of each block of ranks is recorded in a sidecar index alongside the file. """
 
     exists = os.path.isfile(out_file)
+    index = RankIndex(out_file, block_size=index_block_size)
     with open(out_file, mode='w' if not exists else 'a') as f:
         if not exists:
             csv_header = ['username'] + csv_api_stats() + ['ts']
             csv.writer(f).writerow(csv_header)
+        offset = f.tell()
 
         for _ in tqdm(range(total), smoothing=0.01):
             player: PlayerRecord = await in_queue.get()
             if player is not None:
-                f.write(player_to_csv(player) + '\n')
+                line = player_to_csv(player) + '\n'
+                index.add(player.rank, offset)
+                f.write(line)
+                offset += len(line.encode('utf-8'))
         raise DoneScraping
 
 
+def read_rank_range(scrape_file: str, start_rank: int, end_rank: int) -> List[str]:
+    """ Read the CSV lines for a range of ranks from a scrape file, seeking
+    directly to the right block if the file has a rank index. """
+
+    offset = RankIndex(scrape_file).seek_offset(start_rank)
+    lines = []
+    with open(scrape_file, 'r') as f:
+        if offset is None:
+            f.readline()  # discard header
+        else:
+            f.seek(offset)
+        for line in f:
+            rank = int(line.split(',', maxsplit=2)[1])
+            if rank > end_rank:
+                break
+            if rank >= start_rank:
+                lines.append(line.rstrip('\n'))
+    return lines
+
+
+def export_recovered(scrape_file: str, players: List[PlayerRecord]):
+    """ Append records recovered by a retry sweep to the sidecar of a scrape
+    file (see recovered_file()), in rank order. The scrape file itself is
+    left as it is, and the records are merged into the dataset when it is
+    cleaned, so the cost of a sweep is proportional to what it recovered. """
+
+    file = recovered_file(scrape_file)
+    exists = os.path.isfile(file)
+    with open(file, mode='a' if exists else 'w') as f:
+        if not exists:
+            csv.writer(f).writerow(['username'] + csv_api_stats() + ['ts'])
+        for player in sorted(players, key=lambda p: p.rank):
+            f.write(player_to_csv(player) + '\n')
+
+
 def get_top_rank(scrape_file) -> int:
     """ Get the highest rank so far in the CSV file created by scraping. """
 
@@ -8,10 +8,15 @@ from typing import List, Tuple, Callable
 
 from aiohttp import ClientSession
 
-from src.scrape.common import RequestFailed, UserNotFound, ServerBusy, PlayerRecord
+from src.scrape.common import RequestFailed, UserNotFound, ServerBusy, PlayerRecord, RetryList
 from src.scrape.requests import get_hiscores_page, get_player_stats
 
 
+STATS_MAX_TRIES = 3     # attempts at a stats request before the player is put on the retry list
+RETRY_DELAY = 1.0       # seconds to wait before retrying a busy stats request, doubled on each retry
+RETRY_DELAY_MAX = 30.0  # longest wait between retries of a stats request
+
+
 @dataclass(order=True)
 class PageJob:
     """ Represents the task of fetching a front page from the OSRS hiscores, parsing
@@ -112,7 +117,7 @@ async def enqueue_page_usernames(queue: Queue, job: PageJob):
         job.startind += 1
 
 
-async def request_stats(sess: ClientSession, job: UsernameJob):
+async def request_stats(sess: ClientSession, job: UsernameJob, retries: RetryList = None):
     ntries = 0
     while True:
         try:
@@ -123,11 +128,50 @@ async def request_stats(sess: ClientSession, job: UsernameJob):
             break
         except ServerBusy as e:
             ntries += 1
-            if ntries < 3:
-                raise RequestFailed(f"player '{job.username}' (rank {job.priority}): {e}")
+            if ntries < STATS_MAX_TRIES:
+                delay = min(RETRY_DELAY_MAX, RETRY_DELAY * 2 ** (ntries - 1))
+                logging.debug(f"player '{job.username}' (rank {job.priority}): {e}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                continue
             logging.warning(f"player '{job.username}' (rank {job.priority}) skipped after {ntries} failures")
+            if retries is not None:
+                retries.add(job.priority, job.username)
             break
 
 
 async def enqueue_stats(queue: Queue, job: UsernameJob):
     await queue.put(job.result)
+
+
+async def sweep_retries(sess: ClientSession, retries: RetryList, num_workers: int) -> List[PlayerRecord]:
+    """ Make another attempt at fetching stats for each player on the retry
+    list. Players who are recovered or who no longer exist are removed from
+    the list, and the others are left on it for the next sweep. Recovered
+    records are given the rank stored in the list, so that they take the
+    place of the skipped players in the scrape being repaired.
+
+    :param sess: HTTP client session
+    :param retries: list of players skipped while scraping
+    :param num_workers: maximum number of concurrent requests
+    :return: player records which were successfully recovered
+    """
+    slots = asyncio.Semaphore(num_workers)
+    resolved, recovered = [], []
+
+    async def retry(rank, username):
+        async with slots:
+            try:
+                player = await get_player_stats(sess, username=username)
+            except UserNotFound:
+                logging.warning(f"player '{username}' (rank {rank}) no longer exists, dropping from retry list")
+            except (ServerBusy, RequestFailed) as e:
+                logging.warning(f"player '{username}' (rank {rank}) still unavailable: {e}")
+                return
+            else:
+                player.rank = player.stats[0] = rank
+                recovered.append(player)
+            resolved.append(username)
+
+    await asyncio.gather(*[retry(rank, username) for rank, username in retries])
+    retries.remove(resolved)
+    return recovered
@@ -1,25 +1,33 @@
 """ Unit test the hiscores scraping code. """
 
 import asyncio
+import csv
 import os
 import random
+from datetime import datetime
 from pathlib import Path
 from typing import Tuple, List
 
 import aiohttp
+import numpy as np
 import pytest
 
 from src.common import osrs_skills, csv_api_stats
-from src.scrape.common import PlayerRecord
-from src.scrape.export import get_top_rank, get_page_jobs, player_to_csv, csv_to_player
+from src.scrape.common import PlayerRecord, DoneScraping, RetryList, ServerBusy, UserNotFound
+from src.scrape.export import get_top_rank, get_page_jobs, player_to_csv, csv_to_player, \
+    export_records, read_rank_range, export_recovered, RankIndex
+from src.analysis.io import ColumnFile, load_artifact, load_names
+from src.scrape.clean import read_raw_players, dedup_players, sort_players, dump_full_stats, clean_out_of_core, \
+    load_full_stats
 from src.scrape.requests import get_hiscores_page, get_player_stats
-from src.scrape.workers import JobQueue, JobCounter
+from src.scrape.workers import JobQueue, JobCounter, UsernameJob, request_stats, sweep_retries, \
+    STATS_MAX_TRIES, RETRY_DELAY
 from scripts.scrape_hiscores import main as scrape_hiscores
-from scripts.clean_raw_data import main as clean_raw_data
+from scripts.clean_raw_data import main as clean_raw_data, merge as merge_raw_data
 
 
 STATS_RAW_FILE = Path(__file__).resolve().parent / "data" / "stats-raw.csv"
-STATS_FILE = Path(__file__).resolve().parent / "data" / "stats-clean.pkl"
+STATS_FILE = Path(__file__).resolve().parent / "data" / "stats-clean.cols"
 
 
 @pytest.mark.asyncio
@@ -120,15 +128,253 @@ async def test_jobcounter():
     assert jc.value == 6
 
 
+def fake_player(rank: int) -> PlayerRecord:
+    stats = [rank, 2277 - rank, 4_600_000_000 - rank] + [1] * (len(csv_api_stats()) - 3)
+    return PlayerRecord(username=f"player{rank}", stats=stats, ts=datetime(2022, 7, 21))
+
+
+@pytest.mark.asyncio
+async def test_rank_index(tmp_path):
+    out_file = tmp_path / "stats-raw.csv"
+    q = asyncio.Queue()
+    for rank in range(1, 101):
+        await q.put(fake_player(rank) if rank != 50 else None)  # rank 50 was skipped
+    with pytest.raises(DoneScraping):
+        await export_records(q, out_file, total=100, index_block_size=25)
+
+    index = RankIndex(out_file)
+    assert [rank for rank, _ in index.entries] == [1, 26, 51, 76]
+    with open(out_file, 'rb') as f:
+        for rank, offset in index.entries:
+            f.seek(offset)
+            assert f.readline().decode().startswith(f"player{rank},{rank},")
+
+    lines = read_rank_range(out_file, start_rank=40, end_rank=60)
+    assert [csv_to_player(line).rank for line in lines] == [r for r in range(40, 61) if r != 50]
+    assert len(index.partitions(ranks_per_part=50)) == 2
+
+
+@pytest.mark.asyncio
+async def test_retry_sweep(tmp_path, monkeypatch):
+    out_file = tmp_path / "stats-raw.csv"
+    q = asyncio.Queue()
+    for rank in range(1, 11):
+        await q.put(fake_player(rank) if rank not in (3, 7, 8) else None)
+    with pytest.raises(DoneScraping):
+        await export_records(q, out_file, total=10, index_block_size=2)
+
+    retries = RetryList(tmp_path / "stats-raw.csv.retry")
+    for rank in (3, 7, 8):
+        retries.add(rank, f"player{rank}")
+    assert len(RetryList(retries.file)) == 3
+
+    async def get_player_stats(sess, username):
+        if username == "player7":
+            raise ServerBusy("timed out")
+        if username == "player8":
+            raise UserNotFound(username)
+        player = fake_player(int(username.replace("player", "")))
+        player.stats[0] += 1000  # ranked lower by the time of the sweep
+        return player
+
+    monkeypatch.setattr("src.scrape.workers.get_player_stats", get_player_stats)
+    recovered = await sweep_retries(None, retries, num_workers=2)
+    assert [(p.username, p.rank, p.stats[0]) for p in recovered] == [("player3", 3, 3)]
+    assert list(RetryList(retries.file)) == [(7, "player7")]
+
+    # Recovered records go to a sidecar, which is cleaned along with the scrape file.
+    with open(out_file, 'rb') as f:
+        raw = f.read()
+    export_recovered(out_file, recovered)
+    with open(out_file, 'rb') as f:
+        assert f.read() == raw
+    df = read_raw_players(out_file)
+    assert list(df['rank']) == [1, 2, 4, 5, 6, 9, 10, 3]
+    assert list(sort_players(dedup_players(df))['rank']) == [1, 2, 3, 4, 5, 6, 9, 10]
+
+
+@pytest.mark.asyncio
+async def test_request_stats_backoff(tmp_path, monkeypatch):
+    delays = []
+
+    async def get_player_stats(sess, username):
+        raise ServerBusy("timed out")
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr("src.scrape.workers.get_player_stats", get_player_stats)
+    monkeypatch.setattr("src.scrape.workers.asyncio.sleep", sleep)
+    retries = RetryList(tmp_path / "stats-raw.csv.retry")
+    await request_stats(None, UsernameJob(priority=12, username="player12"), retries=retries)
+    assert delays == [RETRY_DELAY * 2 ** i for i in range(STATS_MAX_TRIES - 1)]
+    assert list(retries) == [(12, "player12")]
+
+
 @pytest.mark.asyncio
 async def test_scrape_hiscores():
     start_rank = random.randint(1, 2_000_000) - 100
     end_rank = start_rank + 99
-    if os.path.isfile(STATS_RAW_FILE):
-        os.remove(STATS_RAW_FILE)
+    for file in [STATS_RAW_FILE, f"{STATS_RAW_FILE}.idx"]:
+        if os.path.isfile(file):
+            os.remove(file)
     await scrape_hiscores(STATS_RAW_FILE, start_rank, end_rank, num_workers=25)
     assert get_top_rank(STATS_RAW_FILE) == end_rank
 
 
+def test_clean_chunks(tmp_path, monkeypatch):
+    raw_file = tmp_path / "stats-raw.csv"
+    players = [fake_player(rank) for rank in range(1, 51)]
+    players[10].username = "PLAYER5"        # older duplicate of player5, dropped
+    players[10].ts = datetime(2022, 7, 20)
+    players[20].username = "Player7"        # newer duplicate of player7, kept
+    players[20].ts = datetime(2022, 7, 22)
+    players[30].username = "null"
+    with open(raw_file, 'w') as f:
+        f.write(','.join(['username'] + csv_api_stats() + ['ts']) + '\n')
+        for p in reversed(players):
+            f.write(player_to_csv(p) + '\n')
+
+    df = sort_players(dedup_players(read_raw_players(raw_file, chunk_bytes=1000)))
+    df_parallel = sort_players(dedup_players(read_raw_players(raw_file, chunk_bytes=1000, num_workers=3)))
+    assert df.equals(df_parallel)
+    assert len(df) == 48
+
+    # Records are deduplicated as ranges arrive, with the same result as all at once.
+    monkeypatch.setattr("src.scrape.clean.DEDUP_BATCH_ROWS", 1)
+    assert read_raw_players(raw_file, chunk_bytes=1000).equals(read_raw_players(raw_file, chunk_bytes=10 ** 6))
+    assert list(df['rank']) == sorted(df['rank'])
+    assert "PLAYER5" not in set(df['username']) and "player7" not in set(df['username'])
+    assert {"Player7", "null"} <= set(df['username'])
+    assert df['total'].dtype == 'uint16' and df['attack'].dtype == 'uint8'
+
+    full_df = sort_players(dedup_players(read_raw_players(raw_file, chunk_bytes=1000, full_stats=True)))
+    dump_full_stats(full_df, tmp_path / "stats-full.cols")
+    stats = load_full_stats(tmp_path / "stats-full.cols")
+    assert list(stats) == ['username'] + csv_api_stats() + ['ts']
+    assert list(stats['username']) == list(df['username'])
+    assert stats['total_level'].dtype == 'int16'
+    assert stats['total_xp'].dtype == 'int64'
+    assert stats['attack_level'].dtype == 'int8'
+    assert np.all(stats['total_level'] == df['total'])
+
+
+def write_raw_file(file, players: List[PlayerRecord]):
+    with open(file, 'w') as f:
+        f.write(','.join(['username'] + csv_api_stats() + ['ts']) + '\n')
+        for p in players:
+            f.write(player_to_csv(p) + '\n')
+
+
+def test_quarantine_bad_rows(tmp_path):
+    raw_file = tmp_path / "stats-raw.csv"
+    players = [fake_player(rank) for rank in range(1, 11)]
+    players[1].stats[csv_api_stats().index('attack_level')] = 150  # level out of range
+    write_raw_file(raw_file, players)
+    with open(raw_file, 'r') as f:
+        lines = f.readlines()
+    lines[4] = lines[4].rsplit(',', 3)[0] + '\n'                 # truncated record
+    lines[6] = lines[6].replace("2022-07-21", "2022-13-45")    # bad timestamp
+    lines[8] = lines[8].replace(",1,", ",x,", 1)                # non-numeric value
+    with open(raw_file, 'w') as f:
+        f.writelines(lines)
+
+    quarantine_file = tmp_path / "rejects.csv"
+    df = read_raw_players(raw_file, chunk_bytes=3000, quarantine_file=quarantine_file, full_stats=True)
+    assert sorted(df['rank']) == [1, 3, 5, 7, 9, 10]
+
+    with open(quarantine_file, 'r') as f:
+        reader = csv.DictReader(f)
+        rejects = list(reader)
+    assert [r['line'] for r in rejects] == [lines[i].rstrip('\n') for i in (2, 4, 6, 8)]
+    assert "out of range" in rejects[0]['reason']
+    assert "fields" in rejects[1]['reason']
+    assert "timestamp" in rejects[2]['reason']
+    assert "non-numeric" in rejects[3]['reason']
+    with open(raw_file, 'rb') as f:
+        f.seek(int(rejects[0]['offset']))
+        assert f.readline().decode() == lines[2]
+
+
+def test_merge_raw_data(tmp_path, monkeypatch):
+    base = [fake_player(rank) for rank in range(1, 201)]
+    delta = [fake_player(rank) for rank in (50, 100, 150)]
+    for p in delta:
+        p.stats[1] += 20                           # gained levels, moves up the rankings
+        p.total_level = p.stats[1]
+        p.ts = datetime(2022, 8, 1)
+    delta[1].ts = datetime(2022, 7, 1)             # older than existing record, ignored
+    delta.append(fake_player(300))                 # new player
+    delta[-1].ts = datetime(2022, 8, 1)
+    write_raw_file(tmp_path / "base.csv", base)
+    write_raw_file(tmp_path / "delta.csv", delta)
+    write_raw_file(tmp_path / "all.csv", base + delta)
+
+    clean_raw_data(tmp_path / "base.csv", tmp_path / "merged-stats.cols", full_stats_file=tmp_path / "merged.cols")
+    before = ColumnFile(open(tmp_path / "merged.cols", 'rb').read())
+    merge_raw_data(tmp_path / "delta.csv", tmp_path / "merged-stats.cols", tmp_path / "merged.cols")
+    clean_raw_data(tmp_path / "all.csv", tmp_path / "expected-stats.cols", full_stats_file=tmp_path / "expected.cols")
+
+    merged, expected = load_full_stats(tmp_path / "merged.cols"), load_full_stats(tmp_path / "expected.cols")
+    for col in expected:
+        assert np.array_equal(merged[col], expected[col])
+    assert load_artifact(tmp_path / "merged-stats.cols").equals(load_artifact(tmp_path / "expected-stats.cols"))
+
+    # The file is updated in place, writing only the rows of the 2 replaced players and the new one.
+    after = ColumnFile(tmp_path / "merged.cols")
+    assert after.schema == before.schema
+    written = set()
+    for col in ['username'] + csv_api_stats() + ['ts']:
+        written |= set(np.flatnonzero(before[col] != after[col]))
+    assert len(written) == 3
+    assert np.sum(before['slots'] != after['slots']) == 1
+
+    # Players added by a merge are found by the next one.
+    merge_raw_data(tmp_path / "delta.csv", tmp_path / "merged-stats.cols", tmp_path / "merged.cols")
+    again = ColumnFile(tmp_path / "merged.cols")
+    for col in after.columns:
+        assert np.array_equal(again[col], after[col])
+
+    # Without room for the new player, the file is rewritten with the same result.
+    monkeypatch.setattr("src.scrape.clean.FULL_STATS_SPARE", 0)
+    monkeypatch.setattr("src.scrape.clean.FULL_STATS_MIN_SPARE", 0)
+    clean_raw_data(tmp_path / "base.csv", tmp_path / "full-stats.cols", full_stats_file=tmp_path / "full.cols")
+    merge_raw_data(tmp_path / "delta.csv", tmp_path / "full-stats.cols", tmp_path / "full.cols")
+    rewritten = load_full_stats(tmp_path / "full.cols")
+    for col in expected:
+        assert np.array_equal(rewritten[col], expected[col])
+
+
+def test_clean_out_of_core(tmp_path):
+    players = [fake_player(rank) for rank in range(1, 301)]
+    players[40].username = "PLAYER7"        # newer duplicate of player7, kept
+    players[40].ts = datetime(2022, 7, 22)
+    players[50].username = "Player9"        # older duplicate of player9, dropped
+    players[50].ts = datetime(2022, 7, 20)
+    write_raw_file(tmp_path / "raw.csv", players)
+
+    clean_raw_data(tmp_path / "raw.csv", tmp_path / "expected-stats.cols", full_stats_file=tmp_path / "expected.cols")
+    clean_out_of_core(tmp_path / "raw.csv", tmp_path / "out.cols", memory_budget=4096,
+                      full_stats_file=tmp_path / "out-full.cols")
+
+    expected = load_artifact(tmp_path / "expected-stats.cols")
+    out = ColumnFile(tmp_path / "out.cols")
+    assert out.columns == ['username/blob', 'username/offsets', 'username/slots'] + osrs_skills(include_total=True)
+    for skill in osrs_skills(include_total=True):
+        assert np.array_equal(out[skill], expected[skill])
+    assert load_artifact(tmp_path / "out.cols").equals(expected)
+
+    names = load_names(tmp_path / "out.cols")
+    assert list(names[:]) == list(expected.index)
+    assert names.find("player7") == list(expected.index).index("PLAYER7")
+    assert names.find("Player9") == list(expected.index).index("player9")
+    assert "player301" not in names
+
+    expected_full, out_full = ColumnFile(tmp_path / "expected.cols"), ColumnFile(tmp_path / "out-full.cols")
+    assert out_full.columns == expected_full.columns
+    for col in expected_full.columns:
+        assert np.array_equal(out_full[col], expected_full[col])
+
+
 def test_clean_raw_data():
     clean_raw_data(STATS_RAW_FILE, STATS_FILE)
@@ -1,20 +1,37 @@
 import csv
+import gzip
+import hashlib
+import os
 from collections import OrderedDict
 from pathlib import Path
 
+import boto3
 import numpy as np
 import pandas as pd
+import pytest
 import xarray as xr
+from botocore.exceptions import ClientError, NoCredentialsError
 
 from scripts.build_app_data import main as build_app_data
-from scripts.build_app_db import main as build_app_database
-from scripts.cluster_players import main as cluster_players
-from scripts.compute_quartiles import main as compute_quartiles
+from scripts.build_app_db import main as build_app_database, main_out_of_core as build_app_database_out_of_core
+from scripts.cluster_players import main as cluster_players, main_out_of_core as cluster_players_out_of_core, \
+    split_features, collapse_duplicates, sweep_k
+from scripts.compute_quartiles import main as compute_quartiles, main_out_of_core as compute_quartiles_out_of_core
+import scripts.dim_reduce_clusters
 from scripts.dim_reduce_clusters import main as dim_reduce_clusters
-from src.common import osrs_skills, connect_mongo
+import src.common
+from src.common import osrs_skills, connect_mongo, download_s3_obj
 from src.analysis.appdata import PlayerResults, SplitResults
-from src.analysis.io import import_players_csv, import_clusterids_csv, import_centroids_csv, \
-    export_players_csv, export_clusterids_csv, export_centroids_csv
+import src.analysis.models
+import src.analysis.publish
+from src.analysis.cache import StageCache, hash_data, prune_cache
+from src.analysis.models import assign_clusters, assignment_mismatch, assign_levels, fit_minibatch_kmeans
+from src.analysis.publish import publish_artifacts, publish_manifest, resolve_artifact, load_manifest, \
+    release_history, stale_collections
+from src.analysis.snapshots import SnapshotStore
+from src.analysis.synthetic import synthetic_players, UNRANKED_BELOW
+from src.analysis.io import dump_artifact, load_artifact, ColumnFile, import_players_csv, import_clusterids_csv, \
+    import_centroids_csv, export_players_csv, export_clusterids_csv, export_centroids_csv, pack_levels, unpack_levels
 
 
 SPLITS = OrderedDict([
@@ -27,6 +44,12 @@ UMAP_NN_PER_SPLIT = {"first5": 5, "last10": 10}
 UMAP_MINDIST_PER_SPLIT = {"first5": 0.25, "last10": 0.10}
 
 
+def mock_aws():
+    # moto is a dev requirement, so the tests which mock S3 are skipped without it.
+    moto = pytest.importorskip("moto")
+    return moto.mock_aws() if hasattr(moto, 'mock_aws') else moto.mock_s3()  # moto < 5
+
+
 global players_df
 global clusterids_df, centroids_dict
 global quartiles_dict
@@ -53,6 +76,177 @@ def test_cluster():
         assert list(split_centroids.columns) == skills_in_split
 
 
+def test_cluster_parallel():
+    global players_df, clusterids_df, centroids_dict
+    parallel_clusterids, parallel_centroids = cluster_players(
+        players_df, k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS, verbose=False, num_workers=2)
+    assert parallel_clusterids.equals(clusterids_df)
+    assert list(parallel_centroids.keys()) == list(centroids_dict.keys())
+    for split in SPLITS:
+        assert np.allclose(parallel_centroids[split], centroids_dict[split])
+
+
+def test_cluster_warm_start(tmp_path):
+    global players_df, clusterids_df, centroids_dict
+    for split in SPLITS:
+        assert centroids_dict[split].attrs['inertia'] > 0
+
+    # Refining the centroids of the last run keeps the fit about as good.
+    warm_clusterids, warm_centroids = cluster_players(
+        players_df, k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS, verbose=False, prev_centroids=centroids_dict)
+    assert list(warm_centroids.keys()) == list(centroids_dict.keys())
+    for split in SPLITS:
+        assert warm_centroids[split].attrs['inertia'] <= 1.05 * centroids_dict[split].attrs['inertia']
+        assert warm_centroids[split].attrs['baseline_inertia'] == centroids_dict[split].attrs['inertia']
+
+    # When the refined centroids are too poor a fit, they are fit from scratch.
+    refit_clusterids, refit_centroids = cluster_players(
+        players_df, k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS, verbose=False, prev_centroids=centroids_dict,
+        warm_start_tolerance=-1)
+    assert refit_clusterids.equals(clusterids_df)
+    for split in SPLITS:
+        assert refit_centroids[split].attrs['baseline_inertia'] == refit_centroids[split].attrs['inertia']
+
+    # The fit is held to the last fit from scratch, not to the (possibly drifted) last warm start.
+    drifted = {}
+    for split, centroids in centroids_dict.items():
+        drifted[split] = centroids.copy()
+        drifted[split].attrs['inertia'] = 1e9
+        drifted[split].attrs['baseline_inertia'] = centroids.attrs['inertia'] / 2
+    drifted_clusterids, _ = cluster_players(
+        players_df, k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS, verbose=False, prev_centroids=drifted)
+    assert drifted_clusterids.equals(clusterids_df)
+
+    # Results fitted from other initial centroids are not reused from the cache.
+    cache = StageCache(tmp_path, 'cluster_players')
+    cluster_players(players_df, k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS, verbose=False, cache=cache)
+    assert len(os.listdir(tmp_path / 'cluster_players')) == len(SPLITS)
+    for _ in range(2):
+        cached_clusterids, _ = cluster_players(players_df, k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS,
+                                               verbose=False, cache=cache, prev_centroids=centroids_dict)
+        assert cached_clusterids.equals(warm_clusterids)
+        assert len(os.listdir(tmp_path / 'cluster_players')) == 2 * len(SPLITS)
+
+
+def test_sweep(tmp_path):
+    global players_df
+    ks = {"first5": [10, 40], "last10": [10, 25]}
+    report = sweep_k(players_df, SPLITS, ks, nsample=3000, cache_dir=tmp_path, verbose=False)
+    assert list(report.keys()) == list(SPLITS.keys())
+    for split, entries in report.items():
+        assert [entry['k'] for entry in entries] == ks[split]
+        assert entries[1]['inertia'] < entries[0]['inertia']  # finer clusterings fit more closely
+        for entry in entries:
+            assert 0 <= entry['sizes']['min'] <= entry['sizes']['median'] <= entry['sizes']['max'] <= 1
+            assert -1 <= entry['stability'] <= 1
+
+    # Extending a sweep reuses the fits for the values of k already tried.
+    ncached = len(os.listdir(tmp_path / 'cluster_sweep'))
+    extended = sweep_k(players_df, SPLITS, {split: k + [60] for split, k in ks.items()}, nsample=3000,
+                       cache_dir=tmp_path, num_workers=2, verbose=False)
+    assert len(os.listdir(tmp_path / 'cluster_sweep')) == ncached + 4
+    for split, entries in report.items():
+        assert extended[split][:2] == entries
+
+    # Values of k above the number of distinct players are skipped, however many players there are.
+    repeated = pd.concat([players_df.iloc[1000:1005]] * 100)
+    report = sweep_k(repeated, SPLITS, {split: [2, 10] for split in SPLITS}, nsample=200, verbose=False)
+    for split, entries in report.items():
+        assert [entry['k'] for entry in entries] == [2]
+
+
+def test_synthetic_players():
+    players = synthetic_players(5000, seed=1, names=True)
+    assert list(players.columns) == osrs_skills(include_total=True)
+    assert players['total'].dtype == 'uint16' and players['attack'].dtype == 'uint8'
+    assert players.index.is_unique and players.index.name == 'username'
+    assert np.all(np.diff(players['total'].to_numpy().astype(int)) <= 0)  # sorted by total level descending
+
+    levels = players[osrs_skills()].to_numpy()
+    assert levels.max() == 99 and np.all((levels == 0) | (levels >= UNRANKED_BELOW))
+    assert 0 < np.mean(levels == 0) < 0.5 and np.any(np.all(levels == 99, axis=1))
+    assert players.equals(synthetic_players(5000, seed=1, names=True))
+
+
+def test_collapse_duplicates():
+    stats = np.array([[3, 1], [1, 1], [3, 1], [2, 5], [1, 1], [3, 1]], dtype='float64')
+    weights = np.array([1, 0.5, 1, 1, 0.5, 1])
+    points, point_weights, inverse = collapse_duplicates(stats, weights, nclusters=2)
+    assert np.array_equal(points, [[3, 1], [1, 1], [2, 5]])  # in order of first appearance
+    assert np.array_equal(point_weights, [3, 1, 1])
+    assert np.array_equal(points[inverse], stats)
+
+    # With fewer unique vectors than clusters, every player is kept.
+    points, point_weights, inverse = collapse_duplicates(stats, weights, nclusters=4)
+    assert points is stats and inverse is None
+
+
+def test_assign_clusters():
+    global players_df, centroids_dict
+    for split, skills in SPLITS.items():
+        features, _ = split_features(players_df[skills].to_numpy())
+        centroids = centroids_dict[split].to_numpy()
+        sqdists = ((features[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+
+        # Chunks of a float64 array are converted and searched a few at a time.
+        ids, nearest_sqdists = assign_clusters(features, centroids, chunk_rows=37, num_threads=3)
+        assert ids.dtype == 'int64' and nearest_sqdists.dtype == 'float32'
+        assert np.allclose(nearest_sqdists, sqdists.min(axis=1), rtol=1e-4)
+        assert np.allclose(sqdists[np.arange(len(ids)), ids], sqdists.min(axis=1), rtol=1e-4)
+        assert np.array_equal(ids, assign_clusters(features, centroids)[0])
+        assert assignment_mismatch(features, centroids, ids) == (0, len(features))
+
+        # Approximate indexes find the nearest centroid for nearly every player.
+        for method in ['hnsw', 'ivf']:
+            approx_ids, _ = assign_clusters(features, centroids, method=method, effort=16)
+            nwrong, nchecked = assignment_mismatch(features, centroids, approx_ids, nsample=1000)
+            assert nchecked == 1000 and nwrong < 50
+
+
+def test_assign_levels(monkeypatch):
+    global players_df, centroids_dict
+    for split, skills in SPLITS.items():
+        levels = players_df[skills].to_numpy()
+        features, _ = split_features(levels)
+        centroids = centroids_dict[split].to_numpy()
+        expected_ids, expected_sqdists = assign_clusters(features, centroids)
+
+        # Lookup tables treat unranked levels as 1s, like the features do.
+        for engine in ['numba', 'numpy']:
+            ids, sqdists = assign_levels(levels, centroids, chunk_rows=37, engine=engine)
+            assert ids.dtype == 'int64' and sqdists.dtype == 'float32'
+            assert np.mean(ids == expected_ids) > 0.999
+            assert np.allclose(sqdists, expected_sqdists, rtol=1e-4, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        assign_levels(np.full((2, 3), 356, dtype='uint16'), np.ones((4, 3)))
+
+    # Clustering can assign players with lookup tables instead of faiss, which read the stored levels.
+    dtypes = []
+
+    def record_assign_levels(levels, *args, **kwargs):
+        dtypes.append(levels.dtype)
+        return assign_levels(levels, *args, **kwargs)
+    monkeypatch.setattr(src.analysis.models, 'assign_levels', record_assign_levels)
+    lut_clusterids, _ = cluster_players(players_df, k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS, verbose=False,
+                                        assign_index='lut')
+    assert np.mean(lut_clusterids.to_numpy() == clusterids_df.to_numpy()) > 0.999
+    assert dtypes == [np.dtype('uint8')] * len(SPLITS)
+
+
+def test_minibatch_init_weights():
+    # A batch of players all a little way from the first centroid moves it by a step which shrinks
+    # with the weight behind the initial centroids, rather than all the way to the batch mean.
+    init = np.array([[0], [10]], dtype='float32')
+
+    def batches():
+        yield np.ones((10, 1), dtype='float32'), np.ones(10)
+
+    for init_weights, expected in [(None, 0.5), ([990, 990], 0.01)]:
+        centroids, _ = fit_minibatch_kmeans(batches, init, init_weights, max_passes=1, verbose=False)
+        assert np.allclose(centroids, [[expected], [10]])
+
+
 def test_quartiles():
     global players_df, clusterids_df, quartiles_dict
     quartiles_dict = compute_quartiles(players_df, clusterids_df, SPLITS)
@@ -65,6 +259,51 @@ def test_quartiles():
         assert list(split_quartiles.coords["skill"]) == ['total'] + SPLITS[split]
 
 
+def test_out_of_core(tmp_path):
+    global players_df, clusterids_df, centroids_dict, quartiles_dict
+    dump_artifact(players_df, tmp_path / "stats.cols", index_label='username')
+
+    # With enough memory to train on every player the results match the in-memory pipeline.
+    centroids = cluster_players_out_of_core(tmp_path / "stats.cols", k_per_split=NCLUSTERS_PER_SPLIT,
+                                            splits=SPLITS, out_clusterids=tmp_path / "clusterids.cols",
+                                            memory_budget=1024 ** 3, verbose=False)
+    assert load_artifact(tmp_path / "clusterids.cols").equals(clusterids_df)
+    for split in SPLITS.keys():
+        assert np.array_equal(centroids[split], centroids_dict[split])
+    cluster_players_out_of_core(tmp_path / "stats.cols", k_per_split=NCLUSTERS_PER_SPLIT, splits=SPLITS,
+                                out_clusterids=tmp_path / "lut-clusterids.cols", memory_budget=1024 ** 3,
+                                verbose=False, assign_index='lut')
+    lut_clusterids = load_artifact(tmp_path / "lut-clusterids.cols")
+    assert np.mean(lut_clusterids.to_numpy() == clusterids_df.to_numpy()) > 0.999
+
+    quartiles = compute_quartiles_out_of_core(tmp_path / "stats.cols", tmp_path / "clusterids.cols",
+                                              SPLITS, memory_budget=64 * 1024)
+    for split in SPLITS.keys():
+        assert quartiles[split].equals(quartiles_dict[split])
+
+    # With a small budget centroids are fit to a sample of players.
+    centroids = cluster_players_out_of_core(tmp_path / "stats.cols", k_per_split=NCLUSTERS_PER_SPLIT,
+                                            splits=SPLITS, out_clusterids=tmp_path / "clusterids.cols",
+                                            memory_budget=128 * 1024, verbose=False)
+    clusterids = ColumnFile(tmp_path / "clusterids.cols")
+    for split, nclusters in NCLUSTERS_PER_SPLIT.items():
+        assert centroids[split].shape == (nclusters, len(SPLITS[split]))
+        assert 0 <= clusterids[split].min() and clusterids[split].max() < nclusters
+
+    # In mini-batch mode centroids are refined on every player, so the fit is about as good as the full one.
+    centroids = cluster_players_out_of_core(tmp_path / "stats.cols", k_per_split=NCLUSTERS_PER_SPLIT,
+                                            splits=SPLITS, out_clusterids=tmp_path / "clusterids.cols",
+                                            memory_budget=128 * 1024, verbose=False, minibatch=True)
+    for split, skills in SPLITS.items():
+        features, weights = split_features(players_df[skills].to_numpy())
+
+        def inertia(c):
+            sqdists = ((features[:, None, :] - c.to_numpy()[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+            return weights @ sqdists / weights.sum()
+
+        assert inertia(centroids[split]) < 1.15 * inertia(centroids_dict[split])
+
+
 def test_dimreduce():
     global centroids_dict, xyz_dict
     xyz_dict = dim_reduce_clusters(centroids_dict, n_neighbors=UMAP_NN_PER_SPLIT, min_dist=UMAP_MINDIST_PER_SPLIT)
@@ -75,6 +314,50 @@ def test_dimreduce():
         assert tuple(split_xyz.columns) == ('x', 'y', 'z')
 
 
+def test_stage_cache(tmp_path, monkeypatch):
+    global centroids_dict, xyz_dict
+    ncalls = []
+    umap_reduce = scripts.dim_reduce_clusters.umap_reduce
+    monkeypatch.setattr(scripts.dim_reduce_clusters, 'umap_reduce',
+                        lambda *args, **kwargs: ncalls.append(1) or umap_reduce(*args, **kwargs))
+
+    cache = StageCache(tmp_path, 'dim_reduce_clusters')
+    xyz = dim_reduce_clusters(centroids_dict, UMAP_NN_PER_SPLIT, UMAP_MINDIST_PER_SPLIT, cache)
+    assert len(ncalls) == 2
+    for split in SPLITS.keys():
+        assert xyz[split].equals(xyz_dict[split])
+
+    # Changing a parameter for one split recomputes only that split.
+    min_dist = dict(UMAP_MINDIST_PER_SPLIT, last10=0.5)
+    xyz = dim_reduce_clusters(centroids_dict, UMAP_NN_PER_SPLIT, min_dist, cache)
+    assert len(ncalls) == 3
+    assert xyz['first5'].equals(xyz_dict['first5'])
+    assert not xyz['last10'].equals(xyz_dict['last10'])
+
+    xyz = dim_reduce_clusters(centroids_dict, UMAP_NN_PER_SPLIT, min_dist, cache)
+    assert len(ncalls) == 3
+
+
+def test_cache_prune(tmp_path):
+    global centroids_dict
+    centroids = centroids_dict['first5']
+    assert hash_data(centroids) == hash_data(centroids.copy())
+    assert hash_data(centroids) != hash_data(centroids.set_axis(centroids.index + 1))
+
+    caches = [StageCache(tmp_path, 'a'), StageCache(tmp_path, 'b')]
+    for i in range(6):
+        caches[i % 2].dump(str(i), centroids)
+        os.utime(caches[i % 2].path(str(i)), (i, i))
+    size = os.path.getsize(caches[0].path('0'))
+    caches[0].load('0')  # used most recently, so kept
+
+    # The least recently used results of any stage are deleted first.
+    assert prune_cache(tmp_path, 3 * size) == 3 * size
+    assert [key for key in map(str, range(6)) if caches[int(key) % 2].load(key) is not None] == ['0', '4', '5']
+    caches[0].clear()
+    assert os.listdir(tmp_path / 'a') == [] and os.listdir(tmp_path / 'b') == ['5.cols']
+
+
 def test_appdata():
     global clusterids_df, centroids_dict, quartiles_dict, xyz_dict
     app_data = build_app_data(SPLITS, clusterids_df, centroids_dict, quartiles_dict, xyz_dict)
@@ -95,6 +378,182 @@ def test_appdata():
         for axlimits in split_data.xyz_axlims.values():
             assert axlimits[0] <= axlimits[1]
 
+
+def test_artifacts(tmp_path):
+    global players_df, clusterids_df, centroids_dict, quartiles_dict, xyz_dict
+    dump_artifact(players_df, tmp_path / "stats.cols", index_label='username')
+    players = load_artifact(tmp_path / "stats.cols")
+    assert players.equals(players_df) and players.index.equals(players_df.index)
+    subset = load_artifact(tmp_path / "stats.cols", columns=['total', 'attack'], index=False)
+    assert list(subset.columns) == ['total', 'attack']
+    assert np.array_equal(subset['attack'], players_df['attack'])
+
+    dump_artifact(players_df, tmp_path / "stats-packed.cols", index_label='username', pack=True)
+    assert os.path.getsize(tmp_path / "stats-packed.cols") < os.path.getsize(tmp_path / "stats.cols")
+    assert load_artifact(tmp_path / "stats-packed.cols").equals(players_df)
+    levels = players_df[osrs_skills()].to_numpy()
+    assert np.array_equal(unpack_levels(pack_levels(levels), levels.shape[1]), levels)
+
+    dump_artifact(clusterids_df, tmp_path / "clusterids.cols", index_label='username')
+    assert load_artifact(tmp_path / "clusterids.cols").equals(clusterids_df)
+
+    app_data = build_app_data(SPLITS, clusterids_df, centroids_dict, quartiles_dict, xyz_dict)
+    for name, obj in [("centroids", centroids_dict), ("quartiles", quartiles_dict), ("xyz", xyz_dict)]:
+        dump_artifact(obj, tmp_path / f"{name}.cols")
+        loaded = load_artifact(tmp_path / f"{name}.cols")
+        assert list(loaded.keys()) == list(obj.keys())
+        for split in obj.keys():
+            assert loaded[split].equals(obj[split])
+
+    dump_artifact(app_data, tmp_path / "app-data.cols")
+    with open(tmp_path / "app-data.cols", 'rb') as f:
+        loaded = load_artifact(f.read())
+    for split, split_data in app_data.items():
+        assert loaded[split].skills == split_data.skills
+        assert loaded[split].cluster_quartiles.equals(split_data.cluster_quartiles)
+        assert loaded[split].cluster_centroids.equals(split_data.cluster_centroids)
+        assert np.array_equal(loaded[split].cluster_sizes, split_data.cluster_sizes)
+        assert loaded[split].xyz_axlims.keys() == split_data.xyz_axlims.keys()
+
+
+def test_snapshots(tmp_path):
+    global players_df
+    store = SnapshotStore(tmp_path / "snapshots")
+    assert store.add(players_df, "2022-07") == {'added': len(players_df), 'changed': 0, 'removed': 0}
+
+    # Next month, some players level up, one changes the case of their name, one drops out and one is new.
+    later = players_df.copy()
+    later.iloc[:3, later.columns.get_loc('attack')] += 1
+    later = later.rename(index={later.index[5]: later.index[5].upper()}).drop(later.index[7])
+    later = pd.concat([later, players_df.iloc[:1].rename(index={players_df.index[0]: "new player"})])
+    assert store.add(later, "2022-08") == {'added': 1, 'changed': 4, 'removed': 1}
+    assert os.path.getsize(tmp_path / "snapshots" / "delta-0001.cols") < \
+        os.path.getsize(tmp_path / "snapshots" / "base.cols") / 10
+
+    reopened = SnapshotStore(tmp_path / "snapshots")
+    assert reopened.labels == ["2022-07", "2022-08"]
+    assert reopened.load("2022-07").equals(players_df)
+    assert reopened.load().equals(later)
+
+    first = players_df.index[0]
+    history = reopened.history(first.upper())
+    assert list(history.index) == ["2022-07", "2022-08"]
+    assert list(history['attack']) == [players_df['attack'].iloc[0], players_df['attack'].iloc[0] + 1]
+    assert list(reopened.history(players_df.index[7]).index) == ["2022-07"]
+    assert list(reopened.history("new player").index) == ["2022-08"]
+    assert reopened.history("nobody").empty
+
+
+def test_snapshots_order(tmp_path):
+    global players_df
+    store = SnapshotStore(tmp_path / "snapshots", keyframe_interval=3)
+    rng = np.random.default_rng(0)
+    snapshots = [players_df]
+    for _ in range(4):
+        # Players with the same total level swap places, and a few unchanged players move far up or down.
+        later = snapshots[-1].iloc[np.lexsort((rng.random(len(players_df)), -snapshots[-1]['total'].to_numpy()))]
+        later = later.iloc[np.r_[10:20, 0:10, 20:len(later) - 5, len(later) - 2:len(later), len(later) - 5:len(later) - 2]]
+        later = later.copy()
+        later.iloc[:5, later.columns.get_loc('attack')] += 1
+        snapshots.append(later)
+    for i, players in enumerate(snapshots):
+        store.add(players, f"2022-{i + 1:02d}")
+    assert sorted(os.listdir(tmp_path / "snapshots")) == ["base.cols", "delta-0001.cols", "delta-0002.cols",
+                                                          "delta-0004.cols", "keyframe-0003.cols", "snapshots.json"]
+
+    reopened = SnapshotStore(tmp_path / "snapshots", keyframe_interval=3)
+    for i, players in enumerate(snapshots):
+        assert reopened.load(f"2022-{i + 1:02d}").equals(players)
+    assert list(reopened.history(players_df.index[0]).index) == reopened.labels
+
+
+def test_download_s3(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(src.common, 'S3_PART_BYTES', 100_000)
+    blob = np.random.default_rng(0).bytes(1_234_567)
+
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test-bucket')
+        s3.put_object(Bucket='test-bucket', Key='data/app-data.cols', Body=blob)
+
+        path = download_s3_obj('s3://test-bucket/data/app-data.cols', cache_dir=tmp_path, num_workers=4)
+        assert path == str(tmp_path / "test-bucket" / "data" / "app-data.cols")
+        with open(path, 'rb') as f:
+            assert f.read() == blob
+
+        # An up-to-date copy is not downloaded again, but a changed object is.
+        capsys.readouterr()
+        download_s3_obj('s3://test-bucket/data/app-data.cols', cache_dir=tmp_path)
+        assert "downloading" not in capsys.readouterr().out
+        s3.put_object(Bucket='test-bucket', Key='data/app-data.cols', Body=blob[::-1])
+        download_s3_obj('s3://test-bucket/data/app-data.cols', cache_dir=tmp_path)
+        assert "downloading" in capsys.readouterr().out
+        with open(path, 'rb') as f:
+            assert f.read() == blob[::-1]
+
+        # A missing object is an error even if there is a copy, so that callers can fall back to another.
+        s3.delete_object(Bucket='test-bucket', Key='data/app-data.cols')
+        with pytest.raises(ClientError):
+            download_s3_obj('s3://test-bucket/data/app-data.cols', cache_dir=tmp_path)
+
+    # Without access to S3, the cached copy is used as it is.
+    for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE']:
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / "missing"))
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / "missing"))
+    monkeypatch.setenv('AWS_EC2_METADATA_DISABLED', 'true')
+    assert download_s3_obj('s3://test-bucket/data/app-data.cols', cache_dir=tmp_path) == path
+    with pytest.raises(NoCredentialsError):
+        download_s3_obj('s3://test-bucket/data/other.cols', cache_dir=tmp_path)
+
+
+def test_publish(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(src.analysis.publish, 'PUBLISH_PART_BYTES', 5 * 1024 ** 2)  # smallest part S3 allows
+    blobs = {'app-data': np.random.default_rng(0).bytes(12 * 1024 ** 2), 'cluster-xyz': b'small artifact'}
+    files = {}
+    for name, blob in blobs.items():
+        files[name] = tmp_path / f"{name}.cols"
+        files[name].write_bytes(blob)
+
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test-bucket')
+        assert load_manifest('s3://test-bucket/release/manifest.json', missing_ok=True) is None
+        manifest = publish_artifacts(files, 's3://test-bucket/release', num_workers=4, release='r1')
+        assert manifest['artifacts']['app-data']['key'] == 'release/releases/r1/app-data.cols'
+
+        for name, blob in blobs.items():
+            url = resolve_artifact('s3://test-bucket/release/manifest.json', name)
+            with open(download_s3_obj(url, cache_dir=tmp_path / "cache"), 'rb') as f:
+                assert f.read() == blob
+            assert manifest['artifacts'][name]['sha256'] == hashlib.sha256(blob).hexdigest()
+
+        # A release uploaded without its manifest is not made current.
+        publish_artifacts({'app-data': files['cluster-xyz']}, 's3://test-bucket/release', release='r2',
+                          write_manifest=False)
+        assert resolve_artifact('s3://test-bucket/release/manifest.json', 'app-data').endswith('r1/app-data.cols')
+
+        # The database collection built for a release is switched to along with its artifacts.
+        publish_manifest(dict(manifest, collection='players-r1'), 's3://test-bucket/release')
+        assert load_manifest('s3://test-bucket/release/manifest.json')['collection'] == 'players-r1'
+
+    # Each release records the earlier ones, and only their collections are ever dropped.
+    manifest = {'release': 'r1', 'collection': 'players-r1'}
+    for release, collection in [('r2', 'players-r2'), ('r3', None), ('r4', 'players-r4'), ('r5', 'players-r5')]:
+        manifest = {'release': release, 'collection': collection or manifest['collection'],
+                    'history': release_history(manifest)}
+    assert [entry['release'] for entry in manifest['history']] == ['r1', 'r2', 'r3', 'r4']
+    assert manifest['history'][2]['collection'] == 'players-r2'
+    assert stale_collections(manifest) == ['players-r1', 'players-r2']
+    assert release_history(None) == [] and stale_collections({'release': 'r1', 'collection': 'players-r1'}) == []
+
+
 def test_appdb():
     global players_df, clusterids_df
     coll = connect_mongo("localhost:27017", 'test')
@@ -102,6 +561,12 @@ def test_appdb():
     build_app_database(players_df, clusterids_df, coll, batch_size=789)
     assert coll.count_documents({}) == len(players_df)
 
+    # A rebuild replaces the collection only once it is complete.
+    build_app_database(players_df.head(100), clusterids_df, coll, batch_size=789)
+    assert coll.count_documents({}) == 100
+    assert 'test-staging' not in coll.database.list_collection_names()
+    build_app_database(players_df, clusterids_df, coll, batch_size=789)
+
     for uname in [d['username'] for d in coll.find({}, limit=5)]:
         playerdoc = coll.find_one({'_id': uname.lower()})
         assert 'username' in playerdoc
@@ -111,6 +576,18 @@ def test_appdb():
     coll.drop()
 
 
+def test_appdb_alignment(tmp_path):
+    global players_df, clusterids_df
+    players = players_df.head(100)
+    dump_artifact(players, tmp_path / "stats.cols")
+    for name, clusterids in [("shuffled", clusterids_df.loc[players.index[::-1]]),
+                             ("short", clusterids_df.loc[players.index[:50]])]:
+        dump_artifact(clusterids, tmp_path / f"{name}.cols")
+        # Misaligned files are rejected before the collection is touched.
+        with pytest.raises(ValueError, match="aligned|players"):
+            build_app_database_out_of_core(tmp_path / "stats.cols", tmp_path / f"{name}.cols", None, 4096)
+
+
 def test_export():
     global players_df, clusterids_df, centroids_dict
     data_dir = Path(__file__).resolve().parent / "data"
@@ -161,3 +638,53 @@ def test_export():
     for split, centroids_df in import_centroids_csv(centroids_file).items():
         diff = abs(centroids_dict[split] - centroids_df)
         assert np.all(diff < 5e-6)
+
+
+def csv_players(nrows):
+    usernames = ['zezima', 'has,comma', 'has "quotes"', 'Lynx Titan', '"both",here']
+    return pd.DataFrame({'total': np.arange(nrows)[::-1] * 100, 'attack': np.arange(nrows) % 3},
+                        index=[f"{usernames[i % len(usernames)]}{i}" for i in range(nrows)], dtype='uint16')
+
+
+def csv_centroids():
+    values = np.array([0.5, 2.5, 1 / 3, 98.76543, 1e-8, 3e20, 0, 99], dtype='float32')
+    centroids = OrderedDict()
+    for split, skills in list(SPLITS.items()) + [('has,comma "quotes"', ['attack'])]:
+        centroids[split] = pd.DataFrame(np.resize(values, (len(values), len(skills))), columns=skills)
+    return centroids
+
+
+def write_players_rows(writer, players):
+    writer.writerow(['username', 'rank'] + list(players.columns))
+    for rank, (uname, stats) in enumerate(players.iterrows(), 1):
+        writer.writerow([uname, rank] + ['' if n == 0 else n for n in stats])
+
+
+def write_centroids_rows(writer, centroids):
+    writer.writerow(['split', 'clusterid'] + osrs_skills(include_total=False))
+    for split, split_centroids in centroids.items():
+        for clusterid, centroid in split_centroids.iterrows():
+            writer.writerow([split, clusterid] + ['' if s not in centroid.index else centroid[s] for s in osrs_skills()])
+
+
+# Exports are written in chunks of 3 rows, so these cover empty files, chunk boundaries and gzip members.
+@pytest.mark.parametrize('data, export, write_rows, file', [
+    pytest.param(csv_players(5), export_players_csv, write_players_rows, "players.csv", id='players'),
+    pytest.param(csv_players(5), export_players_csv, write_players_rows, "players.csv.gz", id='players-gz'),
+    pytest.param(csv_players(0), export_players_csv, write_players_rows, "players.csv", id='players-empty'),
+    pytest.param(csv_players(0), export_players_csv, write_players_rows, "players.csv.gz", id='players-empty-gz'),
+    pytest.param(csv_players(3), export_players_csv, write_players_rows, "players.csv.gz", id='players-one-chunk-gz'),
+    pytest.param(csv_players(6), export_players_csv, write_players_rows, "players.csv.gz", id='players-two-chunks-gz'),
+    pytest.param(csv_players(7), export_players_csv, write_players_rows, "players.csv.gz", id='players-past-chunk-gz'),
+    pytest.param(csv_centroids(), export_centroids_csv, write_centroids_rows, "centroids.csv", id='centroids'),
+])
+def test_export_matches_csv_writer(tmp_path, monkeypatch, data, export, write_rows, file):
+    with open(tmp_path / "expected.csv", 'w') as f:
+        write_rows(csv.writer(f), data)
+    with open(tmp_path / "expected.csv", 'rb') as f:
+        expected = f.read()
+
+    monkeypatch.setattr("src.analysis.io.EXPORT_CHUNK_ROWS", 3)
+    export(data, tmp_path / file)
+    with (gzip.open if file.endswith('.gz') else open)(tmp_path / file, 'rb') as f:
+        assert f.read() == expected